@@ -3,255 +3,501 @@ import os
 import google.generativeai as genai
 import openai
 import anthropic
+import httpx
 from dotenv import load_dotenv
 import json
-from typing import List, Dict, Any
+import copy
+import time
+from typing import List, Dict, Any, Optional
 import asyncio
 import re
-from sqlalchemy.orm import Session
+import difflib
+from sqlalchemy.ext.asyncio import AsyncSession
 import memory_service
+import cache_service
+import metrics_service
+import concurrency_limiter
+import patch_service
+import review_planner
+import incremental_review
+import review_json
+import prompt_templates
+import review_calls
+from prompt_templates import SUGGESTION_FORMATS
+from review_stream_parser import IncrementalReviewParser
 
 # .envファイルから環境変数を読み込む
 load_dotenv()
 
+# --- 共有HTTPコネクションプールの設定 ---
+AI_HTTP_MAX_CONNECTIONS = int(os.getenv("AI_HTTP_MAX_CONNECTIONS", "100"))
+AI_HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("AI_HTTP_MAX_KEEPALIVE_CONNECTIONS", "20"))
+AI_HTTP_KEEPALIVE_EXPIRY_SECONDS = float(os.getenv("AI_HTTP_KEEPALIVE_EXPIRY_SECONDS", "60"))
+AI_HTTP_TIMEOUT_SECONDS = float(os.getenv("AI_HTTP_TIMEOUT_SECONDS", "120"))
+
+def _build_http_client() -> httpx.AsyncClient:
+    """
+    OpenAIとAnthropicのSDKで共有する、keep-alive付きの非同期HTTPクライアントを作成します。
+    h2パッケージが利用可能な場合はHTTP/2を有効にします。
+    """
+    try:
+        import h2  # noqa: F401
+        http2 = True
+    except ImportError:
+        http2 = False
+    return httpx.AsyncClient(
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=AI_HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=AI_HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=AI_HTTP_KEEPALIVE_EXPIRY_SECONDS,
+        ),
+        timeout=httpx.Timeout(AI_HTTP_TIMEOUT_SECONDS, connect=10.0),
+    )
+
+_http_client = _build_http_client()
+
 # --- 各AIクライアントの初期化 (非同期) ---
 try:
     gemini_api_key = os.getenv("GEMINI_API_KEY")
     if not gemini_api_key: raise ValueError("GEMINI_API_KEY not found.")
+    # Geminiは非同期呼び出しにgRPC(HTTP/2)のチャネルを使い、SDK内部で使い回される
     genai.configure(api_key=gemini_api_key)
     
     openai_api_key = os.getenv("OPENAI_API_KEY")
     if not openai_api_key: raise ValueError("OPENAI_API_KEY not found.")
-    openai_client = openai.AsyncOpenAI(api_key=openai_api_key)
+    # 429の再試行はconcurrency_limiterで行うため、SDK内部の自動再試行は無効にする
+    openai_client = openai.AsyncOpenAI(api_key=openai_api_key, http_client=_http_client, max_retries=0)
 
     anthropic_api_key = os.getenv("ANTHROPIC_API_KEY")
     if not anthropic_api_key: raise ValueError("ANTHROPIC_API_KEY not found.")
-    claude_client = anthropic.AsyncAnthropic(api_key=anthropic_api_key)
+    claude_client = anthropic.AsyncAnthropic(api_key=anthropic_api_key, http_client=_http_client, max_retries=0)
 
 except Exception as e:
     print(f"--- DEBUG: Error configuring API Keys: {e} ---")
 
+# Geminiのモデルオブジェクトは (モデル名, システム指示) ごとに1つだけ作成して使い回す
+_gemini_models: Dict[tuple, genai.GenerativeModel] = {}
+
+def _get_gemini_model(model_name: str, system_instruction: Optional[str] = None) -> genai.GenerativeModel:
+    key = (model_name, system_instruction)
+    model = _gemini_models.get(key)
+    if model is None:
+        model = genai.GenerativeModel(model_name, system_instruction=system_instruction) if system_instruction else genai.GenerativeModel(model_name)
+        _gemini_models[key] = model
+    return model
+
+async def aclose_clients() -> None:
+    """アプリケーション終了時に、共有HTTPコネクションプールを閉じます。"""
+    await _http_client.aclose()
+
 # --- 各AIモデルを呼び出すための内部関数 (非同期) ---
 
-async def _call_gemini(prompt: str, model_name: str = 'gemini-1.5-flash-latest') -> str:
+# system を渡すと、プロバイダー側のプロンプトキャッシュが効くよう定型部分として先頭に置く (prompt_templates を参照)
+# json_schema を渡すと、各プロバイダーの構造化出力モードでそのスキーマに沿ったJSONを出力させる
+
+def _gemini_generation_config(json_schema: Optional[dict]) -> Optional[dict]:
+    if json_schema is None:
+        return None
+    return {"response_mime_type": "application/json", "response_schema": review_json.gemini_schema(json_schema)}
+
+def _openai_response_format(json_schema: Optional[dict]) -> Dict[str, Any]:
+    if json_schema is None:
+        return {}
+    return {"response_format": {"type": "json_schema", "json_schema": {"name": "code_review", "schema": json_schema, "strict": True}}}
+
+async def _call_gemini(prompt: str, model_name: str = 'gemini-1.5-flash-latest', system: Optional[str] = None, json_schema: Optional[dict] = None) -> str:
     print(f"--- DEBUG: Calling Gemini model: {model_name} ---")
-    model = genai.GenerativeModel(model_name)
-    response = await asyncio.to_thread(model.generate_content, prompt)
+    # 定型部分はシステム指示として渡し、Geminiの暗黙的なキャッシュの対象にする
+    model = _get_gemini_model(model_name, system)
+    generation_config = _gemini_generation_config(json_schema)
+    # スレッドプールを占有しないよう、SDKのネイティブな非同期APIを使う
+    response = await concurrency_limiter.run("gemini", model_name, lambda: model.generate_content_async(prompt, generation_config=generation_config))
+    prompt_templates.record_usage("gemini", model_name, getattr(response, "usage_metadata", None))
     return response.text
 
-async def _call_gpt(prompt: str, model_name: str = 'gpt-4o') -> str:
+async def _call_gpt(prompt: str, model_name: str = 'gpt-4o', system: Optional[str] = None, json_schema: Optional[dict] = None) -> str:
     print(f"--- DEBUG: Calling OpenAI model: {model_name} ---")
-    response = await openai_client.chat.completions.create(
+    response = await concurrency_limiter.run("openai", model_name, lambda: openai_client.chat.completions.create(
         model=model_name,
-        messages=[{"role": "user", "content": prompt}],
+        messages=prompt_templates.openai_messages(system, prompt),
         temperature=0.1,
-    )
+        **_openai_response_format(json_schema),
+    ))
+    prompt_templates.record_usage("openai", model_name, response.usage)
     return response.choices[0].message.content
 
-async def _call_claude(prompt: str, model_name: str = 'claude-3-5-sonnet-20240620') -> str:
+async def _call_claude(prompt: str, model_name: str = 'claude-3-5-sonnet-20240620', system: Optional[str] = None, json_schema: Optional[dict] = None) -> str:
     print(f"--- DEBUG: Calling Anthropic model: {model_name} ---")
-    response = await claude_client.messages.create(
+    # Anthropicには専用のJSONモードがないため、スキーマを入力に持つツールの呼び出しを強制する
+    tool_options = {}
+    if json_schema is not None:
+        tool_options = {
+            "tools": [{"name": "submit_review", "description": "コードレビューの結果を提出する", "input_schema": json_schema}],
+            "tool_choice": {"type": "tool", "name": "submit_review"},
+        }
+    if system:
+        tool_options["system"] = prompt_templates.anthropic_system(system, tool_options.get("tools"))
+    response = await concurrency_limiter.run("anthropic", model_name, lambda: claude_client.messages.create(
         model=model_name,
         max_tokens=4096,
         messages=[{"role": "user", "content": prompt}],
         temperature=0.1,
-    )
+        **tool_options,
+    ))
+    prompt_templates.record_usage("anthropic", model_name, response.usage)
+    for block in response.content:
+        if block.type == "tool_use":
+            return json.dumps(block.input, ensure_ascii=False)
     return response.content[0].text
 
-# --- 司令塔となるメインのレビュー生成関数 (非同期) ---
+# --- ストリーミング用の内部関数 (生成されたテキスト片を順次返す) ---
+# 途中まで返したテキストは取り消せないため再試行はせず、ストリームの間スロットを確保するだけにする
+
+async def _stream_gemini(prompt: str, model_name: str = 'gemini-1.5-flash-latest', system: Optional[str] = None, json_schema: Optional[dict] = None):
+    print(f"--- DEBUG: Streaming Gemini model: {model_name} ---")
+    model = _get_gemini_model(model_name, system)
+    async with concurrency_limiter.limit("gemini", model_name):
+        response = await model.generate_content_async(prompt, stream=True, generation_config=_gemini_generation_config(json_schema))
+        usage = None
+        async for chunk in response:
+            usage = getattr(chunk, "usage_metadata", None) or usage
+            if chunk.text:
+                yield chunk.text
+        prompt_templates.record_usage("gemini", model_name, usage)
+
+async def _stream_gpt(prompt: str, model_name: str = 'gpt-4o', system: Optional[str] = None, json_schema: Optional[dict] = None):
+    print(f"--- DEBUG: Streaming OpenAI model: {model_name} ---")
+    async with concurrency_limiter.limit("openai", model_name):
+        stream = await openai_client.chat.completions.create(
+            model=model_name,
+            messages=prompt_templates.openai_messages(system, prompt),
+            temperature=0.1,
+            stream=True,
+            # 使用量は最後のチャンクで返される
+            stream_options={"include_usage": True},
+            **_openai_response_format(json_schema),
+        )
+        async for chunk in stream:
+            if chunk.usage is not None:
+                prompt_templates.record_usage("openai", model_name, chunk.usage)
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+async def _stream_claude(prompt: str, model_name: str = 'claude-3-5-sonnet-20240620', system: Optional[str] = None, json_schema: Optional[dict] = None):
+    # ツール呼び出しの入力はテキストとして流れてこないため、ストリーミングではスキーマを使わず、
+    # 崩れた出力は review_json の修復に任せる
+    print(f"--- DEBUG: Streaming Anthropic model: {model_name} ---")
+    async with concurrency_limiter.limit("anthropic", model_name):
+        system_options = {"system": prompt_templates.anthropic_system(system)} if system else {}
+        async with claude_client.messages.stream(
+            model=model_name,
+            max_tokens=4096,
+            messages=[{"role": "user", "content": prompt}],
+            temperature=0.1,
+            **system_options,
+        ) as stream:
+            async for text in stream.text_stream:
+                yield text
+            final_message = await stream.get_final_message()
+        prompt_templates.record_usage("anthropic", model_name, final_message.usage)
+
+_STREAM_FUNCTIONS = {
+    _call_gemini: _stream_gemini,
+    _call_gpt: _stream_gpt,
+    _call_claude: _stream_claude,
+}
+
+# --- 同一レビューの同時実行をまとめるSingle-flight層 ---
+
+_review_flights = review_calls.SingleFlight()
+metrics_service.register("review_singleflight", _review_flights.stats)
+
+# --- モデルごとの応答時間の記録と、ヘッジ（予備リクエスト）の設定 ---
+
+REVIEW_HEDGE_ENABLED = os.getenv("REVIEW_HEDGE_ENABLED", "false").lower() == "true"
+REVIEW_HEDGE_FALLBACK_MODE = os.getenv("REVIEW_HEDGE_FALLBACK_MODE", "fast_check")
+_review_latencies = review_calls.LatencyTracker()
+metrics_service.register("review_latency", lambda: {
+    "hedge_enabled": REVIEW_HEDGE_ENABLED,
+    "hedge_fallback_mode": REVIEW_HEDGE_FALLBACK_MODE,
+    **review_calls.hedge_stats,
+    "models": _review_latencies.stats(),
+})
 
-async def generate_structured_review(files: dict[str, str], linter_results: str, mode: str) -> dict:
-    print(f"--- DEBUG: Entering generate_structured_review with mode: {mode} ---")
+# --- 司令塔となるメインのレビュー生成関数 (非同期) ---
 
+def _select_review_model(mode: str):
     if mode == 'fast_check':
-        model_function = _call_claude
-        model_name = 'claude-3-5-sonnet-20240620'
+        return _call_claude, 'claude-3-5-sonnet-20240620'
     elif mode == 'strict_audit':
-        model_function = _call_gpt
-        model_name = 'gpt-4o'
+        return _call_gpt, 'gpt-4o'
     else: # default is 'balanced'
-        model_function = _call_gemini
-        model_name = 'gemini-flash-latest'
-
-    formatted_code = "".join([f"### ファイル名: {name}\n```\n{content}\n```\n\n" for name, content in files.items()])
-
-    prompt = f"""
-    あなたは経験豊富なソフトウェアエンジニアで、コードレビューの達人です。
-    以下のソースコードファイルをレビューしてください。
+        return _call_gemini, 'gemini-flash-latest'
+
+_ERROR_REVIEW_SUMMARY = "AI review generation failed."
+
+def _build_error_review(model_name: str, error: Exception) -> dict:
+    return {
+        "overall_score": 0, 
+        "summary": _ERROR_REVIEW_SUMMARY,
+        "details": [{
+            "category": "Error", 
+            "file_name": "N/A", 
+            "line_number": 0, 
+            "description": f"An error occurred during the review with {model_name}: {str(error)}",
+            "suggestion": ""
+        }]
+    }
+
+def _is_error_review(review: dict) -> bool:
+    return review.get("summary") == _ERROR_REVIEW_SUMMARY and review.get("overall_score") == 0
+
+def _parse_review_response(raw_response: str) -> dict:
+    # 途中で切れた出力や軽微な崩れは、モデルを呼び直さずにローカルで修復する
+    return review_json.parse_review(raw_response)
+
+def _annotate_patch_suggestion(detail: dict, files: dict[str, str]) -> dict:
+    """差分形式の提案を元のファイルに適用できるか検証し、結果を指摘事項に書き込む。"""
+    detail["suggestion_format"] = "patch"
+    original = files.get(detail.get("file_name"))
+    if original is None and len(files) == 1:
+        original = next(iter(files.values()))
+    suggestion = detail.get("suggestion") or ""
+    detail["patch_valid"] = bool(suggestion) and original is not None and patch_service.is_valid_patch(original, suggestion)
+    return detail
+
+async def _review_with_model(files: dict[str, str], mode: str, suggestion_format: str, model_function, model_name: str, cache_key: str) -> dict:
+    """モデルを呼び出してレビューを取得し、成功した結果をキャッシュに保存する。失敗時は例外を送出する。"""
+    started = time.monotonic()
+    prompt = prompt_templates.build_review_prompt(files, suggestion_format)
+    raw_response = await model_function(prompt.user, model_name, system=prompt.system, json_schema=review_json.REVIEW_JSON_SCHEMA)
+    review = _parse_review_response(raw_response)
+    if suggestion_format == "patch":
+        for detail in review.get("details", []):
+            _annotate_patch_suggestion(detail, files)
+    _review_latencies.record(model_name, time.monotonic() - started)
+    print(f"--- DEBUG: Successfully received response from {model_name}. ---")
+    # エラー時のペイロードや修復した（指摘が欠けている可能性のある）結果はキャッシュしない（次回の再実行で回復できるように）
+    if not review.get("repaired"):
+        await cache_service.set_review(cache_key, review, mode, model_name)
+    return review
+
+async def _review_via_mode(files: dict[str, str], mode: str, suggestion_format: str = "full") -> dict:
+    """キャッシュ → 実行中の同一呼び出し → モデル呼び出し の順でレビューを取得する。失敗時は例外を送出する。"""
+    model_function, model_name = _select_review_model(mode)
+
+    # 同じコードが再送された場合は、LLMを呼び出さずにキャッシュから返す
+    cache_key = cache_service.make_review_key(files, mode, model_name, prompt_templates.review_prompt_version(suggestion_format))
+    cached_review = await cache_service.get_review(cache_key)
+    if cached_review is not None:
+        print(f"--- DEBUG: Review cache hit for {model_name}. ---")
+        return cached_review
+
+    review = await _review_flights.do(
+        cache_key,
+        lambda: _review_with_model(files, mode, suggestion_format, model_function, model_name, cache_key),
+    )
+    # 同じ結果を複数の呼び出し元で共有するため、それぞれに独立したコピーを返す
+    return copy.deepcopy(review)
 
-    レビュー結果は、必ず以下のルールに従った有効なJSON形式で出力してください。
-    
-    【JSON出力ルール】
-    - ルートオブジェクトは "overall_score", "summary", "details" という3つのキーを持つこと。
-    - "overall_score": コード全体の健全性を0から100の整数で評価したスコア。
-    - "summary": レビュー結果全体の短い要約（日本語で2文程度）。
-    - "details": 指摘事項の配列。指摘がない場合は空の配列 [] とすること。
-    - 配列の各要素は、"category", "file_name", "line_number", "description", "suggestion" の5つのキーを持つオブジェクトであること。
-    - "category": 指摘のカテゴリ。必ず "Bug", "Security", "Performance", "Quality", "Readability", "Style" のいずれかから選択すること。
-    - "file_name": 指摘対象のファイル名。
-    - "line_number": 指摘対象のおおよその行番号（整数）。
-    - "description": 指摘内容の詳細な解説（日本語）。
-    - "suggestion": 提案を適用した後の、**ファイル全体の完全なコード**をコードブロックで出力すること。元のコードから変更がない場合でも、必ずファイル全体のコードを出力すること。
-
-    --- ソースコード ---
-    {formatted_code}
-    --------------------
+async def _hedged_review(files: dict[str, str], mode: str, suggestion_format: str = "full") -> tuple[dict, str]:
     """
-    
+    主モデルが予算時間内に応答しなければフォールバックモデルにも同じレビューを依頼し、
+    先に成功した方の結果を採用する。負けた方の呼び出しはキャンセルする。
+    """
+    _, primary_model = _select_review_model(mode)
+    _, fallback_model = _select_review_model(REVIEW_HEDGE_FALLBACK_MODE)
+    return await review_calls.hedge(
+        primary_model, lambda: _review_via_mode(files, mode, suggestion_format),
+        fallback_model, lambda: _review_via_mode(files, REVIEW_HEDGE_FALLBACK_MODE, suggestion_format),
+        _review_latencies.budget(primary_model),
+    )
+
+async def _generate_review(files: dict[str, str], mode: str, hedge: bool, suggestion_format: str) -> dict:
+    """1回のモデル呼び出しでレビューを生成する。失敗時はエラー時のペイロードを返す。"""
+    _, model_name = _select_review_model(mode)
     try:
-        raw_response = await model_function(prompt, model_name)
-        json_start = raw_response.find('{')
-        json_end = raw_response.rfind('}') + 1
-        if json_start == -1 or json_end == 0:
-            raise json.JSONDecodeError("No JSON object found in the response", raw_response, 0)
-        
-        json_text = raw_response[json_start:json_end]
-        print(f"--- DEBUG: Successfully received response from {model_name}. ---")
-        return json.loads(json_text)
+        if hedge and mode != REVIEW_HEDGE_FALLBACK_MODE:
+            review, responding_model = await _hedged_review(files, mode, suggestion_format)
+        else:
+            review, responding_model = await _review_via_mode(files, mode, suggestion_format), model_name
+        # 実際に応答したモデルを記録する（ヘッジでフォールバックが勝った場合は依頼先と異なる）
+        review["responding_model"] = responding_model
+        return review
     except Exception as e:
         print(f"--- DEBUG: An error occurred while generating AI review with {model_name}: {e} ---")
-        error_payload = {
-            "overall_score": 0, 
-            "summary": "AI review generation failed.",
-            "details": [{
-                "category": "Error", 
-                "file_name": "N/A", 
-                "line_number": 0, 
-                "description": f"An error occurred during the review with {model_name}: {str(e)}",
-                "suggestion": ""
-            }]
-        }
-        return error_payload
-
-# --- テストコード生成用の新しい関数 (多言語対応に修正) ---
-
-async def generate_test_code(original_code: str, revised_code: str, language: str) -> str:
-
-    print(f"--- DEBUG: Entering generate_test_code for language: {language} ---")
-
-
-
-    is_ts_js = language.lower() in ["javascript", "typescript"]
-
-    test_framework = "Jest" if is_ts_js else "pytest"
-
-    prompt = ""
-
-
-
-    # 言語に応じてプロンプトを動的に切り替える
-
-    if is_ts_js:
-
-        prompt = f"""
-
-あなたは、コードの変更点を正確に検証するテストを作成する、熟練したTypeScript/Jestテストエンジニアです。
-
-提供された「修正済みのコード」が正しく動作することを証明するためのユニットテストを、Jestフレームワークを使用して生成してください。
-
-
-
-【実行環境に関する非常に重要なルール】
-
-- 「修正済みのコード」は `main.ts` というファイルに保存されます。
-
-- あなたがこれから生成するテストコードは `main.test.ts` という別のファイルに保存されます。
-
-- そのため、テスト対象の関数やクラスを `main.ts` から **必ずインポートする必要があります**。
-
-- 例: `import {{ functionNameToTest }} from './main';`
-
-
-
-【テストコード生成ルール】
-
-1. テストフレームワークは「Jest」を使用してください。
-
-2. `main.ts` から必要な要素をインポートする `import` 文を必ず記述してください。
-
-3. 「修正済みのコード」が「元のコード」のバグを修正していることを検証する、具体的で有用なアサーションを記述してください。
-
-4. 出力には、テストコード本体（`import`文やテスト関数・クラス）のみを含めてください。他の説明やMarkdownの囲い(```)は絶対に含めないでください。
-
-
-
----
-
-【元のコード（参考情報）】
-
-```typescript
-
-{original_code}
-
-```
-
----
-
-【修正済みのコード（main.tsの内容）】
-
-```typescript
-
-{revised_code}
-
-```
-
----
-
-上記のルールに厳密に従い、import文を含む完全なテストコードを生成してください。
-
-"""
-
-    else:  # Pythonの場合
-
-        prompt = f"""
-
-あなたは、コードの変更点を正確に検証するテストを作成する、熟練したPython/pytestテストエンジニアです。
-
-提供された「修正済みのコード」が正しく動作することを証明するためのユニットテストを、pytestフレームワークを使用して生成してください。
-
-
-
-【実行環境に関する非常に重要なルール】
-
-あなたが生成するテストコードは、「修正済みのコード」と同じファイル、同じスコープに配置されてから実行されます。
-
-そのため、テスト対象の関数やクラスをインポートする必要は一切ありません。そのまま直接呼び出してください。
-
-
-
-【テストコード生成ルール】
-
-- テストフレームワークは「pytest」を使用してください。
-
-- 「修正済みのコード」が「元のコード」のバグを修正していることを検証する、具体的で有用なアサーションを記述してください。
-
-- 出力には、テストコード本体（import文やテスト関数・クラス）のみを含めてください。他の説明やMarkdownの囲い(```)は絶対に含めないでください。
+        return _build_error_review(model_name, e)
 
+async def _map_reduce_review(files: dict[str, str], mode: str, hedge: bool, suggestion_format: str = "full") -> dict:
+    """
+    大きな入力をトークン予算内のチャンクに分けて並行にレビューし、1つのレビューに統合する。
+    同時実行数はプロバイダーごとのリミッターで制御される。
+    """
+    chunks = review_planner.plan_chunks(files)
+    print(f"--- DEBUG: Input exceeds the token budget. Reviewing {len(chunks)} chunks in parallel. ---")
+    # チャンク単位ではファイル全体のコードを提案できないため、差分形式で受け取って行番号を戻す
+    reviews = await asyncio.gather(*[
+        _generate_review(chunk.files(), mode, hedge, "patch") for chunk in chunks
+    ])
+    failed = [_is_error_review(review) for review in reviews]
+    if all(failed):
+        return reviews[0]
+
+    merged = review_planner.merge_chunk_reviews(chunks, reviews, failed)
+    if suggestion_format == "full":
+        # 元のファイル基準に戻した差分を、ファイル全体のコードの提案に展開する
+        merged["details"] = [
+            _materialize_full_suggestion(detail, files[detail["file_name"]]) if detail.get("file_name") in files else detail
+            for detail in merged["details"]
+        ]
+    responding_models = sorted({review["responding_model"] for review, chunk_failed in zip(reviews, failed) if not chunk_failed})
+    merged["responding_model"] = ", ".join(responding_models)
+    return merged
+
+async def generate_structured_review(files: dict[str, str], linter_results: str, mode: str, hedge: Optional[bool] = None, suggestion_format: str = "full") -> dict:
+    print(f"--- DEBUG: Entering generate_structured_review with mode: {mode} ---")
 
+    if suggestion_format not in SUGGESTION_FORMATS:
+        suggestion_format = "full"
+    if hedge is None:
+        hedge = REVIEW_HEDGE_ENABLED
 
-【元のコード（参考情報）】
+    if review_planner.needs_chunking(files):
+        return await _map_reduce_review(files, mode, hedge, suggestion_format)
+    return await _generate_review(files, mode, hedge, suggestion_format)
 
-```Python
+def _materialize_full_suggestion(detail: dict, code: str) -> dict:
+    """差分形式で受け取った提案を、ファイル全体のコードの提案に変換する（適用できなければ空にする）。"""
+    patch = detail.get("suggestion") or ""
+    try:
+        detail["suggestion"] = patch_service.apply_patch(code, patch) if patch else ""
+    except patch_service.PatchError:
+        detail["suggestion"] = ""
+    detail.pop("suggestion_format", None)
+    detail.pop("patch_valid", None)
+    return detail
+
+async def generate_incremental_review(previous_code: str, previous_review: dict, code: str, file_name: str, mode: str,
+                                      hedge: Optional[bool] = None, suggestion_format: str = "full") -> dict:
+    """
+    前回レビューしたコードとの差分だけをモデルに送り、前回の指摘のうち変更の影響を受けないものは
+    行番号を付け替えて引き継ぐ。変更が大きい場合や前回のレビューが失敗している場合は全体をレビューする。
+    """
+    print(f"--- DEBUG: Entering generate_incremental_review with mode: {mode} ---")
+
+    if suggestion_format not in SUGGESTION_FORMATS:
+        suggestion_format = "full"
+    if hedge is None:
+        hedge = REVIEW_HEDGE_ENABLED
+
+    diff = incremental_review.diff_code(previous_code, code)
+    if _is_error_review(previous_review) or diff.change_ratio > incremental_review.REVIEW_INCREMENTAL_MAX_CHANGE_RATIO:
+        return await generate_structured_review({file_name: code}, "", mode, hedge=hedge, suggestion_format=suggestion_format)
+
+    if not diff.has_changes:
+        review = copy.deepcopy(previous_review)
+        review["incremental"] = {"reviewed_ranges": [], "new_findings": 0, "carried_forward": len(review.get("details", []))}
+        return review
+
+    windows = incremental_review.review_windows(diff)
+    chunk = incremental_review.build_chunk(file_name, diff, windows)
+    print(f"--- DEBUG: Re-reviewing {len(windows)} changed ranges of {file_name}: {windows} ---")
+    chunk_review = await _generate_review(chunk.files(), mode, hedge, "patch")
+    if _is_error_review(chunk_review):
+        return chunk_review
+
+    merged = review_planner.merge_chunk_reviews([chunk], [chunk_review], [False])
+    new_details = merged["details"]
+    if suggestion_format == "full":
+        new_details = [_materialize_full_suggestion(detail, code) for detail in new_details]
+    carried = incremental_review.carry_forward_details(previous_review.get("details", []), diff, windows, previous_code, code)
+    # 前回と今回で提案の形式が異なる場合は、引き継いだ提案を今回の形式に揃える
+    for detail in carried:
+        if suggestion_format == "full" and detail.get("suggestion_format") == "patch":
+            _materialize_full_suggestion(detail, code)
+        elif suggestion_format == "patch" and detail.get("suggestion_format") != "patch" and detail.get("suggestion"):
+            revised = patch_service.strip_code_fence(detail["suggestion"])
+            detail["suggestion"] = "\n".join(difflib.unified_diff(code.split("\n"), revised.split("\n"), lineterm=""))
+            _annotate_patch_suggestion(detail, {file_name: code})
+
+    # スコアは、今回レビューした行と引き継いだ行の数で重み付けして合成する
+    reviewed_lines = sum(end - start + 1 for start, end in windows)
+    unchanged_lines = max(len(diff.new_lines) - reviewed_lines, 0)
+    try:
+        previous_score = float(previous_review.get("overall_score", 0))
+    except (TypeError, ValueError):
+        previous_score = 0.0
+    score = (merged["overall_score"] * reviewed_lines + previous_score * unchanged_lines) / max(reviewed_lines + unchanged_lines, 1)
+
+    return {
+        "overall_score": round(score),
+        "summary": merged["summary"],
+        "details": sorted(new_details + carried, key=lambda d: d.get("line_number") or 0),
+        "responding_model": chunk_review.get("responding_model"),
+        "incremental": {
+            "reviewed_ranges": windows,
+            "new_findings": len(new_details),
+            "carried_forward": len(carried),
+        },
+    }
+
+async def stream_structured_review(files: dict[str, str], linter_results: str, mode: str, suggestion_format: str = "full"):
+    """
+    generate_structured_review のストリーミング版。
+    指摘事項が1件完成するたびに ("issue", detail) を返し、最後に ("review", レビュー全体) を返す。
+    失敗した場合は、最後の ("review", ...) がエラー時のペイロードになる。
+    """
+    print(f"--- DEBUG: Entering stream_structured_review with mode: {mode} ---")
 
-{original_code}
+    if suggestion_format not in SUGGESTION_FORMATS:
+        suggestion_format = "full"
 
-```
+    model_function, model_name = _select_review_model(mode)
 
----
+    cache_key = cache_service.make_review_key(files, mode, model_name, prompt_templates.review_prompt_version(suggestion_format))
+    cached_review = await cache_service.get_review(cache_key)
+    if cached_review is not None:
+        print(f"--- DEBUG: Review cache hit for {model_name}. ---")
+        for detail in cached_review.get("details", []):
+            yield "issue", detail
+        cached_review["responding_model"] = model_name
+        yield "review", cached_review
+        return
 
-【修正済みのコード（テスト対象）】
+    parser = IncrementalReviewParser()
+    try:
+        prompt = prompt_templates.build_review_prompt(files, suggestion_format)
+        stream = _STREAM_FUNCTIONS[model_function](prompt.user, model_name, system=prompt.system, json_schema=review_json.REVIEW_JSON_SCHEMA)
+        async for text in stream:
+            for detail in parser.feed(text):
+                if suggestion_format == "patch":
+                    _annotate_patch_suggestion(detail, files)
+                yield "issue", copy.deepcopy(detail)
+
+        review = _parse_review_response(parser.buffer)
+        if suggestion_format == "patch":
+            for detail in review.get("details", []):
+                _annotate_patch_suggestion(detail, files)
+        print(f"--- DEBUG: Successfully streamed response from {model_name}. ---")
+        if not review.get("repaired"):
+            await cache_service.set_review(cache_key, review, mode, model_name)
+        review["responding_model"] = model_name
+        yield "review", review
+    except Exception as e:
+        print(f"--- DEBUG: An error occurred while streaming AI review with {model_name}: {e} ---")
+        yield "review", _build_error_review(model_name, e)
 
-```python
+# --- テストコード生成用の新しい関数 (多言語対応に修正) ---
 
-{revised_code}
+async def generate_test_code(original_code: str, revised_code: str, language: str) -> str:
 
-```
+    print(f"--- DEBUG: Entering generate_test_code for language: {language} ---")
 
----
 
-上記のルールに厳密に従い、テスト対象のインポート文は含めずに、テストコードを生成してください。
 
-"""
+    # 言語に応じた定型部分と、コードを含む可変部分に分けて組み立てる
+    prompt = prompt_templates.build_test_prompt(original_code, revised_code, language)
 
 
 
@@ -259,7 +505,7 @@ async def generate_test_code(original_code: str, revised_code: str, language: st
 
         # テストコード生成は最も高性能なモデルで行うのが望ましい
 
-        raw_response = await _call_gpt(prompt)
+        raw_response = await _call_gpt(prompt.user, system=prompt.system)
 
         print("--- DEBUG: Successfully received test code from GPT-4o. ---")
 
@@ -287,19 +533,28 @@ async def generate_test_code(original_code: str, revised_code: str, language: st
 
 
 
-async def continue_conversation(db: Session, project_id: int, chat_history: List[Dict[str, str]]) -> str:
+async def summarize_conversation(previous_summary: Optional[str], messages: List[Dict[str, str]], max_tokens: int,
+                                 model_name: str = 'gemini-flash-latest') -> str:
+    """これまでの要約と、その後の会話を統合した新しい要約を生成する。"""
+    prompt = prompt_templates.build_summary_prompt(previous_summary, messages, max_tokens)
+    summary = await _call_gemini(prompt.user, model_name, system=prompt.system)
+    return summary.strip()
+
+
+async def continue_conversation(db: AsyncSession, project_id: int, chat_history: List[Dict[str, str]], summary: Optional[str] = None) -> str:
     """
     既存の会話履歴と、過去の関連する記憶に基づき、AIとの対話を継続する。
+    summary を渡した場合、chat_history には要約に含まれていない直近のメッセージだけを渡せばよい。
     """
     print("--- DEBUG: Entering continue_conversation ---")
 
     # 最後のメッセージがユーザーの現在の質問
     user_question = chat_history[-1].get('content', '')
-    # 関連する過去の記憶をデータベースから検索
-    relevant_memories = memory_service.find_relevant_memories(
+    # 関連する過去の記憶をデータベースから検索（語句検索とベクトル検索を並行して実行し、イベントループはブロックしない）
+    relevant_memories = await memory_service.retrieve_relevant_memories(
         db=db,
         project_id=project_id,
-        user_question=user_question
+        user_question=user_question,
     )
 
     # 会話の文脈をAIに理解させるためのシステムプロンプト
@@ -311,6 +566,9 @@ async def continue_conversation(db: Session, project_id: int, chat_history: List
     ユーザーは以前の会話の続きとして質問しています。あなたは以下の【参考情報】で示された過去のやり取りを完全に理解し、その文脈を**必ず**引き継いで回答してください。
     あたかも、ついさっきまで話していたかのように、自然な会話を継続してください。
 
+    【参考情報：これまでの会話の要約】
+    {summary or "（なし）"}
+
     【参考情報：過去の関連する会話】
     {relevant_memories}
     【参考情報ここまで】
@@ -331,7 +589,8 @@ async def continue_conversation(db: Session, project_id: int, chat_history: List
     messages_for_api.insert(1, {'role': 'model', 'parts': ["はい、承知いたしました。追加の質問について、参考情報も踏まえて回答します。"]})
 
     try:
-        model = genai.GenerativeModel('gemini-flash-latest')
+        chat_model_name = 'gemini-flash-latest'
+        model = _get_gemini_model(chat_model_name)
         
         last_user_message_parts = messages_for_api.pop().get('parts', [''])
         last_user_message = last_user_message_parts[0] if last_user_message_parts else ''
@@ -339,7 +598,7 @@ async def continue_conversation(db: Session, project_id: int, chat_history: List
         chat = model.start_chat(history=messages_for_api)
         
         print(f"--- DEBUG: Calling Gemini with history. Last question: {last_user_message[:100]}... ---")
-        response = await chat.send_message_async(last_user_message)
+        response = await concurrency_limiter.run("gemini", chat_model_name, lambda: chat.send_message_async(last_user_message))
         
         print("--- DEBUG: Successfully received response from Gemini in conversation. ---")
         return response.text
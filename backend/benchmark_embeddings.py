@@ -0,0 +1,158 @@
+# backend/benchmark_embeddings.py
+"""
+ベクトル化のバックエンド（PyTorch版 / ONNX int8版）を比較するベンチマーク。
+
+    python benchmark_embeddings.py [--backends torch,onnx] [--texts 200] [--repeat 3]
+
+メモリ使用量を公平に測るため、バックエンドごとに別プロセスで読み込み、
+- モデルの読み込み時間と読み込み後のRSS（最大常駐メモリ）
+- 1件ずつのベクトル化のレイテンシ（p50/p95）とバッチでのスループット
+- 最初のバックエンドとのベクトルのコサイン類似度と、検索結果（上位k件）の一致率
+を表示します。テキストにはこのディレクトリのソースコードを、メッセージの索引と同じ大きさ（EMBEDDING_CHUNK_TOKENS）に区切ったものを使います。
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import subprocess
+import tempfile
+
+from review_planner import split_text
+
+MODEL_NAME = "all-MiniLM-L6-v2"
+# memory_service と同じ既定値（memory_service を import するとモデルを読み込んでしまうため、ここで読む）
+EMBEDDING_CHUNK_TOKENS = int(os.getenv("EMBEDDING_CHUNK_TOKENS", "160"))
+
+
+def _rss_mb() -> float:
+    # Linuxでは ru_maxrss はKB単位
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _load_corpus(limit: int) -> list:
+    texts = []
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for file_name in sorted(os.listdir(directory)):
+        if not file_name.endswith(".py"):
+            continue
+        with open(os.path.join(directory, file_name), encoding="utf-8") as f:
+            for part in split_text(f.read(), EMBEDDING_CHUNK_TOKENS):
+                text = part.content.strip()
+                if len(text) > 40:
+                    texts.append(text)
+    return texts[:limit]
+
+
+def _percentile(values: list, q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+
+
+def run_worker(backend_name: str, texts: list, repeat: int, output_path: str) -> None:
+    """1つのバックエンドを読み込んで測定し、結果とベクトルをJSONで書き出す（別プロセスで実行される）。"""
+    import embedding_backends
+
+    rss_before = _rss_mb()
+    started = time.perf_counter()
+    backend = embedding_backends.load_backend(MODEL_NAME, backend_name)
+    load_seconds = time.perf_counter() - started
+    backend.encode(texts[:4])  # 初回呼び出しの準備コストを除く
+
+    single_latencies = []
+    for _ in range(repeat):
+        for text in texts:
+            started = time.perf_counter()
+            backend.encode([text])
+            single_latencies.append(time.perf_counter() - started)
+
+    batch_seconds = []
+    vectors = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        vectors = [vector for i in range(0, len(texts), 32) for vector in backend.encode(texts[i:i + 32])]
+        batch_seconds.append(time.perf_counter() - started)
+
+    with open(output_path, "w") as f:
+        json.dump({
+            "backend": backend.name,
+            "load_seconds": load_seconds,
+            "rss_mb": _rss_mb(),
+            "rss_model_mb": _rss_mb() - rss_before,
+            "single_p50_ms": _percentile(single_latencies, 0.5) * 1000,
+            "single_p95_ms": _percentile(single_latencies, 0.95) * 1000,
+            "batch_texts_per_second": len(texts) / min(batch_seconds),
+            "dimensions": len(vectors[0]),
+            "vectors": vectors,
+        }, f)
+
+
+def _cosine(a: list, b: list) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = (sum(x * x for x in a) ** 0.5) * (sum(y * y for y in b) ** 0.5)
+    return dot / norm if norm else 0.0
+
+
+def _top_k(vectors: list, query: int, k: int) -> set:
+    scores = [(_cosine(vectors[query], vector), i) for i, vector in enumerate(vectors) if i != query]
+    return {i for _, i in sorted(scores, reverse=True)[:k]}
+
+
+def compare(reference: dict, candidate: dict, k: int, queries: int) -> dict:
+    similarities = [_cosine(a, b) for a, b in zip(reference["vectors"], candidate["vectors"])]
+    query_ids = range(min(queries, len(reference["vectors"])))
+    overlaps = [
+        len(_top_k(reference["vectors"], q, k) & _top_k(candidate["vectors"], q, k)) / k
+        for q in query_ids
+    ]
+    return {
+        "cosine_mean": sum(similarities) / len(similarities),
+        "cosine_min": min(similarities),
+        f"top{k}_agreement": sum(overlaps) / len(overlaps),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare embedding backends.")
+    parser.add_argument("--backends", default="torch,onnx")
+    parser.add_argument("--texts", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    parser.add_argument("--output", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    texts = _load_corpus(args.texts)
+    if args.worker:
+        run_worker(args.worker, texts, args.repeat, args.output)
+        return
+
+    print(f"Benchmarking {MODEL_NAME} on {len(texts)} code snippets (repeat={args.repeat})")
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for backend_name in args.backends.split(","):
+            output = os.path.join(tmp, f"{backend_name}.json")
+            subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--worker", backend_name, "--output", output,
+                 "--texts", str(args.texts), "--repeat", str(args.repeat)],
+                check=True,
+            )
+            with open(output) as f:
+                results.append(json.load(f))
+
+    print(f"\n{'backend':<32}{'load s':>8}{'RSS MB':>9}{'model MB':>10}{'p50 ms':>9}{'p95 ms':>9}{'texts/s':>9}{'dims':>6}")
+    for result in results:
+        print(f"{result['backend']:<32}{result['load_seconds']:>8.2f}{result['rss_mb']:>9.0f}{result['rss_model_mb']:>10.0f}"
+              f"{result['single_p50_ms']:>9.2f}{result['single_p95_ms']:>9.2f}{result['batch_texts_per_second']:>9.1f}{result['dimensions']:>6}")
+
+    reference = results[0]
+    for candidate in results[1:]:
+        agreement = compare(reference, candidate, args.top_k, args.queries)
+        print(f"\n{candidate['backend']} vs {reference['backend']}: "
+              + ", ".join(f"{name}={value:.4f}" for name, value in agreement.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+# backend/benchmark_vector_search.py
+"""
+ベクトル検索の近似インデックス（HNSW / IVFFlat）の、件数ごとのレイテンシと再現率を測るベンチマーク。
+
+    python benchmark_vector_search.py [--rows 100000,300000,1000000] [--index hnsw] [--ef-search 10,20,40,80,160]
+
+DATABASE_URL のデータベースに専用のテーブル（bench_message_vectors）を作り、
+- 本番の検索と同じ「project_id で絞り込んでコサイン距離の近い順に上位k件」のクエリを
+- 全件走査（正解）と、ef_search / probes を変えた近似検索で実行し
+レイテンシ（p50/p95）と、正解に対する再現率（recall@k）を表示します。
+ベクトルは実際の埋め込みに近くなるよう、クラスタに偏らせた正規化済みの乱数で生成します。
+件数は小さい順に追加していくため、1回の実行で複数の件数を測れます。終了時にテーブルは削除します（--keep で残す）。
+"""
+import io
+import time
+import random
+import argparse
+
+import numpy as np
+from sqlalchemy import text
+
+import vector_index
+from database import engine
+
+TABLE = "bench_message_vectors"
+DIMENSIONS = 384
+
+
+def _percentile(values: list, q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+
+
+def _vector_literal(vector) -> str:
+    return "[" + ",".join(f"{value:.6f}" for value in vector) + "]"
+
+
+class _Generator:
+    """クラスタの中心の周りにばらつかせたベクトルを作る（プロジェクトごとに話題が偏る実データを模す）。"""
+
+    def __init__(self, clusters: int, seed: int):
+        self.rng = np.random.default_rng(seed)
+        self.centers = self._normalize(self.rng.standard_normal((clusters, DIMENSIONS)))
+
+    @staticmethod
+    def _normalize(vectors):
+        return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    def vectors(self, count: int, spread: float = 0.6):
+        centers = self.centers[self.rng.integers(0, len(self.centers), count)]
+        return self._normalize(centers + spread * self.rng.standard_normal((count, DIMENSIONS)) / np.sqrt(DIMENSIONS)).astype(np.float32)
+
+
+def _create_table(conn) -> None:
+    conn.execute(text("CREATE EXTENSION IF NOT EXISTS vector"))
+    conn.execute(text(f"DROP TABLE IF EXISTS {TABLE}"))
+    conn.execute(text(f"CREATE TABLE {TABLE} (id bigserial PRIMARY KEY, project_id integer NOT NULL, embedding vector({DIMENSIONS}) NOT NULL)"))
+    conn.execute(text(f"CREATE INDEX ix_{TABLE}_project_id ON {TABLE} (project_id)"))
+
+
+def _insert(generator: _Generator, count: int, projects: int, batch: int = 20000) -> None:
+    """COPY でまとめて投入する（INSERT を1行ずつ送ると100万件では時間がかかりすぎるため）。"""
+    raw = engine.raw_connection()
+    try:
+        cursor = raw.cursor()
+        for offset in range(0, count, batch):
+            size = min(batch, count - offset)
+            buffer = io.StringIO()
+            for vector in generator.vectors(size):
+                buffer.write(f"{random.randint(1, projects)}\t{_vector_literal(vector)}\n")
+            buffer.seek(0)
+            cursor.copy_expert(f"COPY {TABLE} (project_id, embedding) FROM STDIN", buffer)
+        raw.commit()
+    finally:
+        raw.close()
+
+
+def _build_index(conn, index_type: str, rows: int) -> float:
+    name = f"ix_{TABLE}_embedding"
+    conn.execute(text(f"DROP INDEX IF EXISTS {name}"))
+    if index_type == "hnsw":
+        options = f"m = {vector_index.VECTOR_HNSW_M}, ef_construction = {vector_index.VECTOR_HNSW_EF_CONSTRUCTION}"
+    else:
+        # IVFFlat のリスト数は件数に合わせる（pgvector の推奨値）
+        options = f"lists = {max(rows // 1000, 10) if rows <= 1_000_000 else int(rows ** 0.5)}"
+    if vector_index.VECTOR_INDEX_MAINTENANCE_WORK_MEM:
+        conn.execute(text("SELECT set_config('maintenance_work_mem', :value, false)"),
+                     {"value": vector_index.VECTOR_INDEX_MAINTENANCE_WORK_MEM})
+    started = time.perf_counter()
+    conn.execute(text(f"CREATE INDEX {name} ON {TABLE} USING {index_type} (embedding vector_cosine_ops) WITH ({options})"))
+    conn.execute(text(f"ANALYZE {TABLE}"))
+    return time.perf_counter() - started
+
+
+def _search(conn, query: str, project_id: int, k: int, settings: dict) -> tuple:
+    """1回の検索を専用のトランザクションで実行し、(経過秒数, 結果のIDの集合) を返す。"""
+    with conn.begin():
+        for name, value in settings.items():
+            conn.execute(text("SELECT set_config(:name, :value, true)"), {"name": name, "value": str(value)})
+        started = time.perf_counter()
+        ids = conn.execute(text(
+            f"SELECT id FROM {TABLE} WHERE project_id = :project_id "
+            f"ORDER BY embedding <=> CAST(:query AS vector) LIMIT :k"
+        ), {"project_id": project_id, "query": query, "k": k}).scalars().all()
+        return time.perf_counter() - started, set(ids)
+
+
+def _measure(conn, queries: list, k: int, settings: dict, truth: list = None) -> dict:
+    latencies, recalls, results = [], [], []
+    for index, (project_id, query) in enumerate(queries):
+        seconds, ids = _search(conn, query, project_id, k, settings)
+        latencies.append(seconds)
+        results.append(ids)
+        if truth is not None and truth[index]:
+            recalls.append(len(ids & truth[index]) / len(truth[index]))
+    return {
+        "p50_ms": _percentile(latencies, 0.5) * 1000,
+        "p95_ms": _percentile(latencies, 0.95) * 1000,
+        "recall": sum(recalls) / len(recalls) if recalls else 1.0,
+        "results": results,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Measure latency vs. recall of the pgvector ANN index.")
+    parser.add_argument("--rows", default="100000,300000,1000000", help="comma separated table sizes")
+    parser.add_argument("--projects", type=int, default=50, help="number of projects the rows are spread over")
+    parser.add_argument("--clusters", type=int, default=200)
+    parser.add_argument("--index", default=vector_index.VECTOR_INDEX_TYPE, choices=vector_index.INDEX_TYPES)
+    parser.add_argument("--ef-search", default="10,20,40,80,160,320")
+    parser.add_argument("--probes", default="1,5,10,20,40")
+    parser.add_argument("--iterative-scan", default=vector_index.VECTOR_SEARCH_ITERATIVE_SCAN,
+                        help="relaxed_order / strict_order (pgvector 0.8+)")
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--keep", action="store_true", help="keep the benchmark table")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    generator = _Generator(args.clusters, args.seed)
+    sizes = sorted(int(size) for size in args.rows.split(","))
+    if args.index == "hnsw":
+        sweep = [("ef_search", int(value), {"hnsw.ef_search": int(value)}) for value in args.ef_search.split(",")]
+    else:
+        sweep = [("probes", int(value), {"ivfflat.probes": int(value)}) for value in args.probes.split(",")]
+    if args.iterative_scan:
+        for _, _, settings in sweep:
+            settings[f"{args.index}.iterative_scan"] = args.iterative_scan
+
+    print(f"Benchmarking {args.index} on {TABLE}: sizes={sizes}, projects={args.projects}, k={args.top_k}, queries={args.queries}")
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        _create_table(conn)
+    try:
+        current = 0
+        for size in sizes:
+            _insert(generator, size - current, args.projects)
+            current = size
+            with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+                build_seconds = _build_index(conn, args.index, size)
+                index_mb = conn.execute(text(f"SELECT pg_relation_size('ix_{TABLE}_embedding') / 1048576.0")).scalar()
+            queries = [(random.randint(1, args.projects), _vector_literal(vector)) for vector in generator.vectors(args.queries)]
+
+            with engine.connect() as conn:
+                # 正解は近似インデックスを使わない全件走査で求める
+                exact = _measure(conn, queries, args.top_k, {"enable_indexscan": "off"})
+                print(f"\n{size:,} rows ({size // args.projects:,}/project): index built in {build_seconds:.1f}s, {float(index_mb):.0f} MB")
+                print(f"{'setting':<16}{'p50 ms':>10}{'p95 ms':>10}{'recall@' + str(args.top_k):>12}")
+                print(f"{'exact scan':<16}{exact['p50_ms']:>10.2f}{exact['p95_ms']:>10.2f}{1.0:>12.3f}")
+                for label, value, settings in sweep:
+                    result = _measure(conn, queries, args.top_k, settings, truth=exact["results"])
+                    print(f"{label + '=' + str(value):<16}{result['p50_ms']:>10.2f}{result['p95_ms']:>10.2f}{result['recall']:>12.3f}")
+    finally:
+        if not args.keep:
+            with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+                conn.execute(text(f"DROP TABLE IF EXISTS {TABLE}"))
+
+
+if __name__ == "__main__":
+    main()
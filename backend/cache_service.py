@@ -0,0 +1,389 @@
+# backend/cache_service.py
+
+import os
+import json
+import time
+import hashlib
+import asyncio
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, List, Optional
+
+import models
+import metrics_service
+from database import SessionLocal
+
+# --- 設定値（環境変数で上書き可能） ---
+REVIEW_CACHE_MAX_ENTRIES = int(os.getenv("REVIEW_CACHE_MAX_ENTRIES", "512"))
+REVIEW_CACHE_TTL_SECONDS = int(os.getenv("REVIEW_CACHE_TTL_SECONDS", str(7 * 24 * 60 * 60)))
+REVIEW_CACHE_PERSISTENT = os.getenv("REVIEW_CACHE_PERSISTENT", "true").lower() == "true"
+REVIEW_CACHE_MAX_ROWS = int(os.getenv("REVIEW_CACHE_MAX_ROWS", "10000"))
+# 何回の書き込みごとに永続層の掃除（期限切れ削除・上限超過分の削除）を行うか
+REVIEW_CACHE_SWEEP_INTERVAL = int(os.getenv("REVIEW_CACHE_SWEEP_INTERVAL", "100"))
+
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "4096"))
+EMBEDDING_CACHE_PERSISTENT = os.getenv("EMBEDDING_CACHE_PERSISTENT", "false").lower() == "true"
+EMBEDDING_CACHE_MAX_ROWS = int(os.getenv("EMBEDDING_CACHE_MAX_ROWS", "100000"))
+EMBEDDING_CACHE_SWEEP_INTERVAL = int(os.getenv("EMBEDDING_CACHE_SWEEP_INTERVAL", "500"))
+
+
+class LRUCache:
+    """
+    スレッドセーフなTTL付きLRUキャッシュ。
+    ヒット・ミス・追い出しの回数を記録し、stats()で参照できます。
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: Optional[float] = None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        # 値は (期限の time.monotonic() の値、期限なしなら None, 値) で保持する
+        self._data: "OrderedDict[str, tuple[Optional[float], Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            expires_at, value = item
+            if expires_at is not None and time.monotonic() > expires_at:
+                del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: str, value: Any, ttl_seconds: Optional[float] = None) -> None:
+        """ttl_seconds を渡すと、キャッシュ全体のTTLの代わりにその秒数で期限切れにします（永続層の残りの有効期間など）。"""
+        ttl_seconds = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl_seconds if ttl_seconds is not None else None, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+# --- レビュー結果キャッシュ ---
+
+# メモリ層にはJSON文字列を保持し、取り出すたびに新しいdictを返す
+# (consolidate_reviewsなどが結果を書き換えてもキャッシュが汚れないようにするため)
+_review_memory_cache = LRUCache(REVIEW_CACHE_MAX_ENTRIES, ttl_seconds=REVIEW_CACHE_TTL_SECONDS)
+_review_stats = {"db_hits": 0, "db_misses": 0, "db_errors": 0, "writes": 0}
+_review_stats_lock = threading.Lock()
+
+
+def _count(name: str) -> int:
+    with _review_stats_lock:
+        _review_stats[name] += 1
+        return _review_stats[name]
+
+
+def _normalize_code(content: str) -> str:
+    # 改行コードの違いと末尾の空行だけで別物扱いにならないよう正規化する
+    return content.replace("\r\n", "\n").replace("\r", "\n").rstrip("\n")
+
+
+def make_review_key(files: Dict[str, str], mode: str, model_name: str, prompt_version: str) -> str:
+    """
+    (正規化したファイル群, モード, モデル名, プロンプトのバージョン) からキャッシュキーを作成します。
+    """
+    payload = {
+        "files": [[name, _normalize_code(content)] for name, content in sorted(files.items())],
+        "mode": mode,
+        "model_name": model_name,
+        "prompt_version": prompt_version,
+    }
+    encoded = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def _db_get_review(key: str) -> Optional[tuple]:
+    """(レビュー結果, 行の有効期限) を返します。見つからないか期限切れの場合は None を返します。"""
+    db = SessionLocal()
+    try:
+        entry = db.query(models.ReviewCacheEntry).filter(models.ReviewCacheEntry.key == key).first()
+        if entry is None:
+            return None
+        now = datetime.now(timezone.utc)
+        if entry.expires_at <= now:
+            db.delete(entry)
+            db.commit()
+            return None
+        entry.hit_count = (entry.hit_count or 0) + 1
+        entry.last_hit_at = now
+        db.commit()
+        return entry.review, entry.expires_at
+    finally:
+        db.close()
+
+
+def _db_set_review(key: str, review: dict, mode: str, model_name: str, sweep: bool) -> None:
+    db = SessionLocal()
+    try:
+        expires_at = datetime.now(timezone.utc) + timedelta(seconds=REVIEW_CACHE_TTL_SECONDS)
+        db.merge(models.ReviewCacheEntry(
+            key=key,
+            mode=mode,
+            model_name=model_name,
+            review=review,
+            expires_at=expires_at,
+            hit_count=0,
+        ))
+        db.commit()
+        if sweep:
+            _sweep_expired(db)
+    finally:
+        db.close()
+
+
+def _sweep_expired(db) -> None:
+    """期限切れの行を削除し、上限行数を超えた分は最後に使われたのが古い順に削除します。"""
+    entry = models.ReviewCacheEntry
+    db.query(entry).filter(entry.expires_at <= datetime.now(timezone.utc)).delete(synchronize_session=False)
+    overflow = db.query(entry).count() - REVIEW_CACHE_MAX_ROWS
+    if overflow > 0:
+        stale_keys = [
+            row.key for row in db.query(entry.key)
+            .order_by(entry.last_hit_at.asc().nullsfirst(), entry.created_at.asc())
+            .limit(overflow)
+        ]
+        db.query(entry).filter(entry.key.in_(stale_keys)).delete(synchronize_session=False)
+    db.commit()
+
+
+async def get_review(key: str) -> Optional[dict]:
+    """
+    キャッシュからレビュー結果を取得します。メモリ層 → Postgres層の順に探し、
+    Postgres層で見つかった場合はメモリ層にも載せ直します。
+    """
+    cached = _review_memory_cache.get(key)
+    if cached is not None:
+        return json.loads(cached)
+
+    if not REVIEW_CACHE_PERSISTENT:
+        return None
+
+    try:
+        found = await asyncio.to_thread(_db_get_review, key)
+    except Exception as e:
+        _count("db_errors")
+        print(f"--- DEBUG: Review cache lookup failed: {e} ---")
+        return None
+
+    if found is None:
+        _count("db_misses")
+        return None
+
+    _count("db_hits")
+    review, expires_at = found
+    # メモリ層に載せ直しても REVIEW_CACHE_TTL_SECONDS を超えて残らないよう、行の残りの有効期間を引き継ぐ
+    remaining = (expires_at - datetime.now(timezone.utc)).total_seconds()
+    if remaining > 0:
+        _review_memory_cache.set(key, json.dumps(review, ensure_ascii=False), ttl_seconds=remaining)
+    return review
+
+
+async def set_review(key: str, review: dict, mode: str, model_name: str) -> None:
+    """
+    レビュー結果をメモリ層とPostgres層の両方に保存します。
+    永続層への書き込みに失敗してもレビュー自体は成功扱いとします。
+    """
+    _review_memory_cache.set(key, json.dumps(review, ensure_ascii=False))
+    # 同時に書き込まれても掃除が1回だけ行われるよう、ロックの中で数えた値で判定する
+    writes = _count("writes")
+
+    if not REVIEW_CACHE_PERSISTENT:
+        return
+
+    sweep = REVIEW_CACHE_SWEEP_INTERVAL > 0 and writes % REVIEW_CACHE_SWEEP_INTERVAL == 0
+    try:
+        await asyncio.to_thread(_db_set_review, key, review, mode, model_name, sweep)
+    except Exception as e:
+        _count("db_errors")
+        print(f"--- DEBUG: Review cache write failed: {e} ---")
+
+
+def review_cache_stats() -> Dict[str, Any]:
+    with _review_stats_lock:
+        persistent = dict(_review_stats)
+    memory = _review_memory_cache.stats()
+    lookups = memory["hits"] + memory["misses"]
+    total_hits = memory["hits"] + persistent["db_hits"]
+    return {
+        "memory": memory,
+        "persistent": {"enabled": REVIEW_CACHE_PERSISTENT, "max_rows": REVIEW_CACHE_MAX_ROWS, **persistent},
+        "ttl_seconds": REVIEW_CACHE_TTL_SECONDS,
+        "hit_rate": round(total_hits / lookups, 4) if lookups else 0.0,
+    }
+
+
+metrics_service.register("review_cache", review_cache_stats)
+
+
+# --- ベクトル（embedding）キャッシュ ---
+
+_embedding_memory_cache = LRUCache(EMBEDDING_CACHE_MAX_ENTRIES)
+_embedding_stats = {"db_hits": 0, "db_misses": 0, "db_errors": 0, "writes": 0}
+_embedding_stats_lock = threading.Lock()
+
+
+def _count_embedding(name: str, amount: int = 1) -> None:
+    with _embedding_stats_lock:
+        _embedding_stats[name] += amount
+
+
+def make_embedding_key(text: str, model_name: str) -> str:
+    """(モデル名, テキスト) の内容ハッシュからキャッシュキーを作成します。ベクトルは入力に敏感なため正規化はしません。"""
+    return hashlib.sha256(f"{model_name}\0{text}".encode("utf-8")).hexdigest()
+
+
+def _db_get_embeddings(keys: List[str]) -> Dict[str, List[float]]:
+    db = SessionLocal()
+    try:
+        entry = models.EmbeddingCacheEntry
+        rows = db.query(entry).filter(entry.key.in_(keys)).all()
+        if rows:
+            db.query(entry).filter(entry.key.in_([row.key for row in rows])).update(
+                {entry.last_hit_at: datetime.now(timezone.utc)}, synchronize_session=False
+            )
+            db.commit()
+        return {row.key: [float(value) for value in row.embedding] for row in rows}
+    finally:
+        db.close()
+
+
+def _db_set_embeddings(vectors: Dict[str, List[float]], model_name: str, sweep: bool) -> None:
+    db = SessionLocal()
+    try:
+        for key, vector in vectors.items():
+            db.merge(models.EmbeddingCacheEntry(key=key, model_name=model_name, embedding=vector))
+        db.commit()
+        if sweep:
+            entry = models.EmbeddingCacheEntry
+            overflow = db.query(entry).count() - EMBEDDING_CACHE_MAX_ROWS
+            if overflow > 0:
+                stale_keys = [
+                    row.key for row in db.query(entry.key)
+                    .order_by(entry.last_hit_at.asc().nullsfirst(), entry.created_at.asc())
+                    .limit(overflow)
+                ]
+                db.query(entry).filter(entry.key.in_(stale_keys)).delete(synchronize_session=False)
+                db.commit()
+    finally:
+        db.close()
+
+
+def _get_memory_embeddings(keys: Iterable[str]):
+    found: Dict[str, List[float]] = {}
+    missing = []
+    for key in keys:
+        vector = _embedding_memory_cache.get(key)
+        if vector is not None:
+            found[key] = list(vector)
+        else:
+            missing.append(key)
+    return found, missing
+
+
+def _get_db_embeddings(keys: List[str]) -> Dict[str, List[float]]:
+    if not keys or not EMBEDDING_CACHE_PERSISTENT:
+        return {}
+    try:
+        from_db = _db_get_embeddings(keys)
+    except Exception as e:
+        _count_embedding("db_errors")
+        print(f"--- DEBUG: Embedding cache lookup failed: {e} ---")
+        return {}
+    _count_embedding("db_hits", len(from_db))
+    _count_embedding("db_misses", len(keys) - len(from_db))
+    for key, vector in from_db.items():
+        _embedding_memory_cache.set(key, tuple(vector))
+    return from_db
+
+
+def get_embeddings(keys: Iterable[str]) -> Dict[str, List[float]]:
+    """
+    キャッシュ済みのベクトルを {キー: ベクトル} で返します（見つからなかったキーは含まれません）。
+    メモリ層 → Postgres層（有効な場合）の順に探します。DBにアクセスするため、イベントループ上では aget_embeddings を使ってください。
+    """
+    found, missing = _get_memory_embeddings(keys)
+    found.update(_get_db_embeddings(missing))
+    return found
+
+
+def set_embeddings(vectors: Dict[str, List[float]], model_name: str) -> None:
+    """ベクトルをメモリ層とPostgres層（有効な場合）に保存します。永続層への書き込みの失敗は無視します。"""
+    if not vectors:
+        return
+    for key, vector in vectors.items():
+        # 呼び出し元がリストを書き換えてもキャッシュが汚れないよう、タプルで保持する
+        _embedding_memory_cache.set(key, tuple(vector))
+    with _embedding_stats_lock:
+        before = _embedding_stats["writes"]
+        _embedding_stats["writes"] += len(vectors)
+        after = _embedding_stats["writes"]
+
+    if not EMBEDDING_CACHE_PERSISTENT:
+        return
+    sweep = EMBEDDING_CACHE_SWEEP_INTERVAL > 0 and before // EMBEDDING_CACHE_SWEEP_INTERVAL != after // EMBEDDING_CACHE_SWEEP_INTERVAL
+    try:
+        _db_set_embeddings(vectors, model_name, sweep)
+    except Exception as e:
+        _count_embedding("db_errors")
+        print(f"--- DEBUG: Embedding cache write failed: {e} ---")
+
+
+async def aget_embeddings(keys: Iterable[str]) -> Dict[str, List[float]]:
+    """get_embeddings の非同期版。メモリ層で全て見つかった場合はスレッドに切り替えずに返します。"""
+    found, missing = _get_memory_embeddings(keys)
+    if missing and EMBEDDING_CACHE_PERSISTENT:
+        found.update(await asyncio.to_thread(_get_db_embeddings, missing))
+    return found
+
+
+async def aset_embeddings(vectors: Dict[str, List[float]], model_name: str) -> None:
+    if not EMBEDDING_CACHE_PERSISTENT:
+        set_embeddings(vectors, model_name)
+        return
+    await asyncio.to_thread(set_embeddings, vectors, model_name)
+
+
+def embedding_cache_stats() -> Dict[str, Any]:
+    with _embedding_stats_lock:
+        persistent = dict(_embedding_stats)
+    memory = _embedding_memory_cache.stats()
+    lookups = memory["hits"] + memory["misses"]
+    total_hits = memory["hits"] + persistent["db_hits"]
+    return {
+        "memory": memory,
+        "persistent": {"enabled": EMBEDDING_CACHE_PERSISTENT, "max_rows": EMBEDDING_CACHE_MAX_ROWS, **persistent},
+        "hit_rate": round(total_hits / lookups, 4) if lookups else 0.0,
+    }
+
+
+metrics_service.register("embedding_cache", embedding_cache_stats)
@@ -0,0 +1,228 @@
+# backend/concurrency_limiter.py
+
+import os
+import time
+import random
+import asyncio
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+import metrics_service
+
+# --- 設定値（環境変数で上書き可能） ---
+AI_CONCURRENCY_INITIAL = float(os.getenv("AI_CONCURRENCY_INITIAL", "8"))
+AI_CONCURRENCY_MIN = float(os.getenv("AI_CONCURRENCY_MIN", "1"))
+AI_CONCURRENCY_MAX = float(os.getenv("AI_CONCURRENCY_MAX", "64"))
+# 429やタイムアウトを受けたときに上限を何倍に縮めるか
+AI_CONCURRENCY_DECREASE_FACTOR = float(os.getenv("AI_CONCURRENCY_DECREASE_FACTOR", "0.5"))
+# 同じ輻輳で何度も縮めすぎないよう、縮小の間隔をこの秒数以上空ける
+AI_CONCURRENCY_DECREASE_COOLDOWN_SECONDS = float(os.getenv("AI_CONCURRENCY_DECREASE_COOLDOWN_SECONDS", "2"))
+AI_MAX_RETRIES = int(os.getenv("AI_MAX_RETRIES", "3"))
+AI_RETRY_BASE_DELAY_SECONDS = float(os.getenv("AI_RETRY_BASE_DELAY_SECONDS", "1"))
+AI_RETRY_MAX_DELAY_SECONDS = float(os.getenv("AI_RETRY_MAX_DELAY_SECONDS", "30"))
+
+SUCCESS = "success"
+THROTTLED = "throttled"
+TIMEOUT = "timeout"
+ERROR = "error"
+
+
+class AdaptiveLimiter:
+    """
+    AIMD（加算増加・乗算減少）方式で同時実行数の上限を調整するリミッター。
+    成功するたびに上限を少しずつ広げ、429やタイムアウトで上限を縮める。
+    Retry-After を受け取った場合は、その時刻まで新しい呼び出しを待たせる。
+    """
+
+    def __init__(self, name: str, initial: float, minimum: float, maximum: float):
+        self.name = name
+        self.limit = max(minimum, min(initial, maximum))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self.waiting = 0
+        self.blocked_until = 0.0
+        self._last_decrease = 0.0
+        self._cond = asyncio.Condition()
+        self._stats = {
+            "acquired": 0,
+            "successes": 0,
+            "throttled": 0,
+            "timeouts": 0,
+            "errors": 0,
+            "queue_wait_total_seconds": 0.0,
+            "queue_wait_max_seconds": 0.0,
+        }
+
+    async def acquire(self) -> float:
+        """空きができるまで待ってスロットを確保し、待ち時間（秒）を返す。"""
+        started = time.monotonic()
+        async with self._cond:
+            self.waiting += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    if now < self.blocked_until:
+                        try:
+                            await asyncio.wait_for(self._cond.wait(), timeout=self.blocked_until - now)
+                        except asyncio.TimeoutError:
+                            pass
+                    elif self.in_flight < int(self.limit):
+                        break
+                    else:
+                        await self._cond.wait()
+            finally:
+                self.waiting -= 1
+            self.in_flight += 1
+
+        waited = time.monotonic() - started
+        self._stats["acquired"] += 1
+        self._stats["queue_wait_total_seconds"] += waited
+        self._stats["queue_wait_max_seconds"] = max(self._stats["queue_wait_max_seconds"], waited)
+        return waited
+
+    async def release(self, outcome: str, retry_after: Optional[float] = None) -> None:
+        async with self._cond:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if outcome == SUCCESS:
+                self._stats["successes"] += 1
+                # 上限1つ分の呼び出しが成功するごとに、おおよそ1ずつ広げる
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            elif outcome in (THROTTLED, TIMEOUT):
+                self._stats["throttled" if outcome == THROTTLED else "timeouts"] += 1
+                if now - self._last_decrease >= AI_CONCURRENCY_DECREASE_COOLDOWN_SECONDS:
+                    self.limit = max(self.minimum, self.limit * AI_CONCURRENCY_DECREASE_FACTOR)
+                    self._last_decrease = now
+                if retry_after:
+                    self.blocked_until = max(self.blocked_until, now + retry_after)
+            elif outcome == ERROR:
+                self._stats["errors"] += 1
+            self._cond.notify_all()
+
+    def stats(self) -> Dict[str, Any]:
+        acquired = self._stats["acquired"]
+        return {
+            "limit": round(self.limit, 2),
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "blocked_for_seconds": round(max(0.0, self.blocked_until - time.monotonic()), 2),
+            **self._stats,
+            "queue_wait_avg_seconds": round(self._stats["queue_wait_total_seconds"] / acquired, 4) if acquired else 0.0,
+        }
+
+
+_limiters: Dict[str, AdaptiveLimiter] = {}
+_retries = {"count": 0}
+
+
+def get_limiter(name: str) -> AdaptiveLimiter:
+    """
+    名前ごとのリミッターを返します（なければ作成）。
+    AI_CONCURRENCY_MAX_<NAME> のような環境変数で、個別に最大値を指定できます。
+    """
+    limiter = _limiters.get(name)
+    if limiter is None:
+        env_suffix = name.upper().replace(":", "_").replace("-", "_").replace(".", "_")
+        maximum = float(os.getenv(f"AI_CONCURRENCY_MAX_{env_suffix}", AI_CONCURRENCY_MAX))
+        initial = float(os.getenv(f"AI_CONCURRENCY_INITIAL_{env_suffix}", AI_CONCURRENCY_INITIAL))
+        limiter = AdaptiveLimiter(name, initial, AI_CONCURRENCY_MIN, maximum)
+        _limiters[name] = limiter
+    return limiter
+
+
+def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+        return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def classify_error(error: BaseException) -> Tuple[str, Optional[float]]:
+    """
+    プロバイダーSDKの例外を (THROTTLED / TIMEOUT / ERROR, Retry-Afterの秒数) に分類します。
+    各SDKを直接importせず、ステータスコードやクラス名で判定します。
+    """
+    status = getattr(error, "status_code", None) or getattr(error, "code", None)
+    name = type(error).__name__
+    if status == 429 or name in ("RateLimitError", "ResourceExhausted", "TooManyRequests"):
+        retry_after = None
+        response = getattr(error, "response", None)
+        headers = getattr(response, "headers", None)
+        if headers is not None:
+            retry_after_ms = headers.get("retry-after-ms")
+            if retry_after_ms:
+                retry_after = _parse_retry_after(retry_after_ms)
+                retry_after = retry_after / 1000 if retry_after is not None else None
+            else:
+                retry_after = _parse_retry_after(headers.get("retry-after"))
+        return THROTTLED, retry_after
+    if isinstance(error, (asyncio.TimeoutError, TimeoutError)) or "Timeout" in name or name == "DeadlineExceeded":
+        return TIMEOUT, None
+    return ERROR, None
+
+
+@asynccontextmanager
+async def limit(provider: str, model_name: str):
+    """
+    プロバイダー単位とモデル単位の両方のリミッターでスロットを確保して処理を実行します。
+    処理の結果（成功・429・タイムアウト）に応じて、それぞれの上限が調整されます。
+    モデル単位を先に確保するため、絞られたモデルの待ち行列がプロバイダー全体の枠を占有しません。
+    """
+    limiters = [get_limiter(f"{provider}:{model_name}"), get_limiter(provider)]
+    acquired = []
+    outcome, retry_after = ERROR, None
+    try:
+        for limiter in limiters:
+            await limiter.acquire()
+            acquired.append(limiter)
+        yield
+        outcome = SUCCESS
+    except Exception as e:
+        outcome, retry_after = classify_error(e)
+        raise
+    finally:
+        for limiter in reversed(acquired):
+            await limiter.release(outcome, retry_after)
+
+
+async def run(provider: str, model_name: str, request: Callable[[], Awaitable[Any]]) -> Any:
+    """
+    リミッターの下で request() を実行し、429の場合は Retry-After（なければ指数バックオフ）に従って再試行します。
+    """
+    attempt = 0
+    while True:
+        try:
+            async with limit(provider, model_name):
+                return await request()
+        except Exception as e:
+            outcome, retry_after = classify_error(e)
+            if outcome != THROTTLED or attempt >= AI_MAX_RETRIES:
+                raise
+            delay = retry_after
+            if delay is None:
+                delay = min(AI_RETRY_MAX_DELAY_SECONDS, AI_RETRY_BASE_DELAY_SECONDS * (2 ** attempt))
+                delay *= random.uniform(0.5, 1.0)
+            attempt += 1
+            _retries["count"] += 1
+            print(f"--- DEBUG: {provider}:{model_name} was rate limited. Retrying in {delay:.1f}s (attempt {attempt}/{AI_MAX_RETRIES}) ---")
+            await asyncio.sleep(delay)
+
+
+def limiter_stats() -> Dict[str, Any]:
+    return {
+        "retries": _retries["count"],
+        "limiters": {name: limiter.stats() for name, limiter in _limiters.items()},
+    }
+
+
+metrics_service.register("provider_limits", limiter_stats)
@@ -0,0 +1,176 @@
+# backend/context_packer.py
+
+import os
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence
+
+import metrics_service
+from review_planner import estimate_tokens, fitting_length
+
+# --- 設定値（環境変数で上書き可能） ---
+# チャットのプロンプトに入れる過去の会話（記憶）全体のトークン数の上限。0なら従来どおり上位の記憶をそのまま入れる
+MEMORY_CONTEXT_TOKEN_BUDGET = int(os.getenv("MEMORY_CONTEXT_TOKEN_BUDGET", "1500"))
+# 詰める前に検索する記憶の候補数
+MEMORY_CONTEXT_CANDIDATES = int(os.getenv("MEMORY_CONTEXT_CANDIDATES", "12"))
+# 1つの記憶に使うトークン数の上限。超える場合は質問の語句を含む行の周辺だけを切り出す
+MEMORY_SNIPPET_MAX_TOKENS = int(os.getenv("MEMORY_SNIPPET_MAX_TOKENS", "400"))
+# MMR（Maximal Marginal Relevance）の重み。1に近いほど関連度を、0に近いほど既に選んだ記憶との違いを重視する
+MEMORY_MMR_LAMBDA = float(os.getenv("MEMORY_MMR_LAMBDA", "0.7"))
+# 既に選んだ記憶とのコサイン類似度がこれ以上の候補は、ほぼ同じ内容とみなして入れない
+MEMORY_DUPLICATE_SIMILARITY = float(os.getenv("MEMORY_DUPLICATE_SIMILARITY", "0.95"))
+
+# 残りの予算がこれより少なければ、記憶を切り詰めて入れずにそこで打ち切る
+_MIN_SNIPPET_TOKENS = 48
+
+_stats = {"packs": 0, "candidates": 0, "packed": 0, "duplicates_dropped": 0, "truncated": 0,
+          "over_budget_dropped": 0, "candidate_tokens": 0, "packed_tokens": 0}
+
+
+@dataclass
+class PackedMemory:
+    role: str
+    start_line: int
+    end_line: int
+    content: str
+    whole_message: bool  # メッセージ全体をそのまま入れたか（行範囲を表示しない）
+    tokens: int
+
+    def render(self) -> str:
+        if self.whole_message:
+            return f"- {self.role}: {self.content}\n"
+        return f"- {self.role} (lines {self.start_line}-{self.end_line}): {self.content}\n"
+
+
+def _cosine(a: Sequence[float], b: Sequence[float]) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = (sum(x * x for x in a) ** 0.5) * (sum(y * y for y in b) ** 0.5)
+    return dot / norm if norm else 0.0
+
+
+def _as_vector(embedding: Any) -> Optional[List[float]]:
+    if embedding is None or len(embedding) == 0:
+        return None
+    return [float(value) for value in embedding]
+
+
+def extract_span(content: str, start_line: int, terms: List[str], max_tokens: int):
+    """
+    予算を超えるテキストから、質問の語句を最も多く含む行を中心に、予算に収まる連続した行を切り出します。
+    語句を含む行がなければ先頭から切り出します。(テキスト, 開始行, 終了行, 切り詰めたか) を返します。
+    """
+    if estimate_tokens(content) <= max_tokens:
+        return content, start_line, start_line + content.count("\n"), False
+
+    lines = content.split("\n")
+    lowered_terms = [term.lower() for term in terms]
+    scores = [sum(line.lower().count(term) for term in lowered_terms) for line in lines]
+    center = max(range(len(lines)), key=lambda i: scores[i]) if any(scores) else 0
+
+    first = last = center
+    used = estimate_tokens(lines[center])
+    # 中心の行から前後に1行ずつ広げ、予算に達したら止める（前を少しだけ優先して、定義の行を含めやすくする）
+    while True:
+        grown = False
+        for candidate in (first - 1, last + 1):
+            if 0 <= candidate < len(lines) and not (first <= candidate <= last):
+                cost = estimate_tokens(lines[candidate])
+                if used + cost > max_tokens:
+                    continue
+                used += cost
+                first, last = min(first, candidate), max(last, candidate)
+                grown = True
+        if not grown:
+            break
+
+    text = "\n".join(lines[first:last + 1])
+    if estimate_tokens(text) > max_tokens:
+        # 1行だけで予算を超える場合（圧縮されたコードなど）は、予算に収まる最長の位置で切る
+        text = text[:fitting_length(text, max_tokens)]
+    return text, start_line + first, start_line + last, True
+
+
+def _select_mmr(candidates: List[Dict[str, Any]], lambda_: float, duplicate_similarity: float):
+    """関連度と、既に選んだ記憶との違いの釣り合いで、候補を1つずつ選ぶ順に並べる（ほぼ同じ内容の候補は除く）。"""
+    remaining = list(candidates)
+    selected = []
+    while remaining:
+        best, best_score, best_redundancy = None, None, 0.0
+        for candidate in remaining:
+            redundancy = max(
+                (_cosine(candidate["vector"], chosen["vector"]) for chosen in selected
+                 if candidate["vector"] is not None and chosen["vector"] is not None),
+                default=0.0,
+            )
+            score = lambda_ * candidate["relevance"] - (1 - lambda_) * redundancy
+            if best is None or score > best_score:
+                best, best_score, best_redundancy = candidate, score, redundancy
+        remaining.remove(best)
+        if best_redundancy >= duplicate_similarity:
+            _stats["duplicates_dropped"] += 1
+            continue
+        selected.append(best)
+    return selected
+
+
+def pack_memories(matches: List[Any], query_embedding: Optional[List[float]], terms: List[str],
+                  token_budget: Optional[int] = None) -> List[PackedMemory]:
+    """
+    検索された記憶（crud.MessageMatch）の候補から、重複を除きながら関連度の高い順にトークン数の上限まで詰めます。
+    長い記憶は質問の語句の周辺だけを切り出し、返す順序は関連度の高い順です。
+    """
+    token_budget = MEMORY_CONTEXT_TOKEN_BUDGET if token_budget is None else token_budget
+    query_vector = _as_vector(query_embedding)
+
+    candidates = []
+    for rank, match in enumerate(matches):
+        vector = _as_vector(match.embedding)
+        relevance = _cosine(query_vector, vector) if query_vector is not None and vector is not None else None
+        candidates.append({"match": match, "vector": vector, "relevance": relevance, "rank": rank})
+    # ベクトルのない候補（語句検索だけでヒットした古いメッセージ）は、既知の関連度の中央値として扱う
+    known = sorted(c["relevance"] for c in candidates if c["relevance"] is not None)
+    fallback = known[len(known) // 2] if known else 1.0
+    for candidate in candidates:
+        if candidate["relevance"] is None:
+            candidate["relevance"] = fallback
+
+    _stats["packs"] += 1
+    _stats["candidates"] += len(candidates)
+    _stats["candidate_tokens"] += sum(estimate_tokens(c["match"].content) for c in candidates)
+
+    packed: List[PackedMemory] = []
+    remaining = token_budget
+    for candidate in _select_mmr(candidates, MEMORY_MMR_LAMBDA, MEMORY_DUPLICATE_SIMILARITY):
+        match = candidate["match"]
+        header_tokens = estimate_tokens(f"- {match.message.role} (lines 00000-00000): ")
+        max_tokens = min(MEMORY_SNIPPET_MAX_TOKENS, remaining - header_tokens)
+        if max_tokens < _MIN_SNIPPET_TOKENS:
+            _stats["over_budget_dropped"] += 1
+            continue
+        text, start_line, end_line, truncated = extract_span(match.content, match.start_line, terms, max_tokens)
+        if truncated:
+            _stats["truncated"] += 1
+        memory = PackedMemory(
+            role=match.message.role, start_line=start_line, end_line=end_line, content=text,
+            whole_message=not truncated and match.content == match.message.content,
+            tokens=0,
+        )
+        memory.tokens = estimate_tokens(memory.render())
+        remaining -= memory.tokens
+        packed.append(memory)
+
+    _stats["packed"] += len(packed)
+    _stats["packed_tokens"] += token_budget - remaining
+    return packed
+
+
+def packer_stats() -> Dict[str, Any]:
+    packs = _stats["packs"]
+    return {
+        "token_budget": MEMORY_CONTEXT_TOKEN_BUDGET,
+        "candidates_per_query": MEMORY_CONTEXT_CANDIDATES,
+        **_stats,
+        "avg_packed_tokens": round(_stats["packed_tokens"] / packs, 1) if packs else 0.0,
+    }
+
+
+metrics_service.register("memory_context", packer_stats)
@@ -0,0 +1,159 @@
+# backend/conversation_memory.py
+
+import os
+import time
+import asyncio
+import traceback
+from typing import Any, Dict, List, Optional, Tuple
+
+import crud
+import ai_partner
+import metrics_service
+from database import AsyncSessionLocal
+from review_planner import estimate_tokens, fitting_length
+
+# --- 設定値（環境変数で上書き可能） ---
+# 要約とは別に、そのままの形でモデルに送る直近のメッセージ数
+CHAT_RECENT_MESSAGES = int(os.getenv("CHAT_RECENT_MESSAGES", "6"))
+# 要約されていないやり取りが直近分に加えてこのターン数（ユーザーとAIの1往復）たまったら、裏で要約を更新する
+CHAT_SUMMARY_EVERY_TURNS = int(os.getenv("CHAT_SUMMARY_EVERY_TURNS", "4"))
+# 要約の長さの目安（トークン数）
+CHAT_SUMMARY_MAX_TOKENS = int(os.getenv("CHAT_SUMMARY_MAX_TOKENS", "600"))
+# 要約を作るときに1つのメッセージから渡す長さの上限。レビュー対象のコード全体などを丸ごと送らないようにする
+CHAT_SUMMARY_MESSAGE_MAX_TOKENS = int(os.getenv("CHAT_SUMMARY_MESSAGE_MAX_TOKENS", "800"))
+
+# 要約の更新が止まっていても、1ターンで送るメッセージ数はこれを超えない
+_MAX_UNSUMMARIZED = CHAT_RECENT_MESSAGES + 2 * CHAT_SUMMARY_EVERY_TURNS
+# 1回の要約で取り込むメッセージ数の上限（溜まっている場合は次の更新で続きを取り込む）
+_MAX_MESSAGES_PER_SUMMARY = 100
+
+_tasks: Dict[int, asyncio.Task] = {}
+_stats = {"turns": 0, "turns_with_summary": 0, "history_messages_total": 0,
+          "summaries": 0, "summary_failures": 0, "summarized_messages": 0, "summary_seconds_total": 0.0}
+
+
+async def load_chat_context(db, conversation) -> Tuple[Optional[str], List[Dict[str, str]]]:
+    """
+    モデルに送る会話の文脈として、(要約, 要約に含まれていない直近のメッセージ) を返します。
+    メッセージ数は最大でも直近分と要約の更新間隔の合計に収まるため、会話が長くなっても1ターンの大きさは変わりません。
+    """
+    messages = await crud.aget_unsummarized_messages(db, conversation, limit=_MAX_UNSUMMARIZED, newest=True)
+    history = _start_at_user_turn([{"role": message.role, "content": message.content} for message in messages])
+    _stats["turns"] += 1
+    _stats["history_messages_total"] += len(history)
+    if conversation.summary:
+        _stats["turns_with_summary"] += 1
+    return conversation.summary, history
+
+
+def _start_at_user_turn(history: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    """
+    要約の更新が遅れて件数の上限で切ると、履歴がAIの応答から始まることがある。
+    GeminiやAnthropicはユーザーの発言から始まらない履歴を受け付けないため、最初のユーザーの発言まで読み飛ばす。
+    """
+    for index, message in enumerate(history):
+        if message["role"] == "user":
+            return history[index:]
+    return history
+
+
+def _clip(content: str) -> str:
+    if estimate_tokens(content) <= CHAT_SUMMARY_MESSAGE_MAX_TOKENS:
+        return content
+    # 先頭と末尾を残す（コードなら定義の始まり、レビューなら結論が残りやすい）
+    # 文字の種類で1文字あたりのトークン数が異なるため、文字数ではなくトークン数の見積もりで切る
+    marker = "\n...（中略）...\n"
+    head_budget = CHAT_SUMMARY_MESSAGE_MAX_TOKENS * 2 // 3
+    tail_budget = max(CHAT_SUMMARY_MESSAGE_MAX_TOKENS - head_budget - estimate_tokens(marker), 1)
+    head = content[:fitting_length(content, head_budget)]
+    tail_length = fitting_length(content[::-1], tail_budget)
+    tail = content[len(content) - tail_length:] if tail_length else ""
+    return f"{head}{marker}{tail}"
+
+
+async def _pending_messages(conversation_id: int):
+    async with AsyncSessionLocal() as db:
+        conversation = await crud.aget_conversation(db, conversation_id)
+        if conversation is None:
+            return None, []
+        messages = await crud.aget_unsummarized_messages(db, conversation, limit=_MAX_MESSAGES_PER_SUMMARY)
+        return conversation.summary, [(message.id, message.role, message.content) for message in messages]
+
+
+async def _save_summary(conversation_id: int, summary: str, summary_message_id: int) -> bool:
+    async with AsyncSessionLocal() as db:
+        return await crud.aupdate_conversation_summary(db, conversation_id, summary, summary_message_id)
+
+
+async def _update_summary(conversation_id: int) -> None:
+    started = time.monotonic()
+    try:
+        previous_summary, pending = await _pending_messages(conversation_id)
+        if len(pending) < _MAX_UNSUMMARIZED:
+            return
+        # 直近のメッセージはそのまま送り続けるため、それより古い分だけを要約に取り込む
+        to_summarize = pending[:-CHAT_RECENT_MESSAGES] if CHAT_RECENT_MESSAGES > 0 else pending
+        if not to_summarize:
+            return
+        summary = await ai_partner.summarize_conversation(
+            previous_summary,
+            [{"role": role, "content": _clip(content)} for _, role, content in to_summarize],
+            CHAT_SUMMARY_MAX_TOKENS,
+        )
+        if not summary:
+            raise ValueError("The model returned an empty summary.")
+        await _save_summary(conversation_id, summary, to_summarize[-1][0])
+        _stats["summaries"] += 1
+        _stats["summarized_messages"] += len(to_summarize)
+        _stats["summary_seconds_total"] += time.monotonic() - started
+        print(f"--- DEBUG: Summarized {len(to_summarize)} messages of conversation {conversation_id} "
+              f"in {time.monotonic() - started:.1f}s. ---")
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        # 要約に失敗しても、次のターンは要約されていない分を含めて送るだけなので会話は続けられる
+        _stats["summary_failures"] += 1
+        print(f"--- DEBUG: Failed to summarize conversation {conversation_id}: {e} ---")
+        traceback.print_exc()
+
+
+def schedule_summary_update(conversation_id: int) -> None:
+    """
+    チャットの応答を保存した後に呼び出します。要約されていないメッセージが一定数を超えていれば、
+    応答を待たせないよう裏で要約を更新します（同じ会話の更新は同時に1つだけ実行します）。
+    """
+    task = _tasks.get(conversation_id)
+    if task is not None and not task.done():
+        return
+    task = asyncio.create_task(_update_summary(conversation_id))
+    _tasks[conversation_id] = task
+
+    def forget(finished: asyncio.Task) -> None:
+        if _tasks.get(conversation_id) is finished:
+            del _tasks[conversation_id]
+
+    task.add_done_callback(forget)
+
+
+async def stop() -> None:
+    """アプリケーション終了時に、実行中の要約の更新を止めます（次のターンで再び更新されます）。"""
+    tasks = list(_tasks.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    _tasks.clear()
+
+
+def memory_stats() -> Dict[str, Any]:
+    turns, summaries = _stats["turns"], _stats["summaries"]
+    return {
+        "recent_messages": CHAT_RECENT_MESSAGES,
+        "summary_every_turns": CHAT_SUMMARY_EVERY_TURNS,
+        "summaries_in_flight": sum(1 for task in _tasks.values() if not task.done()),
+        **_stats,
+        "avg_history_messages": round(_stats["history_messages_total"] / turns, 2) if turns else 0.0,
+        "avg_summary_seconds": round(_stats["summary_seconds_total"] / summaries, 2) if summaries else 0.0,
+    }
+
+
+metrics_service.register("conversation_memory", memory_stats)
@@ -1,8 +1,13 @@
-from sqlalchemy.orm import Session
-from sqlalchemy import desc
-from typing import List
+from sqlalchemy.orm import Session, joinedload, selectinload
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import desc, or_, and_, literal_column, select, update
+from sqlalchemy.sql import func
+from datetime import datetime
+from typing import List, NamedTuple
 import models
 import schemas
+import vector_index
+from local_vector_index import LOCAL_VECTOR_INDEX_ENABLED, local_index
 
 # --- Project関連のCRUD関数 ---
 
@@ -41,6 +46,7 @@ def delete_project(db: Session, project_id: int):
     if db_project:
         db.delete(db_project)
         db.commit()
+        local_index.drop_project(project_id)
     return db_project
 
 def update_project_name(db: Session, project_id: int, name: str):
@@ -80,39 +86,472 @@ def create_conversation(db: Session, conversation: schemas.ConversationCreate) -
     db.refresh(db_conversation)
     return db_conversation
 
+def _conversation_project_id(conversation_id: int):
+    # 会話のproject_idをINSERT文の中で複製する（追加の問い合わせは発生しない）
+    return select(models.Conversation.project_id).where(models.Conversation.id == conversation_id).scalar_subquery()
+
 def create_message(db: Session, message: schemas.MessageCreate, conversation_id: int) -> models.Message:
     """特定の会話に新しいメッセージを追加します。"""
     db_message = models.Message(
         role=message.role,
         content=message.content,
-        conversation_id=conversation_id
+        conversation_id=conversation_id,
+        project_id=_conversation_project_id(conversation_id),
     )
     db.add(db_message)
     db.commit()
     db.refresh(db_message)
     return db_message
 
+def get_conversation(db: Session, conversation_id: int) -> models.Conversation | None:
+    return db.query(models.Conversation).filter(models.Conversation.id == conversation_id).first()
+
+def _unsummarized_messages_statement(conversation: models.Conversation, limit: int, newest: bool):
+    stmt = select(models.Message).where(models.Message.conversation_id == conversation.id)
+    if conversation.summary_message_id is not None:
+        stmt = stmt.where(models.Message.id > conversation.summary_message_id)
+    return stmt.order_by(models.Message.id.desc() if newest else models.Message.id).limit(limit)
+
+def get_unsummarized_messages(db: Session, conversation: models.Conversation, limit: int, newest: bool = False) -> List[models.Message]:
+    """
+    会話の要約にまだ含まれていないメッセージを、古い順に最大 limit 件取得します。
+    newest=True の場合は、そのうち最も新しい limit 件を（古い順に並べて）返します。
+    """
+    messages = db.execute(_unsummarized_messages_statement(conversation, limit, newest)).scalars().all()
+    return list(reversed(messages)) if newest else list(messages)
+
+def _summary_update_statement(conversation_id: int, summary: str, summary_message_id: int):
+    return update(models.Conversation).where(
+        models.Conversation.id == conversation_id,
+        or_(models.Conversation.summary_message_id.is_(None), models.Conversation.summary_message_id < summary_message_id),
+    ).values(summary=summary, summary_message_id=summary_message_id, summary_updated_at=func.now())
+
+def update_conversation_summary(db: Session, conversation_id: int, summary: str, summary_message_id: int) -> bool:
+    """会話の要約を保存します。より新しいメッセージまでを含む要約が既に保存されている場合は何もせず False を返します。"""
+    result = db.execute(_summary_update_statement(conversation_id, summary, summary_message_id))
+    db.commit()
+    return result.rowcount > 0
+
+def _latest_conversation_statement(project_id: int):
+    return select(models.Conversation).where(models.Conversation.project_id == project_id).order_by(models.Conversation.created_at.desc()).limit(1)
+
 def get_latest_conversation_by_project_id(db: Session, project_id: int) -> models.Conversation | None:
     """特定のプロジェクトの最新の会話を取得します。"""
-    return db.query(models.Conversation).filter(models.Conversation.project_id == project_id).order_by(models.Conversation.created_at.desc()).first()
+    return db.execute(_latest_conversation_statement(project_id)).scalars().first()
+
+def _build_message_chunks(chunks: List[dict], project_id: int | None) -> List[models.MessageChunk]:
+    return [
+        models.MessageChunk(
+            project_id=project_id,
+            chunk_index=chunk["chunk_index"], start_line=chunk["start_line"], end_line=chunk["end_line"],
+            content=chunk["content"], embedding=chunk["embedding"],
+        )
+        for chunk in chunks if chunk["embedding"]
+    ]
 
-def update_message_embedding(db: Session, message_id: int, embedding: List[float]) -> models.Message:
-    """特定のメッセージにベクトル（embedding）を保存します。"""
+def update_message_embedding(db: Session, message_id: int, embedding: List[float] | None = None, chunks: List[dict] | None = None) -> models.Message:
+    """
+    特定のメッセージにベクトル（embedding）を保存します。
+    chunks（memory_service.generate_message_chunks の結果）を渡すと、部分ごとのベクトルも置き換えて保存し、
+    embedding を省略した場合は先頭の部分のベクトルをメッセージ全体のベクトルとして使います。
+    """
     db_message = db.query(models.Message).filter(models.Message.id == message_id).first()
     if db_message:
-        db_message.embedding = embedding
+        if chunks is not None:
+            db_message.chunks = _build_message_chunks(chunks, db_message.project_id)
+            if embedding is None:
+                embedding = chunks[0]["embedding"] if chunks else None
+        db_message.embedding = embedding or None
         db.commit()
         db.refresh(db_message)
+        _update_local_index(db_message)
     return db_message
 
-def search_similar_messages(db: Session, project_id: int, query_embedding: List[float], limit: int = 3) -> List[models.Message]:
+def _update_local_index(db_message: models.Message) -> None:
+    """保存したベクトルを、メモリ上のプロジェクト別インデックスにも反映します（有効な場合のみ）。"""
+    if not LOCAL_VECTOR_INDEX_ENABLED:
+        return
+    if db_message.chunks:
+        rows = [(chunk.id, chunk.embedding) for chunk in db_message.chunks]
+    else:
+        rows = [(None, db_message.embedding)] if db_message.embedding is not None else []
+    local_index.replace_message(db_message.project_id, db_message.id, rows)
+
+class MessageMatch(NamedTuple):
+    """検索でヒットしたメッセージと、その中で最も類似度が高かった部分。"""
+    message: models.Message
+    start_line: int
+    end_line: int
+    content: str
+    distance: float | None  # 語句検索だけでヒットした場合は None
+    embedding: List[float] | None = None  # 一致した部分のベクトル（記憶を詰めるときの重複の判定に使う）
+
+def _local_hit_statements(hits):
+    """メモリ上のインデックスの検索結果（IDと距離）から、メッセージと部分を主キーで取得する文を作ります。"""
+    chunk_ids = [hit.chunk_id for hit in hits if hit.chunk_id is not None]
+    chunk_stmt = select(models.MessageChunk).where(models.MessageChunk.id.in_(chunk_ids)) if chunk_ids else None
+    message_stmt = select(models.Message).where(models.Message.id.in_([hit.message_id for hit in hits]))
+    return chunk_stmt, message_stmt
+
+def _local_hit_matches(hits, chunks: List[models.MessageChunk], messages: List[models.Message]) -> List[MessageMatch]:
+    chunks = {chunk.id: chunk for chunk in chunks}
+    messages = {message.id: message for message in messages}
+    matches = []
+    for hit in hits:
+        message = messages.get(hit.message_id)
+        if message is None:
+            continue  # インデックスの読み込み後に削除されたメッセージ
+        if hit.chunk_id is None:
+            matches.append(_whole_message_match(message, hit.distance))
+        elif hit.chunk_id in chunks:
+            chunk = chunks[hit.chunk_id]
+            matches.append(MessageMatch(message, chunk.start_line, chunk.end_line, chunk.content, hit.distance, chunk.embedding))
+    return matches
+
+def _resolve_local_hits(db: Session, hits) -> List[MessageMatch]:
+    chunk_stmt, message_stmt = _local_hit_statements(hits)
+    chunks = db.execute(chunk_stmt).scalars().all() if chunk_stmt is not None else []
+    return _local_hit_matches(hits, chunks, db.execute(message_stmt).scalars().all())
+
+def _whole_message_match(message: models.Message, distance: float | None) -> MessageMatch:
+    return MessageMatch(message, 1, message.content.count("\n") + 1, message.content, distance, message.embedding)
+
+def _best_chunk_per_message(rows, limit: int) -> List[MessageMatch]:
+    """部分ごとの検索結果から、メッセージごとに最も上位の部分を1つだけ採用します。"""
+    matches: List[MessageMatch] = []
+    seen = set()
+    for chunk, distance in rows:
+        if chunk.message_id in seen:
+            continue
+        seen.add(chunk.message_id)
+        matches.append(MessageMatch(chunk.message, chunk.start_line, chunk.end_line, chunk.content, distance, chunk.embedding))
+        if len(matches) >= limit:
+            break
+    return matches
+
+def _similar_chunks_statement(project_id: int, query_embedding: List[float], limit: int):
+    chunk_distance = models.MessageChunk.embedding.cosine_distance(query_embedding)
+    # 同じメッセージの部分が上位を占めても limit 件のメッセージが揃うよう、多めに取得する
+    return select(models.MessageChunk, chunk_distance.label("distance")).options(joinedload(models.MessageChunk.message)).where(
+        models.MessageChunk.project_id == project_id,
+    ).order_by(chunk_distance).limit(limit * 4)
+
+def _similar_messages_statement(project_id: int, query_embedding: List[float], limit: int):
+    # 非正規化した project_id で絞り込むため、Conversationテーブルとの結合は不要
+    message_distance = models.Message.embedding.cosine_distance(query_embedding)
+    return select(models.Message, message_distance.label("distance")).where(
+        models.Message.project_id == project_id,
+        models.Message.embedding.isnot(None), # embeddingが存在するメッセージのみ対象
+        ~models.Message.chunks.any(),
+    ).order_by(
+        message_distance # コサイン距離が最も近い順に並び替え
+    ).limit(limit)
+
+def search_similar_messages(db: Session, project_id: int, query_embedding: List[float], limit: int = 3,
+                            ef_search: int | None = None, probes: int | None = None) -> List[MessageMatch]:
     """
-    特定のプロジェクト内で、クエリのベクトルと類似度の高いメッセージを検索します。
+    特定のプロジェクト内で、クエリのベクトルと類似度の高いメッセージを、部分（チャンク）単位で検索します。
+    メッセージごとに最も近い部分を1つだけ採用し、親のメッセージと一致した範囲を返します。
+    部分のベクトルを持たない古いメッセージは、メッセージ全体のベクトルで補います。
+    ef_search（HNSW）/ probes（IVFFlat）で、この検索での近似インデックスの精度と速度の釣り合いを調整できます。
     """
-    # MessageテーブルとConversationテーブルを結合し、project_idでフィルタリング
-    return db.query(models.Message).join(models.Conversation).filter(
-        models.Conversation.project_id == project_id,
-        models.Message.embedding.isnot(None) # embeddingが存在するメッセージのみ対象
-    ).order_by(
-        models.Message.embedding.cosine_distance(query_embedding) # コサイン距離が最も近い順に並び替え
-    ).limit(limit).all()
\ No newline at end of file
+    if LOCAL_VECTOR_INDEX_ENABLED:
+        hits = local_index.search(project_id, query_embedding, limit)
+        # まだ読み込まれていないプロジェクトは None が返るため、pgvector で検索する
+        if hits is not None:
+            return _resolve_local_hits(db, hits)
+
+    vector_index.apply_search_settings(db, ef_search=ef_search, probes=probes)
+    matches = _best_chunk_per_message(db.execute(_similar_chunks_statement(project_id, query_embedding, limit)).all(), limit)
+    if len(matches) >= limit:
+        return matches
+    legacy_rows = db.execute(_similar_messages_statement(project_id, query_embedding, limit - len(matches))).all()
+    matches += [_whole_message_match(message, distance) for message, distance in legacy_rows]
+    return sorted(matches, key=lambda match: match.distance)
+
+# 全文検索のインデックス（vector_index.py で作成）と同じ式にしないとインデックスが使われない
+_TEXT_SEARCH_CONFIG = literal_column(f"'{vector_index.TEXT_SEARCH_CONFIG}'::regconfig")
+
+def _text_search_query(terms: List[str]):
+    """語句ごとの phraseto_tsquery を OR で結合する（識別子は単語の並びとして一致させる）。"""
+    query = None
+    for term in terms:
+        term_query = func.phraseto_tsquery(_TEXT_SEARCH_CONFIG, term)
+        query = term_query if query is None else query.op("||")(term_query)
+    return query
+
+def _text_chunks_statement(project_id: int, terms: List[str], limit: int):
+    query = _text_search_query(terms)
+    chunk_vector = func.to_tsvector(_TEXT_SEARCH_CONFIG, models.MessageChunk.content)
+    chunk_rank = func.ts_rank_cd(chunk_vector, query)
+    return select(models.MessageChunk, chunk_rank.label("rank")).options(joinedload(models.MessageChunk.message)).where(
+        models.MessageChunk.project_id == project_id,
+        chunk_vector.op("@@")(query),
+    ).order_by(chunk_rank.desc()).limit(limit * 4)
+
+def _text_messages_statement(project_id: int, terms: List[str], limit: int):
+    # 部分を持たない古いメッセージは、メッセージ全体で検索する
+    query = _text_search_query(terms)
+    message_vector = func.to_tsvector(_TEXT_SEARCH_CONFIG, models.Message.content)
+    message_rank = func.ts_rank_cd(message_vector, query)
+    return select(models.Message, message_rank.label("rank")).where(
+        models.Message.project_id == project_id,
+        message_vector.op("@@")(query),
+        ~models.Message.chunks.any(),
+    ).order_by(message_rank.desc()).limit(limit)
+
+def _text_matches(ranked: List[MessageMatch]) -> List[MessageMatch]:
+    """一時的に distance に入れていた ts_rank_cd の高い順に並べ、語句検索の結果として distance を None にします。"""
+    return [match._replace(distance=None) for match in sorted(ranked, key=lambda match: match.distance, reverse=True)]
+
+def search_messages_by_text(db: Session, project_id: int, terms: List[str], limit: int = 3) -> List[MessageMatch]:
+    """
+    特定のプロジェクト内で、関数名やエラーメッセージなどの語句を含むメッセージを、全文検索のインデックスで検索します。
+    一致した語句の多さ・近さ（ts_rank_cd）の順に、メッセージごとに最も一致した部分を1つだけ返します。
+    """
+    if not terms:
+        return []
+    ranked = _best_chunk_per_message(db.execute(_text_chunks_statement(project_id, terms, limit)).all(), limit)
+    if len(ranked) < limit:
+        legacy_rows = db.execute(_text_messages_statement(project_id, terms, limit - len(ranked))).all()
+        ranked += [_whole_message_match(message, rank) for message, rank in legacy_rows]
+    return _text_matches(ranked)
+
+
+# --- ReviewSnapshot 関連のCRUD関数 ---
+
+def create_review_snapshot(db: Session, project_id: int, file_name: str, code: str, results: List[dict], conversation_id: int | None = None) -> models.ReviewSnapshot:
+    """レビューしたコードと結果を、次回の差分レビューのために保存します。"""
+    db_snapshot = models.ReviewSnapshot(
+        project_id=project_id,
+        conversation_id=conversation_id,
+        file_name=file_name,
+        code=code,
+        results=results,
+    )
+    db.add(db_snapshot)
+    db.commit()
+    db.refresh(db_snapshot)
+    return db_snapshot
+
+def _review_record_objects(project_id: int, conversation_id: int, record: dict) -> list:
+    """レビュー結果1件分の、会話に属するメッセージ（とその部分）とスナップショットを作ります。"""
+    return [
+        models.Message(conversation_id=conversation_id, project_id=project_id, role="user", content=record["code"],
+                       embedding=record["user_chunks"][0]["embedding"] if record["user_chunks"] else None,
+                       chunks=_build_message_chunks(record["user_chunks"], project_id)),
+        models.Message(conversation_id=conversation_id, project_id=project_id, role="assistant", content=record["assistant_content"],
+                       embedding=record["assistant_chunks"][0]["embedding"] if record["assistant_chunks"] else None,
+                       chunks=_build_message_chunks(record["assistant_chunks"], project_id)),
+        models.ReviewSnapshot(project_id=project_id, conversation_id=conversation_id, file_name=record["file_name"],
+                              code=record["code"], results=record["results"]),
+    ]
+
+def _update_local_index_for(objects: list) -> None:
+    if LOCAL_VECTOR_INDEX_ENABLED:
+        for obj in objects:
+            if isinstance(obj, models.Message):
+                _update_local_index(obj)
+
+def create_review_records(db: Session, project_id: int, records: List[dict]) -> List[models.Conversation]:
+    """
+    複数ファイルのレビュー結果（会話・メッセージ・ベクトル・スナップショット）を、1つのトランザクションでまとめて保存します。
+    records の各要素は title, file_name, code, assistant_content, results, user_chunks, assistant_chunks を持ちます。
+    """
+    conversations, objects = [], []
+    try:
+        for record in records:
+            db_conversation = models.Conversation(project_id=project_id, title=record["title"])
+            db.add(db_conversation)
+            # 子レコードに付けるIDを得るため、コミットせずにINSERTだけ先に送る
+            db.flush()
+            record_objects = _review_record_objects(project_id, db_conversation.id, record)
+            db.add_all(record_objects)
+            conversations.append(db_conversation)
+            objects += record_objects
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    _update_local_index_for(objects)
+    return conversations
+
+def _latest_snapshot_statement(project_id: int, file_name: str):
+    return select(models.ReviewSnapshot).where(
+        models.ReviewSnapshot.project_id == project_id,
+        models.ReviewSnapshot.file_name == file_name
+    ).order_by(models.ReviewSnapshot.created_at.desc(), models.ReviewSnapshot.id.desc()).limit(1)
+
+def get_latest_review_snapshot(db: Session, project_id: int, file_name: str) -> models.ReviewSnapshot | None:
+    """特定のプロジェクト・ファイルについて、最後にレビューしたときのスナップショットを取得します。"""
+    return db.execute(_latest_snapshot_statement(project_id, file_name)).scalars().first()
+
+
+# --- ReviewJob 関連のCRUD関数 ---
+
+def create_review_job(db: Session, job_id: str, payload: dict, project_id: int | None = None) -> models.ReviewJob:
+    """レビュージョブをキューに登録します。"""
+    db_job = models.ReviewJob(id=job_id, project_id=project_id, status="queued", payload=payload, attempts=0)
+    db.add(db_job)
+    db.commit()
+    db.refresh(db_job)
+    return db_job
+
+def get_review_job(db: Session, job_id: str) -> models.ReviewJob | None:
+    return db.query(models.ReviewJob).filter(models.ReviewJob.id == job_id).first()
+
+def claim_next_review_job(db: Session, worker_id: str, stale_before: datetime) -> models.ReviewJob | None:
+    """
+    実行待ちのジョブを1件取り出して実行中にします。
+    FOR UPDATE SKIP LOCKED で行をロックするため、複数のワーカーやプロセスが同じジョブを取り合うことはありません。
+    stale_before より前に開始されたまま終わっていないジョブは、ワーカーが落ちたものとみなして再実行します。
+    """
+    db_job = db.query(models.ReviewJob).filter(
+        or_(
+            models.ReviewJob.status == "queued",
+            and_(models.ReviewJob.status == "running", models.ReviewJob.started_at < stale_before),
+        )
+    ).order_by(models.ReviewJob.created_at, models.ReviewJob.id).with_for_update(skip_locked=True).first()
+    if db_job is None:
+        db.rollback()
+        return None
+    db_job.status = "running"
+    db_job.worker_id = worker_id
+    db_job.attempts = (db_job.attempts or 0) + 1
+    db_job.started_at = func.now()
+    db.commit()
+    db.refresh(db_job)
+    return db_job
+
+def finish_review_job(db: Session, job_id: str, result: dict | None = None, error: str | None = None) -> models.ReviewJob | None:
+    """ジョブの結果（またはエラー）を保存して完了にします。"""
+    db_job = get_review_job(db, job_id)
+    if db_job:
+        db_job.status = "failed" if error is not None else "succeeded"
+        db_job.result = result
+        db_job.error = error
+        db_job.finished_at = func.now()
+        db.commit()
+        db.refresh(db_job)
+    return db_job
+
+def count_review_jobs_by_status(db: Session) -> dict:
+    return dict(db.query(models.ReviewJob.status, func.count(models.ReviewJob.id)).group_by(models.ReviewJob.status).all())
+
+
+# --- 非同期版のCRUD関数（AsyncSession用） ---
+# async なエンドポイントのホットパスで使い、DBの待ち時間の間も他のリクエスト（LLMの応答待ちなど）を進められるようにする。
+# 問い合わせの内容は同期版と共通の文を使う。AsyncSession では遅延読み込みができないため、必要な関連は明示的に読み込む
+
+async def aget_project(db: AsyncSession, project_id: int) -> models.Project | None:
+    return await db.get(models.Project, project_id)
+
+async def aget_conversation(db: AsyncSession, conversation_id: int) -> models.Conversation | None:
+    return await db.get(models.Conversation, conversation_id)
+
+async def aget_latest_conversation_by_project_id(db: AsyncSession, project_id: int) -> models.Conversation | None:
+    return (await db.execute(_latest_conversation_statement(project_id))).scalars().first()
+
+async def acreate_message(db: AsyncSession, message: schemas.MessageCreate, conversation_id: int) -> models.Message:
+    db_message = models.Message(
+        role=message.role,
+        content=message.content,
+        conversation_id=conversation_id,
+        project_id=_conversation_project_id(conversation_id),
+    )
+    db.add(db_message)
+    await db.commit()
+    await db.refresh(db_message)
+    return db_message
+
+async def aupdate_message_embedding(db: AsyncSession, message_id: int, embedding: List[float] | None = None,
+                                    chunks: List[dict] | None = None) -> models.Message | None:
+    """update_message_embedding の非同期版です。"""
+    db_message = (await db.execute(
+        select(models.Message).options(selectinload(models.Message.chunks)).where(models.Message.id == message_id)
+    )).scalars().first()
+    if db_message:
+        if chunks is not None:
+            db_message.chunks = _build_message_chunks(chunks, db_message.project_id)
+            if embedding is None:
+                embedding = chunks[0]["embedding"] if chunks else None
+        db_message.embedding = embedding or None
+        await db.commit()
+        _update_local_index(db_message)
+    return db_message
+
+async def aget_unsummarized_messages(db: AsyncSession, conversation: models.Conversation, limit: int,
+                                     newest: bool = False) -> List[models.Message]:
+    messages = (await db.execute(_unsummarized_messages_statement(conversation, limit, newest))).scalars().all()
+    return list(reversed(messages)) if newest else list(messages)
+
+async def aupdate_conversation_summary(db: AsyncSession, conversation_id: int, summary: str, summary_message_id: int) -> bool:
+    result = await db.execute(_summary_update_statement(conversation_id, summary, summary_message_id))
+    await db.commit()
+    return result.rowcount > 0
+
+async def asearch_similar_messages(db: AsyncSession, project_id: int, query_embedding: List[float], limit: int = 3,
+                                   ef_search: int | None = None, probes: int | None = None) -> List[MessageMatch]:
+    """search_similar_messages の非同期版です。"""
+    if LOCAL_VECTOR_INDEX_ENABLED:
+        hits = local_index.search(project_id, query_embedding, limit)
+        if hits is not None:
+            chunk_stmt, message_stmt = _local_hit_statements(hits)
+            chunks = (await db.execute(chunk_stmt)).scalars().all() if chunk_stmt is not None else []
+            return _local_hit_matches(hits, chunks, (await db.execute(message_stmt)).scalars().all())
+
+    await vector_index.aapply_search_settings(db, ef_search=ef_search, probes=probes)
+    rows = (await db.execute(_similar_chunks_statement(project_id, query_embedding, limit))).all()
+    matches = _best_chunk_per_message(rows, limit)
+    if len(matches) >= limit:
+        return matches
+    legacy_rows = (await db.execute(_similar_messages_statement(project_id, query_embedding, limit - len(matches)))).all()
+    matches += [_whole_message_match(message, distance) for message, distance in legacy_rows]
+    return sorted(matches, key=lambda match: match.distance)
+
+async def asearch_messages_by_text(db: AsyncSession, project_id: int, terms: List[str], limit: int = 3) -> List[MessageMatch]:
+    """search_messages_by_text の非同期版です。"""
+    if not terms:
+        return []
+    ranked = _best_chunk_per_message((await db.execute(_text_chunks_statement(project_id, terms, limit))).all(), limit)
+    if len(ranked) < limit:
+        legacy_rows = (await db.execute(_text_messages_statement(project_id, terms, limit - len(ranked)))).all()
+        ranked += [_whole_message_match(message, rank) for message, rank in legacy_rows]
+    return _text_matches(ranked)
+
+async def aget_latest_review_snapshot(db: AsyncSession, project_id: int, file_name: str) -> models.ReviewSnapshot | None:
+    return (await db.execute(_latest_snapshot_statement(project_id, file_name))).scalars().first()
+
+async def aget_latest_review_snapshots(db: AsyncSession, project_id: int, file_names: List[str]) -> dict:
+    """複数のファイルについて、最後にレビューしたときのスナップショットを1回のクエリで取得し、{ファイル名: スナップショット} で返します。"""
+    if not file_names:
+        return {}
+    statement = select(models.ReviewSnapshot).where(
+        models.ReviewSnapshot.project_id == project_id,
+        models.ReviewSnapshot.file_name.in_(file_names),
+    ).distinct(models.ReviewSnapshot.file_name).order_by(
+        models.ReviewSnapshot.file_name, models.ReviewSnapshot.created_at.desc(), models.ReviewSnapshot.id.desc()
+    )
+    return {snapshot.file_name: snapshot for snapshot in (await db.execute(statement)).scalars().all()}
+
+async def acreate_review_records(db: AsyncSession, project_id: int, records: List[dict]) -> List[models.Conversation]:
+    """create_review_records の非同期版です。"""
+    conversations, objects = [], []
+    try:
+        for record in records:
+            db_conversation = models.Conversation(project_id=project_id, title=record["title"])
+            db.add(db_conversation)
+            await db.flush()
+            record_objects = _review_record_objects(project_id, db_conversation.id, record)
+            db.add_all(record_objects)
+            conversations.append(db_conversation)
+            objects += record_objects
+        await db.commit()
+    except Exception:
+        await db.rollback()
+        raise
+    _update_local_index_for(objects)
+    return conversations
+
+async def aget_review_job(db: AsyncSession, job_id: str) -> models.ReviewJob | None:
+    return await db.get(models.ReviewJob, job_id)
@@ -1,23 +1,77 @@
 # backend/database.py
 
 import os
-from sqlalchemy import create_engine
+import re
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from dotenv import load_dotenv
 
+from db_metrics import InstrumentedAsyncAdaptedQueuePool, InstrumentedQueuePool, instrument
+
 # .envファイルから環境変数を読み込む
 load_dotenv()
 
 # 環境変数からデータベースURLを取得
 SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL")
 
+# --- 接続プールの設定（環境変数で上書き可能） ---
+# 常に保持しておく接続数と、混雑時に一時的に追加で開く接続数の上限
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+# 空きの接続を待つ秒数。超えると QueuePool limit ... overflow ... のエラーになる
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+# この秒数より古い接続は使う前に張り直す（DB側やロードバランサーのアイドル切断への対策）。-1なら張り直さない
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+# 使う前に接続が生きているかを確かめる（切れていれば張り直す）
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+# 非同期エンジンは別のプールを持つ。省略時は同期エンジンと同じ大きさ（DBの max_connections は両方の合計で見積もる）
+ASYNC_DB_POOL_SIZE = int(os.getenv("ASYNC_DB_POOL_SIZE", str(DB_POOL_SIZE)))
+ASYNC_DB_MAX_OVERFLOW = int(os.getenv("ASYNC_DB_MAX_OVERFLOW", str(DB_MAX_OVERFLOW)))
+
+def _pool_options(pool_size: int, max_overflow: int) -> dict:
+    return {
+        "pool_size": pool_size,
+        "max_overflow": max_overflow,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+    }
+
 # データベースへの接続エンジンを作成
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
+_sync_pool_options = _pool_options(DB_POOL_SIZE, DB_MAX_OVERFLOW)
+engine = create_engine(
+    SQLALCHEMY_DATABASE_URL, poolclass=InstrumentedQueuePool, pool_logging_name="sync", **_sync_pool_options
+)
+instrument(engine, "sync", **_sync_pool_options)
 
 # データベースセッションを作成するためのクラス
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# --- async なエンドポイント用の非同期エンジン（asyncpg） ---
+def _async_database_url(url: str) -> str:
+    """DATABASE_URL を asyncpg 用のURLに変換します（sslmode は asyncpg では ssl という名前になる）。"""
+    url = re.sub(r"^postgres(?:ql)?(?:\+\w+)?://", "postgresql+asyncpg://", url)
+    return re.sub(r"([?&])sslmode=", r"\1ssl=", url)
+
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL") or _async_database_url(SQLALCHEMY_DATABASE_URL)
+
+_async_pool_options = _pool_options(ASYNC_DB_POOL_SIZE, ASYNC_DB_MAX_OVERFLOW)
+async_engine = create_async_engine(
+    ASYNC_DATABASE_URL, poolclass=InstrumentedAsyncAdaptedQueuePool, pool_logging_name="async", **_async_pool_options
+)
+instrument(async_engine.sync_engine, "async", **_async_pool_options)
+
+@event.listens_for(async_engine.sync_engine, "connect")
+def _register_vector_type(dbapi_connection, connection_record):
+    # asyncpg で pgvector の vector 型を読み書きできるようにする
+    from pgvector.asyncpg import register_vector
+    dbapi_connection.run_async(register_vector)
+
+# コミット後に属性を読み直すと（遅延読み込みができないため）エラーになるので、expire_on_commit は無効にする
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
 # データベースモデル（テーブルの定義）を作成するためのベースクラス
 Base = declarative_base()
 
@@ -27,4 +81,9 @@ def get_db():
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+# --- async なエンドポイントが AsyncSession を取得するための関数 ---
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
@@ -0,0 +1,141 @@
+# backend/db_metrics.py
+
+import os
+import time
+import threading
+from collections import deque
+from typing import Any, Dict
+
+from sqlalchemy import event, exc
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+import metrics_service
+
+# --- 設定値（環境変数で上書き可能） ---
+# これ以上かかったクエリをログに出し、メトリクスの recent_slow_queries に残す（ミリ秒）。0なら記録しない
+DB_SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", "500"))
+
+# メトリクスに残す遅いクエリの件数と、1件あたりのSQLの文字数（パラメータにはコードや会話が入るため残さない）
+_SLOW_QUERY_HISTORY = 20
+_STATEMENT_PREVIEW_CHARS = 300
+
+_lock = threading.Lock()
+_engines: Dict[str, Any] = {}
+_settings: Dict[str, Dict[str, Any]] = {}
+_stats: Dict[str, Dict[str, Any]] = {}
+
+
+def _new_stats() -> Dict[str, Any]:
+    return {
+        "checkouts": 0, "checkout_seconds_total": 0.0, "checkout_seconds_max": 0.0, "checkout_timeouts": 0,
+        "queries": 0, "query_seconds_total": 0.0, "slow_queries": 0,
+        "recent_slow_queries": deque(maxlen=_SLOW_QUERY_HISTORY),
+    }
+
+
+def _stats_for(name: str) -> Dict[str, Any]:
+    with _lock:
+        return _stats.setdefault(name, _new_stats())
+
+
+class _InstrumentedPoolMixin:
+    """
+    プールから接続を取り出すまでの時間（空きを待つ時間と、新しく接続する時間）と、待ちきれずに失敗した回数を記録します。
+    メトリクスの項目名には pool_logging_name を使う（dispose() でプールが作り直されても引き継がれるため）。
+    """
+
+    def _do_get(self):
+        stats = _stats_for(self.logging_name or "default")
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            with _lock:
+                stats["checkout_timeouts"] += 1
+            print(f"--- DEBUG: Timed out waiting for a connection from the '{self.logging_name}' pool ({self.status()}). ---")
+            raise
+        finally:
+            seconds = time.perf_counter() - started
+            with _lock:
+                stats["checkouts"] += 1
+                stats["checkout_seconds_total"] += seconds
+                stats["checkout_seconds_max"] = max(stats["checkout_seconds_max"], seconds)
+
+
+class InstrumentedQueuePool(_InstrumentedPoolMixin, QueuePool):
+    pass
+
+
+class InstrumentedAsyncAdaptedQueuePool(_InstrumentedPoolMixin, AsyncAdaptedQueuePool):
+    pass
+
+
+def instrument(engine, name: str, **settings) -> None:
+    """
+    エンジンの実行するクエリの時間を計測し、遅いクエリを記録します（非同期エンジンは sync_engine を渡す）。
+    settings にはプールの設定を渡し、メトリクスにそのまま表示します。
+    """
+    stats = _stats_for(name)
+    with _lock:
+        _engines[name] = engine
+        _settings[name] = settings
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - conn.info["query_started"].pop()
+        slow = DB_SLOW_QUERY_MS > 0 and seconds * 1000 >= DB_SLOW_QUERY_MS
+        with _lock:
+            stats["queries"] += 1
+            stats["query_seconds_total"] += seconds
+            if slow:
+                stats["slow_queries"] += 1
+                stats["recent_slow_queries"].append({
+                    "ms": round(seconds * 1000, 1),
+                    "statement": " ".join(statement.split())[:_STATEMENT_PREVIEW_CHARS],
+                    "executemany": executemany,
+                    "at": time.time(),
+                })
+        if slow:
+            print(f"--- DEBUG: Slow query on '{name}' took {seconds * 1000:.0f}ms: {' '.join(statement.split())[:_STATEMENT_PREVIEW_CHARS]} ---")
+
+    @event.listens_for(engine, "handle_error")
+    def _handle_error(exception_context):
+        # 失敗したクエリでは after_cursor_execute が呼ばれないため、開始時刻をここで捨てる
+        conn = exception_context.connection
+        if conn is not None and conn.info.get("query_started"):
+            conn.info["query_started"].pop()
+
+
+def _engine_stats(name: str) -> Dict[str, Any]:
+    pool = _engines[name].pool
+    stats = dict(_stats[name])
+    checkouts, queries = stats["checkouts"], stats["queries"]
+    return {
+        **_settings[name],
+        "pool_class": type(pool).__name__,
+        # checked_out が pool_size + max_overflow に張り付いていれば、プールの大きさが足りていない
+        "checked_out": pool.checkedout(),
+        "checked_in": pool.checkedin(),
+        "overflow": pool.overflow(),
+        "checkouts": checkouts,
+        "checkout_timeouts": stats["checkout_timeouts"],
+        "avg_checkout_ms": round(stats["checkout_seconds_total"] / checkouts * 1000, 2) if checkouts else 0.0,
+        "max_checkout_ms": round(stats["checkout_seconds_max"] * 1000, 2),
+        "queries": queries,
+        "avg_query_ms": round(stats["query_seconds_total"] / queries * 1000, 2) if queries else 0.0,
+        "slow_queries": stats["slow_queries"],
+        "recent_slow_queries": list(stats["recent_slow_queries"]),
+    }
+
+
+def database_stats() -> Dict[str, Any]:
+    with _lock:
+        names = list(_engines)
+        return {"slow_query_ms": DB_SLOW_QUERY_MS, **{name: _engine_stats(name) for name in names}}
+
+
+metrics_service.register("database", database_stats)
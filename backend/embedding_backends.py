@@ -0,0 +1,93 @@
+# backend/embedding_backends.py
+
+import os
+from typing import List, Optional
+
+# "torch": sentence-transformers(PyTorch) / "onnx": ONNX Runtime + int8量子化モデル
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch").lower()
+# ONNX版で使うモデルファイル（Hugging Faceのリポジトリ内のパス）。CPUに合わせて変更できる
+# 例: onnx/model_quint8_avx2.onnx / onnx/model_qint8_avx512_vnni.onnx / onnx/model_qint8_arm64.onnx
+EMBEDDING_ONNX_FILE = os.getenv("EMBEDDING_ONNX_FILE", "onnx/model_quint8_avx2.onnx")
+# ダウンロードせずにローカルのファイルを使う場合のパス（tokenizer.json は同じディレクトリか親ディレクトリに置く）
+EMBEDDING_ONNX_PATH = os.getenv("EMBEDDING_ONNX_PATH")
+EMBEDDING_ONNX_THREADS = int(os.getenv("EMBEDDING_ONNX_THREADS", "0"))  # 0ならONNX Runtimeの既定値
+# all-MiniLM-L6-v2 の max_seq_length と同じ値にして、PyTorch版と同じ位置で切り詰める
+EMBEDDING_MAX_TOKENS = int(os.getenv("EMBEDDING_MAX_TOKENS", "256"))
+
+
+class TorchBackend:
+    """sentence-transformers(PyTorch) でベクトル化する従来の実装。"""
+
+    name = "torch"
+
+    def __init__(self, model_name: str):
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model_name)
+
+    def encode(self, texts: List[str]) -> List[List[float]]:
+        return self.model.encode(texts, convert_to_numpy=True, batch_size=max(len(texts), 1)).tolist()
+
+
+class OnnxBackend:
+    """
+    同じモデルを int8 量子化したONNX版で、PyTorchを読み込まずにベクトル化する実装。
+    sentence-transformers と同じく、トークンの平均プーリングとL2正規化を行い、384次元の互換なベクトルを返す。
+    """
+
+    def __init__(self, model_name: str):
+        import numpy as np
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        self._np = np
+        model_path, tokenizer_path = self._resolve_files(model_name)
+        # 量子化の方式が異なるファイルのベクトルは互いに少しずつ異なるため、ファイル名で区別する
+        self.name = f"onnx:{os.path.basename(model_path)}"
+        options = onnxruntime.SessionOptions()
+        if EMBEDDING_ONNX_THREADS > 0:
+            options.intra_op_num_threads = EMBEDDING_ONNX_THREADS
+        self.session = onnxruntime.InferenceSession(model_path, sess_options=options, providers=["CPUExecutionProvider"])
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+
+        self.tokenizer = Tokenizer.from_file(tokenizer_path)
+        self.tokenizer.enable_truncation(max_length=EMBEDDING_MAX_TOKENS)
+        self.tokenizer.enable_padding()
+
+    @staticmethod
+    def _resolve_files(model_name: str):
+        if EMBEDDING_ONNX_PATH:
+            model_dir = os.path.dirname(EMBEDDING_ONNX_PATH)
+            for directory in (model_dir, os.path.dirname(model_dir)):
+                tokenizer_path = os.path.join(directory, "tokenizer.json")
+                if os.path.exists(tokenizer_path):
+                    return EMBEDDING_ONNX_PATH, tokenizer_path
+            raise FileNotFoundError(f"tokenizer.json was not found next to {EMBEDDING_ONNX_PATH}")
+
+        from huggingface_hub import hf_hub_download
+        repo_id = model_name if "/" in model_name else f"sentence-transformers/{model_name}"
+        return hf_hub_download(repo_id, EMBEDDING_ONNX_FILE), hf_hub_download(repo_id, "tokenizer.json")
+
+    def encode(self, texts: List[str]) -> List[List[float]]:
+        np = self._np
+        encodings = self.tokenizer.encode_batch(texts)
+        input_ids = np.array([encoding.ids for encoding in encodings], dtype=np.int64)
+        attention_mask = np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64)
+        inputs = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in self.input_names:
+            inputs["token_type_ids"] = np.array([encoding.type_ids for encoding in encodings], dtype=np.int64)
+
+        token_embeddings = self.session.run(None, inputs)[0]
+        mask = attention_mask[:, :, None].astype(token_embeddings.dtype)
+        pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        normalized = pooled / np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+        return normalized.astype(np.float32).tolist()
+
+
+_BACKENDS = {"torch": TorchBackend, "onnx": OnnxBackend}
+
+
+def load_backend(model_name: str, backend_name: Optional[str] = None):
+    backend_name = (backend_name or EMBEDDING_BACKEND).lower()
+    if backend_name not in _BACKENDS:
+        raise ValueError(f"Unknown embedding backend: {backend_name} (choose from {', '.join(_BACKENDS)})")
+    return _BACKENDS[backend_name](model_name)
@@ -0,0 +1,123 @@
+# backend/incremental_review.py
+
+import os
+import difflib
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+import patch_service
+from review_planner import ChunkPart, ReviewChunk, estimate_tokens
+
+# 変更箇所の前後に含めるコンテキストの行数
+REVIEW_INCREMENTAL_CONTEXT_LINES = int(os.getenv("REVIEW_INCREMENTAL_CONTEXT_LINES", "10"))
+# 変更された行の割合がこれを超える場合は、差分レビューをせずに全体をレビューし直す
+REVIEW_INCREMENTAL_MAX_CHANGE_RATIO = float(os.getenv("REVIEW_INCREMENTAL_MAX_CHANGE_RATIO", "0.5"))
+
+
+@dataclass
+class CodeDiff:
+    """前回レビューしたコードと今回のコードの行単位の対応関係。"""
+    old_lines: List[str]
+    new_lines: List[str]
+    # 前回の行番号(1始まり) → 今回の行番号。変更・削除された行は含まれない
+    line_map: Dict[int, int] = field(default_factory=dict)
+    # 今回のコードで変更・追加された行の範囲 (開始行, 終了行)、1始まりで両端を含む
+    changed_ranges: List[Tuple[int, int]] = field(default_factory=list)
+
+    @property
+    def has_changes(self) -> bool:
+        return bool(self.changed_ranges) or len(self.line_map) != len(self.old_lines)
+
+    @property
+    def change_ratio(self) -> float:
+        changed = sum(end - start + 1 for start, end in self.changed_ranges)
+        removed = len(self.old_lines) - len(self.line_map)
+        return (changed + removed) / max(len(self.new_lines), len(self.old_lines), 1)
+
+
+def diff_code(old_code: str, new_code: str) -> CodeDiff:
+    old_lines = old_code.split("\n")
+    new_lines = new_code.split("\n")
+    diff = CodeDiff(old_lines, new_lines)
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            for offset in range(i2 - i1):
+                diff.line_map[i1 + offset + 1] = j1 + offset + 1
+        elif j2 > j1:
+            diff.changed_ranges.append((j1 + 1, j2))
+        else:
+            # 削除のみの場合は、削除位置の直後の行を変更箇所として扱う
+            line = min(j1 + 1, len(new_lines))
+            diff.changed_ranges.append((line, line))
+    return diff
+
+
+def review_windows(diff: CodeDiff, context: Optional[int] = None) -> List[Tuple[int, int]]:
+    """変更箇所に前後のコンテキストを付け、重なる範囲をまとめたレビュー対象の範囲を返す。"""
+    context = REVIEW_INCREMENTAL_CONTEXT_LINES if context is None else context
+    windows: List[Tuple[int, int]] = []
+    for start, end in diff.changed_ranges:
+        start = max(1, start - context)
+        end = min(len(diff.new_lines), end + context)
+        if windows and start <= windows[-1][1] + 1:
+            windows[-1] = (windows[-1][0], max(windows[-1][1], end))
+        else:
+            windows.append((start, end))
+    return windows
+
+
+def build_chunk(file_name: str, diff: CodeDiff, windows: List[Tuple[int, int]]) -> ReviewChunk:
+    """レビュー対象の範囲を、review_planner と同じ形式のチャンクにまとめる。"""
+    chunk = ReviewChunk()
+    for start, end in windows:
+        content = "\n".join(diff.new_lines[start - 1:end])
+        chunk.parts.append(ChunkPart(file_name, start, content, partial=True))
+        chunk.tokens += estimate_tokens(content)
+    return chunk
+
+
+def _in_windows(line: int, windows: List[Tuple[int, int]]) -> bool:
+    return any(start <= line <= end for start, end in windows)
+
+
+def carry_forward_details(previous_details: List[dict], diff: CodeDiff, windows: List[Tuple[int, int]],
+                          old_code: str, new_code: str) -> List[dict]:
+    """
+    前回の指摘のうち、今回のレビュー対象範囲の外にあり行が残っているものを、
+    新しい行番号に付け替えて引き継ぐ。ファイル全体のコードの提案は、前回のコードとの差分として
+    今回のコードに適用し直し、適用できなければ提案を空にする。
+    """
+    carried = []
+    for detail in previous_details:
+        if detail.get("category") == "Error":
+            continue
+        line = detail.get("line_number")
+        if not isinstance(line, int) or line not in diff.line_map:
+            continue
+        new_line = diff.line_map[line]
+        if _in_windows(new_line, windows):
+            continue
+
+        detail = dict(detail)
+        detail["line_number"] = new_line
+        detail["carried_forward"] = True
+        suggestion = detail.get("suggestion") or ""
+        if suggestion and detail.get("suggestion_format") == "patch":
+            detail["suggestion"] = patch_service.shift_patch(suggestion, new_line - line)
+            detail["patch_valid"] = patch_service.is_valid_patch(new_code, detail["suggestion"])
+        elif suggestion:
+            detail["suggestion"] = _rebase_full_suggestion(old_code, new_code, suggestion)
+        carried.append(detail)
+    return carried
+
+
+def _rebase_full_suggestion(old_code: str, new_code: str, suggestion: str) -> str:
+    suggested = patch_service.strip_code_fence(suggestion)
+    patch = "\n".join(difflib.unified_diff(old_code.split("\n"), suggested.split("\n"), lineterm=""))
+    if not patch:
+        return new_code
+    try:
+        return patch_service.apply_patch(new_code, patch)
+    except patch_service.PatchError:
+        return ""
@@ -0,0 +1,342 @@
+# backend/local_vector_index.py
+
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, NamedTuple, Optional
+
+import numpy as np
+from sqlalchemy.sql import func
+
+import models
+import metrics_service
+from database import SessionLocal
+
+# --- 設定値（環境変数で上書き可能） ---
+# プロセス内のプロジェクト別ベクトルインデックスを使うか（ローカル・開発環境や、同じプロジェクトへの質問が続く場合向け）
+# 1プロセスで動かす前提。複数のプロセスで動かす場合、他のプロセスで保存されたベクトルは再読み込みまで反映されない
+LOCAL_VECTOR_INDEX_ENABLED = os.getenv("LOCAL_VECTOR_INDEX_ENABLED", "false").lower() == "true"
+# メモリに保持するプロジェクト数の上限。超えたら最も長く使われていないプロジェクトを書き出して解放する
+LOCAL_VECTOR_INDEX_MAX_PROJECTS = int(os.getenv("LOCAL_VECTOR_INDEX_MAX_PROJECTS", "32"))
+# 書き出したインデックス（np.load で memory-map して読み込む）の保存先
+LOCAL_VECTOR_INDEX_DIR = os.getenv("LOCAL_VECTOR_INDEX_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".vector_index"))
+# この秒数を過ぎたインデックスは、次の検索時にデータベースとの差分を確認して読み込み直す
+LOCAL_VECTOR_INDEX_TTL_SECONDS = float(os.getenv("LOCAL_VECTOR_INDEX_TTL_SECONDS", "600"))
+
+_INITIAL_CAPACITY = 256
+# 削除済みの行がこの割合を超えたら詰め直す
+_COMPACT_RATIO = 0.25
+
+
+class LocalHit(NamedTuple):
+    message_id: int
+    chunk_id: Optional[int]  # メッセージ全体のベクトル（部分を持たない古いメッセージ）の場合は None
+    distance: float
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.clip(norms, 1e-12, None)
+
+
+class ProjectIndex:
+    """
+    1つのプロジェクトのベクトルを、正規化済みの連続した float32 行列として保持する。
+    検索は行列とクエリの内積1回（= コサイン類似度）で全件を評価する。
+    """
+
+    def __init__(self, project_id: int, matrix: np.ndarray, message_ids: np.ndarray, chunk_ids: np.ndarray, watermark: tuple):
+        self.project_id = project_id
+        self._lock = threading.RLock()
+        self._matrix = matrix  # memory-map したスナップショットの場合は読み取り専用で、最初の追加時にメモリへ複製する
+        self._message_ids = message_ids
+        self._chunk_ids = chunk_ids  # -1 はメッセージ全体のベクトル
+        self._valid = np.ones(len(message_ids), dtype=bool)
+        self._size = len(message_ids)
+        self.watermark = watermark
+        self.loaded_at = time.monotonic()
+        self.dirty = False
+
+    @property
+    def rows(self) -> int:
+        return int(self._valid[:self._size].sum())
+
+    def _ensure_capacity(self, extra: int) -> None:
+        needed, capacity = self._size + extra, len(self._matrix)
+        if needed > capacity:
+            capacity = max(needed, capacity * 2, _INITIAL_CAPACITY)
+        elif not isinstance(self._matrix, np.memmap):
+            return
+        matrix = np.zeros((capacity, self._matrix.shape[1]), dtype=np.float32)
+        matrix[:self._size] = self._matrix[:self._size]
+        self._matrix = matrix
+        for name in ("_message_ids", "_chunk_ids", "_valid"):
+            old = getattr(self, name)
+            grown = np.zeros(capacity, dtype=old.dtype)
+            grown[:self._size] = old[:self._size]
+            setattr(self, name, grown)
+
+    def replace_message(self, message_id: int, rows: List[tuple]) -> None:
+        """メッセージのベクトルを置き換える。rows は (chunk_id または None, ベクトル) のリスト。"""
+        with self._lock:
+            self._valid[:self._size][self._message_ids[:self._size] == message_id] = False
+            if rows:
+                self._ensure_capacity(len(rows))
+                start, end = self._size, self._size + len(rows)
+                self._matrix[start:end] = _normalize(np.asarray([vector for _, vector in rows], dtype=np.float32))
+                self._message_ids[start:end] = message_id
+                self._chunk_ids[start:end] = [-1 if chunk_id is None else chunk_id for chunk_id, _ in rows]
+                self._valid[start:end] = True
+                self._size = end
+            self.dirty = True
+            if self._size and 1 - self.rows / self._size > _COMPACT_RATIO:
+                self._compact()
+
+    def _compact(self) -> None:
+        keep = np.flatnonzero(self._valid[:self._size])
+        self._matrix = np.ascontiguousarray(self._matrix[keep])
+        self._message_ids = self._message_ids[keep]
+        self._chunk_ids = self._chunk_ids[keep]
+        self._valid = np.ones(len(keep), dtype=bool)
+        self._size = len(keep)
+
+    def search(self, query: np.ndarray, limit: int) -> List[LocalHit]:
+        """メッセージごとに最も近い部分を1つだけ採用し、距離の近い順に limit 件返す。"""
+        with self._lock:
+            if self._size == 0:
+                return []
+            scores = self._matrix[:self._size] @ query
+            scores[~self._valid[:self._size]] = -np.inf
+            # 同じメッセージの部分が上位を占めても limit 件のメッセージが揃うよう、多めに候補を取る
+            candidates = min(limit * 4, self._size)
+            top = np.argpartition(-scores, candidates - 1)[:candidates]
+            top = top[np.argsort(-scores[top])]
+            hits, seen = [], set()
+            for row in top:
+                message_id = int(self._message_ids[row])
+                if not np.isfinite(scores[row]) or message_id in seen:
+                    continue
+                seen.add(message_id)
+                chunk_id = int(self._chunk_ids[row])
+                hits.append(LocalHit(message_id, None if chunk_id < 0 else chunk_id, float(1.0 - scores[row])))
+                if len(hits) >= limit:
+                    break
+            return hits
+
+    def save(self, directory: str) -> None:
+        """スナップショットを書き出す（書き込み途中のファイルを読まないよう、一時ファイルに書いてから置き換える）。"""
+        with self._lock:
+            self._compact()
+            os.makedirs(directory, exist_ok=True)
+            base = os.path.join(directory, f"project_{self.project_id}")
+            for suffix, array in (("vectors", self._matrix[:self._size]), ("message_ids", self._message_ids), ("chunk_ids", self._chunk_ids)):
+                with open(f"{base}.{suffix}.npy.tmp", "wb") as f:
+                    np.save(f, np.ascontiguousarray(array))
+                os.replace(f"{base}.{suffix}.npy.tmp", f"{base}.{suffix}.npy")
+            with open(f"{base}.json.tmp", "w") as f:
+                json.dump({"watermark": list(self.watermark), "rows": self._size}, f)
+            os.replace(f"{base}.json.tmp", f"{base}.json")
+            self.dirty = False
+
+    @classmethod
+    def load_snapshot(cls, directory: str, project_id: int) -> Optional["ProjectIndex"]:
+        base = os.path.join(directory, f"project_{project_id}")
+        try:
+            with open(f"{base}.json") as f:
+                meta = json.load(f)
+            matrix = np.load(f"{base}.vectors.npy", mmap_mode="r")
+            message_ids = np.load(f"{base}.message_ids.npy")
+            chunk_ids = np.load(f"{base}.chunk_ids.npy")
+        except (OSError, ValueError):
+            return None
+        if len(message_ids) != meta.get("rows") or len(matrix) != len(message_ids):
+            return None
+        return cls(project_id, matrix, message_ids, chunk_ids, tuple(meta["watermark"]))
+
+
+def _watermark(db, project_id: int) -> tuple:
+    """スナップショットがデータベースと一致しているかを確かめるための、行数と最大IDの組。"""
+    chunk_count, chunk_max = db.query(
+        func.count(models.MessageChunk.id), func.max(models.MessageChunk.id)
+    ).filter(models.MessageChunk.project_id == project_id).one()
+    message_count, message_max = db.query(
+        func.count(models.Message.id), func.max(models.Message.id)
+    ).filter(models.Message.project_id == project_id, models.Message.embedding.isnot(None)).one()
+    return (chunk_count or 0, chunk_max or 0, message_count or 0, message_max or 0)
+
+
+def _load_from_database(db, project_id: int, watermark: tuple) -> ProjectIndex:
+    chunk_rows = db.query(models.MessageChunk.id, models.MessageChunk.message_id, models.MessageChunk.embedding).filter(
+        models.MessageChunk.project_id == project_id,
+    ).all()
+    # 部分のベクトルを持たない古いメッセージは、メッセージ全体のベクトルを使う
+    message_rows = db.query(models.Message.id, models.Message.embedding).filter(
+        models.Message.project_id == project_id,
+        models.Message.embedding.isnot(None),
+        ~models.Message.chunks.any(),
+    ).all()
+    vectors = [embedding for _, _, embedding in chunk_rows] + [embedding for _, embedding in message_rows]
+    matrix = _normalize(np.asarray(vectors, dtype=np.float32)) if vectors else np.zeros((0, 384), dtype=np.float32)
+    message_ids = np.asarray([message_id for _, message_id, _ in chunk_rows] + [message_id for message_id, _ in message_rows], dtype=np.int64)
+    chunk_ids = np.asarray([chunk_id for chunk_id, _, _ in chunk_rows] + [-1] * len(message_rows), dtype=np.int64)
+    return ProjectIndex(project_id, np.ascontiguousarray(matrix), message_ids, chunk_ids, watermark)
+
+
+class LocalVectorIndex:
+    """プロジェクトごとの ProjectIndex を、最近使われた順に上限まで保持する。"""
+
+    def __init__(self, max_projects: int, directory: str):
+        self.max_projects = max(max_projects, 1)
+        self.directory = directory
+        self._indexes: "OrderedDict[int, ProjectIndex]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._loading = set()
+        # 読み込み中のプロジェクトに届いた置き換え。読み込んだデータより新しい可能性があるため、登録前に適用し直す
+        self._pending: Dict[int, List[tuple]] = {}
+        # 読み込みは検索の応答を待たせないよう、専用のスレッドで1件ずつ行う
+        self._loader = ThreadPoolExecutor(max_workers=1, thread_name_prefix="vector-index")
+        self._stats = {"hits": 0, "misses": 0, "loads_from_snapshot": 0, "loads_from_database": 0, "evictions": 0,
+                       "appends": 0, "search_seconds_total": 0.0}
+
+    def _get(self, project_id: int) -> Optional[ProjectIndex]:
+        with self._lock:
+            index = self._indexes.get(project_id)
+            if index is not None:
+                self._indexes.move_to_end(project_id)
+            return index
+
+    def search(self, project_id: int, query_embedding: List[float], limit: int) -> Optional[List[LocalHit]]:
+        """
+        メモリ上のインデックスで検索します。まだ読み込まれていない（または古くなった）場合は、
+        裏で読み込みを始めて None を返すため、呼び出し元は pgvector での検索に切り替えてください。
+        """
+        index = self._get(project_id)
+        if index is None or time.monotonic() - index.loaded_at > LOCAL_VECTOR_INDEX_TTL_SECONDS:
+            self._stats["misses"] += 1
+            self.schedule_load(project_id)
+            if index is None:
+                return None
+        started = time.perf_counter()
+        query = _normalize(np.asarray(query_embedding, dtype=np.float32))
+        hits = index.search(query, limit)
+        self._stats["hits"] += 1
+        self._stats["search_seconds_total"] += time.perf_counter() - started
+        return hits
+
+    def schedule_load(self, project_id: int) -> None:
+        with self._lock:
+            if project_id in self._loading:
+                return
+            self._loading.add(project_id)
+        self._loader.submit(self._load, project_id)
+
+    def _load(self, project_id: int) -> None:
+        db = SessionLocal()
+        try:
+            watermark = _watermark(db, project_id)
+            current = self._get(project_id)
+            if current is not None and current.watermark == watermark:
+                current.loaded_at = time.monotonic()
+                return
+            # 書き出したスナップショットがデータベースと一致していれば、ベクトルを読まずに memory-map で使う
+            index = ProjectIndex.load_snapshot(self.directory, project_id)
+            if index is not None and index.watermark == watermark:
+                self._stats["loads_from_snapshot"] += 1
+            else:
+                index = _load_from_database(db, project_id, watermark)
+                index.dirty = True
+                self._stats["loads_from_database"] += 1
+            self._put(index)
+        except Exception as e:
+            print(f"--- DEBUG: Failed to load the local vector index for project {project_id}: {e} ---")
+        finally:
+            db.close()
+            with self._lock:
+                self._loading.discard(project_id)
+                self._pending.pop(project_id, None)
+
+    def _put(self, index: ProjectIndex) -> None:
+        evicted = []
+        with self._lock:
+            pending = self._pending.pop(index.project_id, [])
+            for message_id, rows in pending:
+                index.replace_message(message_id, rows)
+            if pending:
+                index.watermark = None
+            self._indexes[index.project_id] = index
+            self._indexes.move_to_end(index.project_id)
+            while len(self._indexes) > self.max_projects:
+                evicted.append(self._indexes.popitem(last=False)[1])
+        for old in evicted:
+            self._stats["evictions"] += 1
+            self._save(old)
+
+    def _save(self, index: ProjectIndex) -> None:
+        if not index.dirty:
+            return
+        try:
+            if index.watermark is None:
+                # 追加した分を含めた現在の値で書き出す（1プロセスで動かす前提では、インデックスとデータベースは一致している）
+                db = SessionLocal()
+                try:
+                    index.watermark = _watermark(db, index.project_id)
+                finally:
+                    db.close()
+            index.save(self.directory)
+        except Exception as e:
+            print(f"--- DEBUG: Failed to save the local vector index for project {index.project_id}: {e} ---")
+
+    def replace_message(self, project_id: Optional[int], message_id: int, rows: List[tuple]) -> None:
+        """
+        保存されたメッセージのベクトルを、読み込み済みのインデックスに反映します（crud から呼ばれる）。
+        読み込まれていないプロジェクトは何もしない（次の読み込み時にデータベースから取り込まれる）。
+        読み込み中のプロジェクトは、読み込んだインデックスを登録する前に同じ置き換えを適用し直す。
+        """
+        if project_id is None:
+            return
+        with self._lock:
+            index = self._indexes.get(project_id)
+            if project_id in self._loading:
+                self._pending.setdefault(project_id, []).append((message_id, rows))
+        if index is None:
+            return
+        index.replace_message(message_id, rows)
+        # 書き込み後の行数・最大IDは分からないため、次に古くなったときはデータベースから読み込み直す
+        index.watermark = None
+        self._stats["appends"] += 1
+
+    def drop_project(self, project_id: int) -> None:
+        with self._lock:
+            self._indexes.pop(project_id, None)
+        base = os.path.join(self.directory, f"project_{project_id}")
+        for suffix in ("json", "vectors.npy", "message_ids.npy", "chunk_ids.npy"):
+            try:
+                os.remove(f"{base}.{suffix}")
+            except OSError:
+                pass
+
+    def save_all(self) -> None:
+        """アプリケーション終了時に、変更のあったインデックスをすべて書き出します。"""
+        with self._lock:
+            indexes = list(self._indexes.values())
+        for index in indexes:
+            self._save(index)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            projects = {project_id: index.rows for project_id, index in self._indexes.items()}
+        hits = self._stats["hits"]
+        return {
+            "enabled": LOCAL_VECTOR_INDEX_ENABLED,
+            "projects": len(projects),
+            "rows": sum(projects.values()),
+            **self._stats,
+            "avg_search_ms": round(self._stats["search_seconds_total"] / hits * 1000, 4) if hits else 0.0,
+        }
+
+
+local_index = LocalVectorIndex(LOCAL_VECTOR_INDEX_MAX_PROJECTS, LOCAL_VECTOR_INDEX_DIR)
+metrics_service.register("local_vector_index", local_index.stats)
@@ -1,4 +1,7 @@
 import os
+import json
+import time
+import copy
 import asyncio
 from datetime import datetime
 from collections import defaultdict
@@ -6,9 +9,10 @@ import threading
 import traceback
 
 from fastapi import FastAPI, HTTPException, Depends, Header, Request, APIRouter
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List, Dict, Optional
 from pydantic import BaseModel
 
@@ -21,11 +25,19 @@ import snyk_service
 import cross_check_service
 import github_service
 import memory_service
+import metrics_service
+import patch_service
+import review_pipeline
+import review_jobs
+import migrations
+import local_vector_index
+import conversation_memory
 from auth import auth_verifier
 
-from database import SessionLocal, engine
+from database import SessionLocal, AsyncSessionLocal, engine, get_async_db
 
 models.Base.metadata.create_all(bind=engine)
+migrations.run_startup(engine)
 
 app = FastAPI(redirect_slashes=False)
 
@@ -53,6 +65,34 @@ async def global_exception_handler(request: Request, exc: Exception):
         },
     )
 
+@app.on_event("startup")
+async def start_embedding_batcher():
+    memory_service.embedding_batcher.start()
+
+@app.on_event("shutdown")
+async def stop_embedding_batcher():
+    await memory_service.embedding_batcher.stop()
+
+@app.on_event("startup")
+async def start_review_job_workers():
+    review_jobs.start_workers(on_project_result=_save_review_conversation)
+
+@app.on_event("shutdown")
+async def stop_review_job_workers():
+    await review_jobs.stop_workers()
+
+@app.on_event("shutdown")
+async def stop_conversation_summaries():
+    await conversation_memory.stop()
+
+@app.on_event("shutdown")
+async def save_local_vector_index():
+    await asyncio.to_thread(local_vector_index.local_index.save_all)
+
+@app.on_event("shutdown")
+async def close_ai_clients():
+    await ai_partner.aclose_clients()
+
 api_router = APIRouter(prefix="/api")
 
 # --- 共通のDependency ---
@@ -123,69 +163,96 @@ def update_project_order(update_data: schemas.ProjectOrderUpdate, db: Session =
 def reorder_projects_endpoint(reorder_data: schemas.ProjectReorderRequest, db: Session = Depends(get_db)):
     return crud.reorder_projects(db=db, user_id=reorder_data.user_id, sort_by=reorder_data.sort_by)
 
-# --- 監査とテストのエンドポイント ---
-@api_router.post("/projects/{project_id}/inspect", dependencies=[Depends(auth_verifier)])
-async def inspect_code(project_id: int, request: schemas.CodeInspectionRequest, db: Session = Depends(get_db)):
-    project = crud.get_project(db, project_id=project_id)
-    if not project:
-        raise HTTPException(status_code=404, detail="Project not found")
-    
-    files_dict = {f"pasted_code.txt": request.code}
-    tasks = [
-        ai_partner.generate_structured_review(files=files_dict, linter_results="", mode="balanced"),
-        ai_partner.generate_structured_review(files=files_dict, linter_results="", mode="strict_audit"),
-    ]
-    results = await asyncio.gather(*tasks, return_exceptions=True)
-    ai_models = ["Gemini (Balanced)", "GPT-4o (Strict Audit)"]
-    inspection_results = []
-    for i, res in enumerate(results):
-        if isinstance(res, Exception):
-            inspection_results.append({"model_name": ai_models[i], "error": str(res)})
-        else:
-            inspection_results.append({"model_name": ai_models[i], "review": res})
-            
+# --- レビュー結果を会話として保存するヘルパー ---
+def _review_summary(inspection_results: List[Dict]) -> str:
+    return "\n".join(
+        f"- {res['model_name']}: {res['review']['summary']}" 
+        for res in inspection_results if 'review' in res and 'summary' in res['review']
+    )
+
+def _save_review_conversation(db: Session, project_id: int, code: str, inspection_results: List[Dict], file_name: str = "pasted_code.txt"):
     try:
         title = f"Review at {datetime.now().strftime('%Y-%m-%d %H:%M')}"
         conversation_schema = schemas.ConversationCreate(project_id=project_id, title=title)
         db_conversation = crud.create_conversation(db=db, conversation=conversation_schema)
 
-        user_message_schema = schemas.MessageCreate(role="user", content=request.code)
+        user_message_schema = schemas.MessageCreate(role="user", content=code)
         db_user_message = crud.create_message(db=db, message=user_message_schema, conversation_id=db_conversation.id)
-        user_embedding = memory_service.generate_embedding(request.code)
-        crud.update_message_embedding(db=db, message_id=db_user_message.id, embedding=user_embedding)
+        user_chunks = memory_service.generate_message_chunks(code)
+        crud.update_message_embedding(db=db, message_id=db_user_message.id, chunks=user_chunks)
         
-        review_summary = "\n".join(
-            f"- {res['model_name']}: {res['review']['summary']}" 
-            for res in inspection_results if 'review' in res and 'summary' in res['review']
-        )
+        review_summary = _review_summary(inspection_results)
         assistant_message_schema = schemas.MessageCreate(role="assistant", content=f"AIレビューが完了しました。\n{review_summary}")
         db_assistant_message = crud.create_message(db=db, message=assistant_message_schema, conversation_id=db_conversation.id)
-        assistant_embedding = memory_service.generate_embedding(review_summary)
-        crud.update_message_embedding(db=db, message_id=db_assistant_message.id, embedding=assistant_embedding)
+        assistant_chunks = memory_service.generate_message_chunks(assistant_message_schema.content)
+        crud.update_message_embedding(db=db, message_id=db_assistant_message.id, chunks=assistant_chunks)
         
+        # 次回の差分レビューのために、今回のコードと結果を保存する
+        crud.create_review_snapshot(
+            db=db, project_id=project_id, file_name=file_name, code=code,
+            results=inspection_results, conversation_id=db_conversation.id
+        )
+
         print(f"--- DEBUG: Saved and vectorized conversation {db_conversation.id} for project {project_id} ---")
 
     except Exception as e:
         print(f"--- DEBUG: ERROR - Failed to save or vectorize conversation: {e} ---")
 
+async def _asave_review_conversation(db: AsyncSession, project_id: int, code: str, inspection_results: List[Dict], file_name: str = "pasted_code.txt"):
+    """_save_review_conversation の非同期版。会話・メッセージ・ベクトル・スナップショットを1つのトランザクションで保存する。"""
+    try:
+        assistant_content = f"AIレビューが完了しました。\n{_review_summary(inspection_results)}"
+        record = {
+            "title": f"Review at {datetime.now().strftime('%Y-%m-%d %H:%M')}",
+            "file_name": file_name,
+            "code": code,
+            "assistant_content": assistant_content,
+            "results": inspection_results,
+            "user_chunks": await memory_service.embed_message_chunks(code),
+            "assistant_chunks": await memory_service.embed_message_chunks(assistant_content),
+        }
+        conversations = await crud.acreate_review_records(db, project_id, [record])
+        print(f"--- DEBUG: Saved and vectorized conversation {conversations[0].id} for project {project_id} ---")
+
+    except Exception as e:
+        print(f"--- DEBUG: ERROR - Failed to save or vectorize conversation: {e} ---")
+
+def _incremental_review_factory(snapshot, file_name: str, code: str, suggestion_format: str):
+    """前回のレビュー結果があれば、変更された箇所だけをレビューし直すための review_factory を返す。"""
+    previous_reviews = {res["model_name"]: res["review"] for res in snapshot.results if "review" in res} if snapshot else {}
+
+    def review_task(target: review_pipeline.ReviewTarget):
+        if target.label in previous_reviews:
+            return ai_partner.generate_incremental_review(
+                previous_code=snapshot.code, previous_review=previous_reviews[target.label], code=code,
+                file_name=file_name, mode=target.mode, suggestion_format=suggestion_format
+            )
+        return ai_partner.generate_structured_review(files={file_name: code}, linter_results="", mode=target.mode, suggestion_format=suggestion_format)
+
+    return review_task
+
+# --- 監査とテストのエンドポイント ---
+@api_router.post("/projects/{project_id}/inspect", dependencies=[Depends(auth_verifier)])
+async def inspect_code(project_id: int, request: schemas.CodeInspectionRequest, db: AsyncSession = Depends(get_async_db)):
+    project = await crud.aget_project(db, project_id=project_id)
+    if not project:
+        raise HTTPException(status_code=404, detail="Project not found")
+    
+    file_name = "pasted_code.txt"
+    files_dict = {file_name: request.code}
+
+    snapshot = await crud.aget_latest_review_snapshot(db, project_id=project_id, file_name=file_name)
+    review_task = _incremental_review_factory(snapshot, file_name, request.code, request.suggestion_format)
+    inspection_results = await review_pipeline.ReviewPipeline().run(files_dict, review_factory=review_task)
+
+    await _asave_review_conversation(db, project_id, request.code, inspection_results, file_name)
+
     return inspection_results
 
 @api_router.post("/inspect/public", dependencies=[Depends(rate_limiter)])
 async def public_inspect_code(request: schemas.CodeInspectionRequest):
     files_dict = {f"pasted_code.txt": request.code}
-    tasks = [
-        ai_partner.generate_structured_review(files=files_dict, linter_results="", mode="balanced"),
-        ai_partner.generate_structured_review(files=files_dict, linter_results="", mode="strict_audit"),
-    ]
-    results = await asyncio.gather(*tasks, return_exceptions=True)
-    ai_models = ["Gemini (Balanced)", "GPT-4o (Strict Audit)"]
-    inspection_results = []
-    for i, res in enumerate(results):
-        if isinstance(res, Exception):
-            inspection_results.append({"model_name": ai_models[i], "error": str(res)})
-        else:
-            inspection_results.append({"model_name": ai_models[i], "review": res})
-    return inspection_results
+    return await review_pipeline.ReviewPipeline().run(files_dict, suggestion_format=request.suggestion_format)
 
 @api_router.post("/tests/generate", dependencies=[Depends(auth_verifier)])
 async def generate_test(request: schemas.GenerateTestRequest):
@@ -228,82 +295,351 @@ async def scan_with_snyk(request: schemas.SnykScanRequest):
 @api_router.post("/inspect/consolidated", dependencies=[Depends(rate_limiter)])
 async def consolidated_inspect_code(request: schemas.CodeInspectionRequest):
     files_dict = {f"pasted_code.txt": request.code}
-    tasks = [
-        ai_partner.generate_structured_review(files=files_dict, linter_results="", mode="balanced"),
-        ai_partner.generate_structured_review(files=files_dict, linter_results="", mode="strict_audit"),
-    ]
-    results = await asyncio.gather(*tasks, return_exceptions=True)
-    
-    ai_models = ["Gemini (Balanced)", "GPT-4o (Strict Audit)"]
-    raw_results = []
-    for i, res in enumerate(results):
-        if isinstance(res, Exception):
-            raw_results.append({"model_name": ai_models[i], "error": str(res)})
-        else:
-            raw_results.append({"model_name": ai_models[i], "review": res})
+    raw_results = await review_pipeline.ReviewPipeline().run(files_dict, suggestion_format=request.suggestion_format)
 
     consolidated_issues = cross_check_service.consolidate_reviews(raw_results)
     
     return {"consolidated_issues": consolidated_issues}
 
 @api_router.post("/projects/{project_id}/inspect/consolidated", dependencies=[Depends(auth_verifier)])
-async def consolidated_inspect_code_authenticated(project_id: int, request: schemas.CodeInspectionRequest, db: Session = Depends(get_db)):
-    project = crud.get_project(db, project_id=project_id)
+async def consolidated_inspect_code_authenticated(project_id: int, request: schemas.CodeInspectionRequest, db: AsyncSession = Depends(get_async_db)):
+    project = await crud.aget_project(db, project_id=project_id)
     if not project:
         raise HTTPException(status_code=404, detail="Project not found")
     
     files_dict = {f"pasted_code.txt": request.code}
-    tasks = [
-        ai_partner.generate_structured_review(files=files_dict, linter_results="", mode="balanced"),
-        ai_partner.generate_structured_review(files=files_dict, linter_results="", mode="strict_audit"),
-    ]
-    results = await asyncio.gather(*tasks, return_exceptions=True)
-    
-    ai_models = ["Gemini (Balanced)", "GPT-4o (Strict Audit)"]
-    raw_results = []
-    for i, res in enumerate(results):
-        if isinstance(res, Exception):
-            raw_results.append({"model_name": ai_models[i], "error": str(res)})
-        else:
-            raw_results.append({"model_name": ai_models[i], "review": res})
+    raw_results = await review_pipeline.ReviewPipeline().run(files_dict, suggestion_format=request.suggestion_format)
 
     consolidated_issues = cross_check_service.consolidate_reviews(raw_results)
     
     return {"consolidated_issues": consolidated_issues}
 
+# --- ストリーミング(SSE)版の監査エンドポイント ---
+STREAM_REVIEW_TARGETS = [(target.mode, target.label) for target in review_pipeline.REVIEW_TARGETS]
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+def _sse_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+async def _stream_review_events(files_dict: Dict[str, str], suggestion_format: str = "full", on_complete=None):
+    """
+    複数モデルのレビューを並行してストリーミングし、SSEイベントとして順次返す。
+    - issue: 指摘事項が1件完成するたびに送信
+    - consolidated: その時点までの全モデルの指摘を consolidate_reviews で集約した結果
+    - review: 1つのモデルのレビューが完了（または失敗）したときに送信
+    - done: 全モデルの完了後に、最終結果と集約結果をまとめて送信
+    締め切り(REVIEW_PIPELINE_DEADLINE_SECONDS)までに完了しなかったモデルはタイムアウトとして扱う。
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+    partial_reviews = {label: {"details": []} for _, label in STREAM_REVIEW_TARGETS}
+    final_results = {}
+
+    async def pump(mode: str, label: str):
+        try:
+            async for kind, payload in ai_partner.stream_structured_review(
+                files=files_dict, linter_results="", mode=mode, suggestion_format=suggestion_format
+            ):
+                await queue.put((label, kind, payload))
+        except Exception as e:
+            await queue.put((label, "error", str(e)))
+        finally:
+            await queue.put((label, "end", None))
+
+    def consolidate_partial():
+        raw_results = [{"model_name": label, "review": review} for label, review in partial_reviews.items()]
+        return cross_check_service.consolidate_reviews(copy.deepcopy(raw_results))
+
+    tasks = [asyncio.create_task(pump(mode, label)) for mode, label in STREAM_REVIEW_TARGETS]
+    remaining = len(tasks)
+    deadline = time.monotonic() + review_pipeline.REVIEW_PIPELINE_DEADLINE_SECONDS
+    try:
+        while remaining:
+            try:
+                label, kind, payload = await asyncio.wait_for(queue.get(), timeout=max(deadline - time.monotonic(), 0))
+            except asyncio.TimeoutError:
+                for _, label in STREAM_REVIEW_TARGETS:
+                    if label not in final_results:
+                        final_results[label] = {
+                            "model_name": label,
+                            "error": f"Review did not complete within {review_pipeline.REVIEW_PIPELINE_DEADLINE_SECONDS:g} seconds.",
+                            "timed_out": True,
+                        }
+                        yield _sse_event("review", final_results[label])
+                break
+            if kind == "end":
+                remaining -= 1
+            elif kind == "issue":
+                partial_reviews[label]["details"].append(payload)
+                yield _sse_event("issue", {"model_name": label, "issue": payload})
+                yield _sse_event("consolidated", {"consolidated_issues": consolidate_partial()})
+            elif kind == "review":
+                partial_reviews[label] = payload
+                final_results[label] = {"model_name": label, "review": payload}
+                yield _sse_event("review", final_results[label])
+                yield _sse_event("consolidated", {"consolidated_issues": consolidate_partial()})
+            else:
+                final_results[label] = {"model_name": label, "error": payload}
+                yield _sse_event("review", final_results[label])
+
+        inspection_results = [final_results[label] for _, label in STREAM_REVIEW_TARGETS if label in final_results]
+        consolidated_issues = cross_check_service.consolidate_reviews(copy.deepcopy(inspection_results))
+        yield _sse_event("done", {"results": inspection_results, "consolidated_issues": consolidated_issues})
+        if on_complete:
+            await on_complete(inspection_results)
+    finally:
+        # クライアントが切断した場合も、実行中のモデル呼び出しを確実に止める
+        for task in tasks:
+            task.cancel()
+
+@api_router.post("/inspect/stream", dependencies=[Depends(rate_limiter)])
+async def public_inspect_code_stream(request: schemas.CodeInspectionRequest):
+    files_dict = {f"pasted_code.txt": request.code}
+    return StreamingResponse(
+        _stream_review_events(files_dict, suggestion_format=request.suggestion_format),
+        media_type="text/event-stream",
+        headers=SSE_HEADERS,
+    )
+
+@api_router.post("/projects/{project_id}/inspect/stream", dependencies=[Depends(auth_verifier)])
+async def inspect_code_stream(project_id: int, request: schemas.CodeInspectionRequest, db: AsyncSession = Depends(get_async_db)):
+    project = await crud.aget_project(db, project_id=project_id)
+    if not project:
+        raise HTTPException(status_code=404, detail="Project not found")
+
+    async def save_results(inspection_results):
+        # ストリーミング中はDependencyのセッションが既に閉じられているため、専用のセッションを使う
+        async with AsyncSessionLocal() as stream_db:
+            await _asave_review_conversation(stream_db, project_id, request.code, inspection_results)
+
+    files_dict = {f"pasted_code.txt": request.code}
+    return StreamingResponse(
+        _stream_review_events(files_dict, suggestion_format=request.suggestion_format, on_complete=save_results),
+        media_type="text/event-stream",
+        headers=SSE_HEADERS,
+    )
+
+# --- 複数ファイルの一括監査エンドポイント ---
+# 同時にレビューするファイル数の上限（各ファイルはさらに複数モデルに並行して依頼される）
+REVIEW_BATCH_CONCURRENCY = int(os.getenv("REVIEW_BATCH_CONCURRENCY", "4"))
+REVIEW_BATCH_MAX_ITEMS = int(os.getenv("REVIEW_BATCH_MAX_ITEMS", "100"))
+
+async def _review_batch_items(items: List[schemas.BatchInspectionItem], snapshots: Dict, suggestion_format: str, on_item_done=None):
+    """
+    ファイルごとのレビューを REVIEW_BATCH_CONCURRENCY 件ずつ並行して実行し、
+    完了した順に (入力の位置, 結果) を返す。on_item_done を渡すと、各ファイルの結果を返す前に保存などを行う。
+    """
+    semaphore = asyncio.Semaphore(REVIEW_BATCH_CONCURRENCY)
+
+    async def review_item(index: int, item: schemas.BatchInspectionItem):
+        async with semaphore:
+            review_task = _incremental_review_factory(snapshots.get(item.file_name), item.file_name, item.code, suggestion_format)
+            results = await review_pipeline.ReviewPipeline().run({item.file_name: item.code}, review_factory=review_task)
+            consolidated_issues = cross_check_service.consolidate_reviews(copy.deepcopy(results))
+            item_result = {
+                "file_name": item.file_name,
+                "language": item.language,
+                "results": results,
+                "consolidated_issues": consolidated_issues,
+            }
+            if on_item_done is not None:
+                # クライアントが切断して残りのタスクがキャンセルされても、終わったレビューの保存は最後まで行う
+                await asyncio.shield(on_item_done(item, item_result))
+        return index, item_result
+
+    tasks = [asyncio.ensure_future(review_item(index, item)) for index, item in enumerate(items)]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def _asave_batch_results(db: AsyncSession, project_id: int, item_results: List[Dict]):
+    """一括監査の結果を、1回のベクトル化と1つのトランザクションでまとめて保存する（一括監査では1ファイルずつ呼ばれる）。"""
+    assistant_contents = [f"AIレビューが完了しました。\n{_review_summary(item['results'])}" for item in item_results]
+    # ベクトル化でイベントループをブロックしないよう、ワーカースレッドで実行する
+    chunk_lists = await asyncio.to_thread(
+        memory_service.generate_message_chunks_many, [item["code"] for item in item_results] + assistant_contents
+    )
+    title = f"Review at {datetime.now().strftime('%Y-%m-%d %H:%M')}"
+    records = [
+        {
+            "title": f"{title} ({item['file_name']})",
+            "file_name": item["file_name"],
+            "code": item["code"],
+            "assistant_content": assistant_content,
+            "results": item["results"],
+            "user_chunks": chunk_lists[index],
+            "assistant_chunks": chunk_lists[len(item_results) + index],
+        }
+        for index, (item, assistant_content) in enumerate(zip(item_results, assistant_contents))
+    ]
+    try:
+        await crud.acreate_review_records(db, project_id, records)
+        print(f"--- DEBUG: Saved {len(records)} batch reviews for project {project_id} in one transaction ---")
+    except Exception as e:
+        print(f"--- DEBUG: ERROR - Failed to save batch reviews: {e} ---")
+
+@api_router.post("/projects/{project_id}/inspect/batch", dependencies=[Depends(auth_verifier)])
+async def batch_inspect_code(project_id: int, request: schemas.BatchInspectionRequest, db: AsyncSession = Depends(get_async_db)):
+    project = await crud.aget_project(db, project_id=project_id)
+    if not project:
+        raise HTTPException(status_code=404, detail="Project not found")
+    if not request.items:
+        raise HTTPException(status_code=400, detail="No items to inspect.")
+    if len(request.items) > REVIEW_BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"Too many items. The maximum is {REVIEW_BATCH_MAX_ITEMS}.")
+
+    snapshots = await crud.aget_latest_review_snapshots(db, project_id=project_id, file_names=sorted({item.file_name for item in request.items}))
+
+    async def save_item(item: schemas.BatchInspectionItem, item_result: Dict):
+        # ファイルごとにレビューが終わった時点で保存する（ストリーミング中はDependencyのセッションが閉じられているため、専用のセッションを使う）
+        async with AsyncSessionLocal() as batch_db:
+            await _asave_batch_results(batch_db, project_id, [{**item_result, "code": item.code}])
+
+    if request.stream:
+        async def events():
+            # 1ファイルのレビューが終わるたびに item イベントを送り、最後に done イベントを送る
+            indexed_results = {}
+            async for index, item_result in _review_batch_items(request.items, snapshots, request.suggestion_format, save_item):
+                indexed_results[index] = item_result
+                yield _sse_event("item", {"index": index, **item_result})
+            yield _sse_event("done", {"items": [indexed_results[index] for index in sorted(indexed_results)]})
+
+        return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+    indexed_results = {}
+    async for index, item_result in _review_batch_items(request.items, snapshots, request.suggestion_format, save_item):
+        indexed_results[index] = item_result
+    return {"items": [indexed_results[index] for index in sorted(indexed_results)]}
+
+# --- 非同期レビュージョブのエンドポイント ---
+# 投稿するとすぐにジョブIDを返し、レビューはワーカーが実行する。結果はポーリングかSSEで受け取る
+@api_router.post("/jobs/inspect", status_code=202, dependencies=[Depends(rate_limiter)])
+def submit_public_inspect_job(request: schemas.CodeInspectionRequest, db: Session = Depends(get_db)):
+    job = review_jobs.submit_review_job(db, code=request.code, suggestion_format=request.suggestion_format)
+    return {"job_id": job.id, "status": job.status}
+
+@api_router.post("/projects/{project_id}/jobs/inspect", status_code=202, dependencies=[Depends(auth_verifier)])
+def submit_inspect_job(project_id: int, request: schemas.CodeInspectionRequest, db: Session = Depends(get_db)):
+    project = crud.get_project(db, project_id=project_id)
+    if not project:
+        raise HTTPException(status_code=404, detail="Project not found")
+    job = review_jobs.submit_review_job(db, code=request.code, suggestion_format=request.suggestion_format, project_id=project_id)
+    return {"job_id": job.id, "status": job.status}
+
+def _visible_job(job, project_id: Optional[int]):
+    # プロジェクトのジョブは、認証付きのプロジェクト配下のURLからだけ読めるようにする（ジョブIDを知っているだけでは読めない）
+    if job is None or job.project_id != project_id:
+        return None
+    return review_jobs.job_to_dict(job)
+
+def _read_review_job(db: Session, job_id: str, project_id: Optional[int] = None):
+    job = _visible_job(crud.get_review_job(db, job_id=job_id), project_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+async def _stream_review_job(job_id: str, project_id: Optional[int] = None):
+    async def load_job():
+        # ポーリングのたびに最新の状態を読むよう、毎回新しいセッションを使う
+        async with AsyncSessionLocal() as job_db:
+            return _visible_job(await crud.aget_review_job(job_db, job_id=job_id), project_id)
+
+    if await load_job() is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    async def events():
+        # 状態が変わるたびに status イベントを送り、完了したら done イベントで結果を送る
+        last_status = None
+        while True:
+            job = await load_job()
+            if job is None:
+                return
+            if job["status"] in review_jobs.FINISHED_STATUSES:
+                yield _sse_event("done", job)
+                return
+            if job["status"] != last_status:
+                last_status = job["status"]
+                yield _sse_event("status", {"job_id": job_id, "status": last_status, "attempts": job["attempts"]})
+            await asyncio.sleep(review_jobs.REVIEW_JOB_POLL_SECONDS)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+@api_router.get("/jobs/{job_id}")
+def read_review_job(job_id: str, db: Session = Depends(get_db)):
+    return _read_review_job(db, job_id)
+
+@api_router.get("/jobs/{job_id}/events")
+async def stream_review_job(job_id: str):
+    return await _stream_review_job(job_id)
+
+@api_router.get("/projects/{project_id}/jobs/{job_id}", dependencies=[Depends(auth_verifier)])
+def read_project_review_job(project_id: int, job_id: str, db: Session = Depends(get_db)):
+    return _read_review_job(db, job_id, project_id=project_id)
+
+@api_router.get("/projects/{project_id}/jobs/{job_id}/events", dependencies=[Depends(auth_verifier)])
+async def stream_project_review_job(project_id: int, job_id: str):
+    return await _stream_review_job(job_id, project_id=project_id)
+
+# --- 差分形式の提案をファイル全体に展開するエンドポイント ---
+# LLMを呼ばずにローカルで適用するだけなので、レビューの回数制限（rate_limiter）は使わない。入力の大きさは ApplyPatchRequest で制限する
+@api_router.post("/suggestions/apply")
+def apply_suggestion_patch(request: schemas.ApplyPatchRequest):
+    try:
+        revised_code = patch_service.apply_patch(request.original_code, request.patch)
+    except patch_service.PatchError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"revised_code": revised_code}
+
 @api_router.post("/chat", dependencies=[Depends(auth_verifier)])
-async def handle_chat(request: schemas.ChatRequest, db: Session = Depends(get_db)):
+async def handle_chat(request: schemas.ChatRequest, db: AsyncSession = Depends(get_async_db)):
     try:
-        db_conversation = crud.get_latest_conversation_by_project_id(db, project_id=request.project_id)
+        db_conversation = await crud.aget_latest_conversation_by_project_id(db, project_id=request.project_id)
         if not db_conversation:
             raise HTTPException(status_code=404, detail="Conversation not found. Please run a review first.")
 
+        question = request.message if request.message is not None else (
+            request.chat_history[-1].get('content', '') if request.chat_history else ''
+        )
+        if not question:
+            raise HTTPException(status_code=400, detail="A message is required.")
+
         # ユーザーのメッセージを保存し、ベクトル化
-        user_message_dict = request.chat_history[-1]
-        user_message_schema = schemas.MessageCreate(**user_message_dict)
-        db_user_message = crud.create_message(db, message=user_message_schema, conversation_id=db_conversation.id)
-        user_embedding = memory_service.generate_embedding(user_message_dict['content'])
-        crud.update_message_embedding(db=db, message_id=db_user_message.id, embedding=user_embedding)
+        user_message_schema = schemas.MessageCreate(role="user", content=question)
+        db_user_message = await crud.acreate_message(db, message=user_message_schema, conversation_id=db_conversation.id)
+        user_chunks = await memory_service.embed_message_chunks(question)
+        await crud.aupdate_message_embedding(db=db, message_id=db_user_message.id, chunks=user_chunks)
 
-        # AIからの応答を取得
+        # AIからの応答を取得（履歴はクライアントから送られたものではなく、サーバー側の要約と直近のメッセージを使う）
+        summary, chat_history = await conversation_memory.load_chat_context(db, db_conversation)
         ai_response_content = await ai_partner.continue_conversation(
             db=db,
             project_id=request.project_id,
-            chat_history=request.chat_history
+            chat_history=chat_history,
+            summary=summary,
         )
 
         # AIの応答を保存し、ベクトル化
         ai_message_schema = schemas.MessageCreate(role="assistant", content=ai_response_content)
-        db_ai_message = crud.create_message(db, message=ai_message_schema, conversation_id=db_conversation.id)
-        ai_embedding = memory_service.generate_embedding(ai_response_content)
-        crud.update_message_embedding(db=db, message_id=db_ai_message.id, embedding=ai_embedding)
+        db_ai_message = await crud.acreate_message(db, message=ai_message_schema, conversation_id=db_conversation.id)
+        ai_chunks = await memory_service.embed_message_chunks(ai_response_content)
+        await crud.aupdate_message_embedding(db=db, message_id=db_ai_message.id, chunks=ai_chunks)
         
         print(f"--- DEBUG: Saved and vectorized chat messages to conversation {db_conversation.id} ---")
+        conversation_memory.schedule_summary_update(db_conversation.id)
 
         return {"response": ai_response_content}
+    except HTTPException as e:
+        raise e
     except Exception as e:
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
+# --- 運用向けのメトリクス ---
+@api_router.get("/metrics", dependencies=[Depends(auth_verifier)])
+def read_metrics():
+    return metrics_service.snapshot()
+
 
 app.include_router(api_router)
\ No newline at end of file
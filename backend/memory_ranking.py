@@ -0,0 +1,61 @@
+# backend/memory_ranking.py
+
+import os
+import re
+from typing import Any, Dict, List
+
+# --- 語句検索とベクトル検索のハイブリッド検索で使う、DBやモデルに依存しない処理 ---
+
+# Reciprocal Rank Fusion の定数 k（大きいほど下位の候補の順位差を小さく扱う）
+MEMORY_RRF_K = int(os.getenv("MEMORY_RRF_K", "60"))
+
+# 関数名・クラス名・モジュールのパス（foo.bar, Foo::bar）など、コード中の識別子らしい語句
+_IDENTIFIER_PATTERN = re.compile(r"[A-Za-z_][A-Za-z0-9_]*(?:(?:\.|::)[A-Za-z_][A-Za-z0-9_]*)*")
+# 引用符やかぎ括弧で囲まれた部分（エラーメッセージなど）は、語の並びごと一致させる
+_QUOTED_PATTERN = re.compile(r"[\"'`「『]([^\"'`」』\n]{3,200})[\"'`」』]")
+_STOP_WORDS = {
+    "the", "and", "for", "are", "but", "not", "you", "all", "can", "this", "that", "with", "from", "have", "what",
+    "why", "how", "when", "where", "which", "does", "did", "was", "were", "will", "would", "should", "could",
+    "about", "there", "here", "into", "code", "error", "function", "please",
+}
+_MAX_LEXICAL_TERMS = 8
+
+
+def _looks_like_code(term: str) -> bool:
+    return any(c in term for c in "_.:") or any(c.isdigit() for c in term) or (term[1:] != term[1:].lower())
+
+
+def lexical_terms(question: str) -> List[str]:
+    """
+    質問から全文検索に使う語句を取り出す。引用された文字列、識別子らしい語句、その他の英単語の順に優先する。
+    日本語の文はベクトル検索に任せ、ここでは対象にしない。
+    """
+    quoted = [phrase.strip() for phrase in _QUOTED_PATTERN.findall(question or "")]
+    words = [word for word in _IDENTIFIER_PATTERN.findall(question or "") if len(word) >= 3 and word.lower() not in _STOP_WORDS]
+    ordered = quoted + [word for word in words if _looks_like_code(word)] + [word for word in words if not _looks_like_code(word)]
+
+    terms, seen = [], set()
+    for term in ordered:
+        if term and term.lower() not in seen:
+            seen.add(term.lower())
+            terms.append(term)
+    return terms[:_MAX_LEXICAL_TERMS]
+
+
+def reciprocal_rank_fusion(result_lists: List[List[Any]], limit: int, k: int = MEMORY_RRF_K) -> List[Any]:
+    """
+    複数の検索結果を、各結果での順位 r から 1 / (k + r) を合計したスコアで統合する（Reciprocal Rank Fusion）。
+    距離とスコアの尺度が違う検索同士でも、順位だけで公平に統合できる。
+    各結果の要素は crud.MessageMatch（message.id で同じメッセージを判定する）。
+    同じメッセージが複数の結果にある場合は、最も順位が高かった結果の一致部分を採用する。
+    """
+    scores: Dict[int, float] = {}
+    best: Dict[int, tuple] = {}
+    for matches in result_lists:
+        for rank, match in enumerate(matches, start=1):
+            message_id = match.message.id
+            scores[message_id] = scores.get(message_id, 0.0) + 1.0 / (k + rank)
+            if message_id not in best or rank < best[message_id][0]:
+                best[message_id] = (rank, match)
+    ordered = sorted(scores, key=lambda message_id: scores[message_id], reverse=True)
+    return [best[message_id][1] for message_id in ordered[:limit]]
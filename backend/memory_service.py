@@ -1,53 +1,356 @@
 # backend/memory_service.py
 
-from sentence_transformers import SentenceTransformer
-from typing import List
-from sqlalchemy.orm import Session
+import os
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+from sqlalchemy.ext.asyncio import AsyncSession
 import crud # crudをインポート
+import cache_service
+import embedding_backends
+import metrics_service
+import context_packer
+from memory_ranking import MEMORY_RRF_K, lexical_terms, reciprocal_rank_fusion
+from database import AsyncSessionLocal
+from review_planner import split_text
 
-print("--- LOADING SentenceTransformer model. This may take a moment on first run... ---")
-model = SentenceTransformer('all-MiniLM-L6-v2')
-print("--- SentenceTransformer model LOADED. ---")
+EMBEDDING_MODEL_NAME = 'all-MiniLM-L6-v2'
 
+print(f"--- LOADING embedding model ({embedding_backends.EMBEDDING_BACKEND} backend). This may take a moment on first run... ---")
+backend = embedding_backends.load_backend(EMBEDDING_MODEL_NAME)
+print("--- Embedding model LOADED. ---")
+# int8量子化版のベクトルは元のモデルとわずかに異なるため、キャッシュはバックエンドごとに分ける
+EMBEDDING_CACHE_MODEL_ID = f"{EMBEDDING_MODEL_NAME}:{backend.name}"
 
-def generate_embedding(text: str) -> List[float]:
+# --- ベクトル化のマイクロバッチ設定（環境変数で上書き可能） ---
+# 1回のモデル呼び出しでまとめてベクトル化するテキストの最大数
+EMBEDDING_BATCH_MAX_SIZE = int(os.getenv("EMBEDDING_BATCH_MAX_SIZE", "32"))
+# 最初のテキストが届いてから、同じバッチに入れる他のテキストを待つ最大時間（ミリ秒）
+EMBEDDING_BATCH_MAX_WAIT_MS = float(os.getenv("EMBEDDING_BATCH_MAX_WAIT_MS", "5"))
+# メッセージを部分に分けるときの1部分のトークン数の目安（モデルが切り詰める256トークンより小さくする）
+EMBEDDING_CHUNK_TOKENS = int(os.getenv("EMBEDDING_CHUNK_TOKENS", "160"))
+
+# --- 記憶の検索の設定（環境変数で上書き可能） ---
+# "hybrid": 語句検索とベクトル検索を並行して実行し、順位を統合する / "vector": ベクトル検索のみ（従来の動作）
+MEMORY_RETRIEVAL_MODE = os.getenv("MEMORY_RETRIEVAL_MODE", "hybrid").lower()
+# 統合する前に、それぞれの検索から取得する候補の数
+MEMORY_RETRIEVAL_CANDIDATES = int(os.getenv("MEMORY_RETRIEVAL_CANDIDATES", "10"))
+
+
+def _encode(texts: List[str]) -> List[List[float]]:
+    return backend.encode(texts)
+
+
+def _fail_future(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_exception(RuntimeError("The embedding batcher was stopped before this text was embedded."))
+
+
+class EmbeddingBatcher:
     """
-    与えられたテキストからベクトル（embedding）を生成します。
+    同時に届いたベクトル化の依頼を非同期キューでまとめ、専用のスレッドで1回のモデル呼び出しとして実行する。
+    イベントループはベクトル化の間ブロックされず、依頼ごとのFutureに結果が返される。
     """
-    if not text or not isinstance(text, str):
+
+    def __init__(self, max_batch_size: int, max_wait_seconds: float):
+        self.max_batch_size = max(max_batch_size, 1)
+        self.max_wait_seconds = max_wait_seconds
+        # モデルはスレッドセーフではないため、ベクトル化は常に1本のスレッドで順に行う
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embedding")
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stats = {"batches": 0, "texts": 0, "max_batch_size": 0, "encode_seconds_total": 0.0, "queue_wait_seconds_total": 0.0}
+
+    def start(self) -> None:
+        """実行中のイベントループでバッチ処理のタスクを起動します（起動済みなら何もしない）。"""
+        loop = asyncio.get_running_loop()
+        if self._loop is loop and self._task is not None and not self._task.done():
+            return
+        self._loop = loop
+        self._queue = asyncio.Queue()
+        self._task = loop.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        # キューに残った依頼は処理されないため、待っている呼び出し元が止まったままにならないよう失敗させる
+        if self._queue is not None:
+            while not self._queue.empty():
+                _, future, _ = self._queue.get_nowait()
+                _fail_future(future)
+
+    async def embed_many(self, texts: List[str]) -> List[List[float]]:
+        self.start()
+        futures = []
+        for text in texts:
+            future = self._loop.create_future()
+            self._queue.put_nowait((text, future, time.monotonic()))
+            futures.append(future)
+        return list(await asyncio.gather(*futures))
+
+    def embed_many_blocking(self, texts: List[str]) -> List[List[float]]:
+        """
+        同期的な呼び出し元のための入口。ワーカースレッドから呼ばれた場合はバッチ処理のキューに載せて結果を待ち、
+        イベントループが動いていない（または実行中のループ上から呼ばれた）場合はその場でベクトル化する。
+        """
+        try:
+            asyncio.get_running_loop()
+            in_event_loop = True
+        except RuntimeError:
+            in_event_loop = False
+        if self._loop is None or not self._loop.is_running() or in_event_loop:
+            return _encode(texts)
+        return asyncio.run_coroutine_threadsafe(self.embed_many(texts), self._loop).result()
+
+    async def _run(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            try:
+                # 少しだけ待って、同時に届いた他の依頼も同じバッチに入れる
+                if self._queue.qsize() < self.max_batch_size - 1 and self.max_wait_seconds > 0:
+                    await asyncio.sleep(self.max_wait_seconds)
+                while len(batch) < self.max_batch_size and not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                await self._encode_batch(batch)
+            except asyncio.CancelledError:
+                # 停止された場合、キューから取り出し済みの依頼も失敗させる
+                for _, future, _ in batch:
+                    _fail_future(future)
+                raise
+
+    async def _encode_batch(self, batch) -> None:
+        pending = [(text, future, queued_at) for text, future, queued_at in batch if not future.done()]
+        if not pending:
+            return
+        started = time.monotonic()
+        try:
+            vectors = await self._loop.run_in_executor(self._executor, _encode, [text for text, _, _ in pending])
+        except Exception as e:
+            for _, future, _ in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finished = time.monotonic()
+
+        self._stats["batches"] += 1
+        self._stats["texts"] += len(pending)
+        self._stats["max_batch_size"] = max(self._stats["max_batch_size"], len(pending))
+        self._stats["encode_seconds_total"] += finished - started
+        self._stats["queue_wait_seconds_total"] += sum(started - queued_at for _, _, queued_at in pending)
+        for (_, future, _), vector in zip(pending, vectors):
+            if not future.done():
+                future.set_result(vector)
+
+    def stats(self) -> Dict[str, Any]:
+        batches, texts = self._stats["batches"], self._stats["texts"]
+        return {
+            **self._stats,
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "avg_batch_size": round(texts / batches, 2) if batches else 0.0,
+            "avg_queue_wait_seconds": round(self._stats["queue_wait_seconds_total"] / texts, 4) if texts else 0.0,
+        }
+
+
+embedding_batcher = EmbeddingBatcher(EMBEDDING_BATCH_MAX_SIZE, EMBEDDING_BATCH_MAX_WAIT_MS / 1000)
+metrics_service.register("embeddings", embedding_batcher.stats)
+
+
+def _is_embeddable(text: Any) -> bool:
+    return bool(text) and isinstance(text, str)
+
+
+def _plan_embeddings(texts: List[str]):
+    """ベクトル化が必要なテキストを、内容のハッシュで重複を除いて {キー: テキスト} にまとめる。"""
+    keys = [cache_service.make_embedding_key(text, EMBEDDING_CACHE_MODEL_ID) if _is_embeddable(text) else None for text in texts]
+    unique = {key: text for key, text in zip(keys, texts) if key is not None}
+    return keys, unique
+
+
+def _assemble_embeddings(keys: List[Optional[str]], vectors: Dict[str, List[float]]) -> List[List[float]]:
+    return [list(vectors[key]) if key is not None else [] for key in keys]
+
+
+async def embed_texts(texts: List[str]) -> List[List[float]]:
+    """
+    複数のテキストのベクトルを、イベントループをブロックせずに生成します。空のテキストには空のリストを返します。
+    ベクトルキャッシュにない分だけを、他のリクエストの依頼とまとめて1回のモデル呼び出しで処理します。
+    """
+    keys, unique = _plan_embeddings(texts)
+    vectors = await cache_service.aget_embeddings(unique)
+    missing = [key for key in unique if key not in vectors]
+    if missing:
+        encoded = dict(zip(missing, await embedding_batcher.embed_many([unique[key] for key in missing])))
+        await cache_service.aset_embeddings(encoded, EMBEDDING_CACHE_MODEL_ID)
+        vectors.update(encoded)
+    return _assemble_embeddings(keys, vectors)
+
+
+async def embed_text(text: str) -> List[float]:
+    """1つのテキストのベクトルを生成します（embed_texts を参照）。"""
+    return (await embed_texts([text]))[0]
+
+
+def generate_embeddings(texts: List[str]) -> List[List[float]]:
+    """
+    複数のテキストのベクトルを1回のモデル呼び出しでまとめて生成します。空のテキストには空のリストを返します。
+    ベクトルキャッシュにあるテキストはモデルを呼び出しません。
+    """
+    keys, unique = _plan_embeddings(texts)
+    vectors = cache_service.get_embeddings(unique)
+    missing = [key for key in unique if key not in vectors]
+    if missing:
+        encoded = dict(zip(missing, embedding_batcher.embed_many_blocking([unique[key] for key in missing])))
+        cache_service.set_embeddings(encoded, EMBEDDING_CACHE_MODEL_ID)
+        vectors.update(encoded)
+    return _assemble_embeddings(keys, vectors)
+
+def _split_message(text: str) -> List[Dict[str, Any]]:
+    if not _is_embeddable(text):
         return []
-    embedding = model.encode(text, convert_to_numpy=True)
-    return embedding.tolist()
+    return [
+        {"chunk_index": index, "start_line": part.start_line, "end_line": part.end_line, "content": part.content}
+        for index, part in enumerate(split_text(text, EMBEDDING_CHUNK_TOKENS))
+        if part.content.strip()
+    ]
+
+
+def _attach_embeddings(chunk_lists: List[List[Dict[str, Any]]], vectors: List[List[float]]) -> List[List[Dict[str, Any]]]:
+    flat = iter(vectors)
+    for chunks in chunk_lists:
+        for chunk in chunks:
+            chunk["embedding"] = next(flat)
+    return chunk_lists
+
+
+def generate_message_chunks_many(texts: List[str]) -> List[List[Dict[str, Any]]]:
+    """
+    各メッセージを関数・クラスの境界（それでも大きければ行単位）でモデルが切り詰めない大きさの部分に分け、
+    全メッセージの部分をまとめてベクトル化します。
+    各部分は chunk_index, start_line, end_line, content, embedding を持つ辞書です。
+    """
+    chunk_lists = [_split_message(text) for text in texts]
+    vectors = generate_embeddings([chunk["content"] for chunks in chunk_lists for chunk in chunks])
+    return _attach_embeddings(chunk_lists, vectors)
+
+
+def generate_message_chunks(text: str) -> List[Dict[str, Any]]:
+    return generate_message_chunks_many([text])[0]
+
+
+async def embed_message_chunks(text: str) -> List[Dict[str, Any]]:
+    """generate_message_chunks の非同期版です。async なハンドラーからはこちらを使ってください。"""
+    chunk_lists = [_split_message(text)]
+    vectors = await embed_texts([chunk["content"] for chunk in chunk_lists[0]])
+    return _attach_embeddings(chunk_lists, vectors)[0]
 
 # ▼▼▼ 新しい関数を追加 ▼▼▼
-def find_relevant_memories(db: Session, project_id: int, user_question: str, limit: int = 3) -> str:
+def format_memories(matches: List[crud.MessageMatch]) -> str:
+    """見つかった記憶をAIが読みやすい形式のテキストに整形する。長いメッセージは、質問に一致した部分だけを行範囲付きで示す。"""
+    formatted_memories = "【参考：過去の関連する会話】\n"
+    for match in reversed(matches): # 新しいものから順に表示
+        msg = match.message
+        if match.content == msg.content:
+            formatted_memories += f"- {msg.role}: {msg.content}\n"
+        else:
+            formatted_memories += f"- {msg.role} (lines {match.start_line}-{match.end_line}): {match.content}\n"
+    return formatted_memories
+# ▲▲▲ ここまで追加 ▲▲▲
+
+
+# --- 語句検索とベクトル検索のハイブリッド検索 ---
+
+_retrieval_stats = {"searches": 0, "lexical_only": 0, "vector_only": 0, "both": 0, "returned": 0, "seconds_total": 0.0}
+
+
+async def search_memories_hybrid(db: AsyncSession, project_id: int, user_question: str, limit: int = 3,
+                                 query_embedding: Optional[List[float]] = None) -> List[crud.MessageMatch]:
     """
-    ユーザーの質問に基づいて、関連性の高い過去の会話（記憶）を検索して整形する。
+    語句検索（関数名やエラーメッセージの完全一致に強い）とベクトル検索（言い換えに強い）を並行して実行し、
+    Reciprocal Rank Fusion で統合した上位 limit 件の記憶を返します。
+    ベクトル検索は呼び出し元のセッションを使い、並行する語句検索だけ別のセッション（接続）を使います。
     """
-    print(f"--- DEBUG: Searching memories for project {project_id} with question: {user_question[:100]}... ---")
-    
-    # 1. ユーザーの質問をベクトル化する
-    query_embedding = generate_embedding(user_question)
-    if not query_embedding:
-        return ""
+    started = time.monotonic()
+    if query_embedding is None:
+        query_embedding = await embed_text(user_question)
+    terms = lexical_terms(user_question)
+    candidates = max(MEMORY_RETRIEVAL_CANDIDATES, limit)
+
+    # 1つのセッションでは同時に1つのクエリしか実行できないため、並行する語句検索には別のセッションを使う
+    async def vector_search():
+        if not query_embedding:
+            return []
+        return await crud.asearch_similar_messages(db, project_id, query_embedding, candidates)
+
+    async def lexical_search():
+        if not terms:
+            return []
+        async with AsyncSessionLocal() as lexical_db:
+            return await crud.asearch_messages_by_text(lexical_db, project_id, terms, candidates)
+
+    vector_matches, lexical_matches = await asyncio.gather(vector_search(), lexical_search())
+    fused = reciprocal_rank_fusion([vector_matches, lexical_matches], limit)
 
-    # 2. データベースで類似メッセージを検索する
-    similar_messages = crud.search_similar_messages(
-        db=db, 
-        project_id=project_id, 
-        query_embedding=query_embedding, 
-        limit=limit
-    )
+    vector_ids = {match.message.id for match in vector_matches}
+    lexical_ids = {match.message.id for match in lexical_matches}
+    _retrieval_stats["searches"] += 1
+    _retrieval_stats["returned"] += len(fused)
+    _retrieval_stats["seconds_total"] += time.monotonic() - started
+    for match in fused:
+        in_vector, in_lexical = match.message.id in vector_ids, match.message.id in lexical_ids
+        key = "both" if in_vector and in_lexical else "vector_only" if in_vector else "lexical_only"
+        _retrieval_stats[key] += 1
+    print(f"--- DEBUG: Hybrid memory search: {len(vector_matches)} vector / {len(lexical_matches)} lexical "
+          f"candidates (terms: {terms}) -> {len(fused)} memories. ---")
+    return fused
 
-    if not similar_messages:
+
+async def retrieve_relevant_memories(db: AsyncSession, project_id: int, user_question: str, limit: int = 3,
+                                     query_embedding: Optional[List[float]] = None) -> str:
+    """
+    ユーザーの質問に基づいて、関連性の高い過去の会話（記憶）を検索して整形します。
+    MEMORY_RETRIEVAL_MODE が "hybrid" の場合はハイブリッド検索を使います。
+    MEMORY_CONTEXT_TOKEN_BUDGET が設定されている場合は、多めに検索した候補から重複を除き、
+    関連する部分だけをトークン数の上限まで詰めます（この場合 limit は使いません）。
+    """
+    print(f"--- DEBUG: Searching memories for project {project_id} with question: {user_question[:100]}... ---")
+    if query_embedding is None:
+        query_embedding = await embed_text(user_question)
+    packing = context_packer.MEMORY_CONTEXT_TOKEN_BUDGET > 0
+    candidates = max(context_packer.MEMORY_CONTEXT_CANDIDATES, limit) if packing else limit
+
+    if MEMORY_RETRIEVAL_MODE == "hybrid":
+        matches = await search_memories_hybrid(db, project_id, user_question, limit=candidates, query_embedding=query_embedding)
+    elif query_embedding:
+        matches = await crud.asearch_similar_messages(db=db, project_id=project_id, query_embedding=query_embedding, limit=candidates)
+    else:
+        matches = []
+    if not matches:
         print("--- DEBUG: No relevant memories found. ---")
         return ""
+    if not packing:
+        return format_memories(matches)
 
-    # 3. 見つかった記憶をAIが読みやすい形式のテキストに整形する
-    formatted_memories = "【参考：過去の関連する会話】\n"
-    for msg in reversed(similar_messages): # 新しいものから順に表示
-        formatted_memories += f"- {msg.role}: {msg.content}\n"
-    
-    print(f"--- DEBUG: Found {len(similar_messages)} relevant memories. ---")
-    return formatted_memories
-# ▲▲▲ ここまで追加 ▲▲▲
\ No newline at end of file
+    packed = context_packer.pack_memories(matches, query_embedding, lexical_terms(user_question))
+    print(f"--- DEBUG: Packed {len(packed)} of {len(matches)} memories into {sum(m.tokens for m in packed)} tokens. ---")
+    if not packed:
+        return ""
+    # format_memories と同じく、最も関連する記憶が質問の直前に来るよう逆順に並べる
+    return "【参考：過去の関連する会話】\n" + "".join(memory.render() for memory in reversed(packed))
+
+
+def retrieval_stats() -> Dict[str, Any]:
+    searches = _retrieval_stats["searches"]
+    return {
+        "mode": MEMORY_RETRIEVAL_MODE,
+        "candidates": MEMORY_RETRIEVAL_CANDIDATES,
+        "rrf_k": MEMORY_RRF_K,
+        **_retrieval_stats,
+        "avg_seconds": round(_retrieval_stats["seconds_total"] / searches, 4) if searches else 0.0,
+    }
+
+
+metrics_service.register("memory_retrieval", retrieval_stats)
@@ -0,0 +1,32 @@
+# backend/metrics_service.py
+
+import threading
+from typing import Any, Callable, Dict
+
+# 各サービスが自身のメトリクスを返す関数を登録しておくレジストリ
+_collectors: Dict[str, Callable[[], Dict[str, Any]]] = {}
+_lock = threading.Lock()
+
+
+def register(name: str, collector: Callable[[], Dict[str, Any]]) -> None:
+    """
+    メトリクスの収集関数を名前付きで登録します。同名で登録し直した場合は上書きされます。
+    """
+    with _lock:
+        _collectors[name] = collector
+
+
+def snapshot() -> Dict[str, Any]:
+    """
+    登録済みの全ての収集関数を呼び出し、現在のメトリクスをまとめて返します。
+    """
+    with _lock:
+        collectors = dict(_collectors)
+
+    result = {}
+    for name, collector in collectors.items():
+        try:
+            result[name] = collector()
+        except Exception as e:
+            result[name] = {"error": str(e)}
+    return result
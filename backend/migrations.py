@@ -0,0 +1,71 @@
+# backend/migrations.py
+"""
+create_all では既存のテーブルに列やインデックスが追加されないため、スキーマの変更をここでまとめて実行します。
+
+- 起動時（main.py）: run_startup(engine) で、足りない列の追加（すぐに終わる）と、インデックスの状態の確認だけを行います。
+- デプロイ時: 既存行の埋め戻しとインデックスの構築は時間がかかるため、サーバーとは別に明示的に実行します。
+
+    python migrations.py [--index hnsw|ivfflat|none]
+"""
+import sys
+import argparse
+from typing import List
+
+from sqlalchemy import text
+
+import vector_index
+
+# 既存のテーブルに後から追加した列（テーブル名, 列名, DDL）。検索用の列は vector_index.column_steps() が持つ
+COLUMN_STEPS = [
+    # チャットの要約（conversation_memory.py）を保持する列
+    ("conversations", "summary", "ALTER TABLE conversations ADD COLUMN IF NOT EXISTS summary TEXT"),
+    ("conversations", "summary_message_id", "ALTER TABLE conversations ADD COLUMN IF NOT EXISTS summary_message_id INTEGER"),
+    ("conversations", "summary_updated_at",
+     "ALTER TABLE conversations ADD COLUMN IF NOT EXISTS summary_updated_at TIMESTAMP WITH TIME ZONE"),
+]
+
+
+def _missing_column_steps(conn, steps: List[tuple]) -> List[tuple]:
+    # ALTER TABLE は IF NOT EXISTS でもテーブルの排他ロックを待つため、既にある列には実行しない
+    existing = set(conn.execute(text(
+        "SELECT table_name, column_name FROM information_schema.columns "
+        "WHERE table_schema = current_schema() AND table_name = ANY(:tables)"
+    ), {"tables": sorted({table for table, _, _ in steps})}).tuples().all())
+    return [step for step in steps if (step[0], step[1]) not in existing]
+
+
+def add_missing_columns(engine) -> None:
+    """モデルが参照する列のうち、まだテーブルにないものを追加します。"""
+    with engine.begin() as conn:
+        for table, column, ddl in _missing_column_steps(conn, COLUMN_STEPS + vector_index.column_steps()):
+            print(f"--- DEBUG: Adding column {table}.{column}. ---")
+            conn.execute(text(ddl))
+
+
+def run_startup(engine) -> None:
+    """起動時に、モデルが参照する列を追加し、検索用のインデックスがそろっているかを確認します。"""
+    add_missing_columns(engine)
+    vector_index.check(engine)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Backfill columns and build the search indexes.")
+    parser.add_argument("--index", default=vector_index.VECTOR_INDEX_TYPE, choices=vector_index.INDEX_TYPES + ("none",),
+                        help="type of the approximate vector index to build")
+    args = parser.parse_args()
+
+    from database import engine
+    import models
+
+    models.Base.metadata.create_all(bind=engine)
+    add_missing_columns(engine)
+    result = vector_index.migrate(engine, args.index)
+    for step in result["steps"]:
+        print(f"{step['step']:<48}{step['seconds']:>10.3f}s")
+    for error in result["errors"]:
+        print(f"FAILED {error['step']}: {error['error']}")
+    return 1 if result["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
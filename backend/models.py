@@ -1,4 +1,4 @@
-from sqlalchemy import Column, ForeignKey, Integer, String, Text, DateTime
+from sqlalchemy import Column, ForeignKey, Integer, String, Text, DateTime, JSON
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from pgvector.sqlalchemy import Vector
@@ -18,6 +18,7 @@ class Project(Base):
     display_order = Column(Integer, default=0)
 
     conversations = relationship("Conversation", back_populates="project", cascade="all, delete-orphan")
+    review_snapshots = relationship("ReviewSnapshot", back_populates="project", cascade="all, delete-orphan")
 
 # Conversationモデル
 class Conversation(Base):
@@ -27,6 +28,10 @@ class Conversation(Base):
     project_id = Column(Integer, ForeignKey("projects.id"), nullable=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     title = Column(String, nullable=True) 
+    # チャットの古いやり取りの要約（conversation_memory.py が裏で更新する）と、要約に含めた最後のメッセージのID
+    summary = Column(Text, nullable=True)
+    summary_message_id = Column(Integer, nullable=True)
+    summary_updated_at = Column(DateTime(timezone=True), nullable=True)
 
     project = relationship("Project", back_populates="conversations")
     messages = relationship("Message", back_populates="conversation", cascade="all, delete-orphan")
@@ -37,9 +42,83 @@ class Message(Base):
 
     id = Column(Integer, primary_key=True, index=True)
     conversation_id = Column(Integer, ForeignKey("conversations.id"), nullable=False)
+    # 検索時に conversations と結合せずに絞り込めるよう、会話のproject_idを複製して持つ（vector_index.py で既存の行を補完）
+    project_id = Column(Integer, ForeignKey("projects.id", ondelete="CASCADE"), nullable=True, index=True)
     role = Column(String, nullable=False)
     content = Column(Text, nullable=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
+    # コサイン距離の近似インデックス（HNSW / IVFFlat）は、種類を設定で切り替えられるよう vector_index.py で作成する
     embedding = Column(Vector(384), nullable=True)
 
-    conversation = relationship("Conversation", back_populates="messages")
\ No newline at end of file
+    conversation = relationship("Conversation", back_populates="messages")
+    chunks = relationship("MessageChunk", back_populates="message", cascade="all, delete-orphan", order_by="MessageChunk.chunk_index")
+
+# MessageChunkモデル（長いメッセージを関数・クラス単位に分け、部分ごとにベクトルを持たせる）
+class MessageChunk(Base):
+    __tablename__ = "message_chunks"
+
+    id = Column(Integer, primary_key=True, index=True)
+    message_id = Column(Integer, ForeignKey("messages.id", ondelete="CASCADE"), nullable=False, index=True)
+    project_id = Column(Integer, ForeignKey("projects.id", ondelete="CASCADE"), nullable=True, index=True)
+    chunk_index = Column(Integer, nullable=False)
+    # メッセージ内での行範囲（1始まり、両端を含む）
+    start_line = Column(Integer, nullable=False)
+    end_line = Column(Integer, nullable=False)
+    content = Column(Text, nullable=False)
+    embedding = Column(Vector(384), nullable=False)
+
+    message = relationship("Message", back_populates="chunks")
+
+# ReviewSnapshotモデル（差分レビューのために、前回レビューしたコードと結果を保持する）
+class ReviewSnapshot(Base):
+    __tablename__ = "review_snapshots"
+
+    id = Column(Integer, primary_key=True, index=True)
+    project_id = Column(Integer, ForeignKey("projects.id"), nullable=False, index=True)
+    conversation_id = Column(Integer, ForeignKey("conversations.id", ondelete="SET NULL"), nullable=True)
+    file_name = Column(String, nullable=False)
+    code = Column(Text, nullable=False)
+    results = Column(JSON, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    project = relationship("Project", back_populates="review_snapshots")
+
+# レビュー結果キャッシュ（永続層）モデル
+class ReviewCacheEntry(Base):
+    __tablename__ = "review_cache"
+
+    key = Column(String(64), primary_key=True)
+    mode = Column(String, nullable=False)
+    model_name = Column(String, nullable=False)
+    review = Column(JSON, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    expires_at = Column(DateTime(timezone=True), nullable=False, index=True)
+    last_hit_at = Column(DateTime(timezone=True), nullable=True)
+    hit_count = Column(Integer, default=0)
+
+# レビュージョブ（非同期に実行するレビューの永続キュー）モデル
+class ReviewJob(Base):
+    __tablename__ = "review_jobs"
+
+    id = Column(String(32), primary_key=True)
+    project_id = Column(Integer, ForeignKey("projects.id", ondelete="CASCADE"), nullable=True, index=True)
+    # queued → running → succeeded / failed
+    status = Column(String, nullable=False, default="queued", index=True)
+    payload = Column(JSON, nullable=False)
+    result = Column(JSON, nullable=True)
+    error = Column(Text, nullable=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    worker_id = Column(String, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), index=True)
+    started_at = Column(DateTime(timezone=True), nullable=True)
+    finished_at = Column(DateTime(timezone=True), nullable=True)
+
+# ベクトルキャッシュ（永続層）モデル。同じテキストを何度もベクトル化しないよう、内容のハッシュをキーに保持する
+class EmbeddingCacheEntry(Base):
+    __tablename__ = "embedding_cache"
+
+    key = Column(String(64), primary_key=True)
+    model_name = Column(String, nullable=False)
+    embedding = Column(Vector(384), nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    last_hit_at = Column(DateTime(timezone=True), nullable=True, index=True)
@@ -0,0 +1,140 @@
+# backend/patch_service.py
+
+import re
+from dataclasses import dataclass, field
+from typing import List
+
+_HUNK_HEADER = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+_FENCE = re.compile(r"^```[\w+-]*\s*\n(.*?)\n```\s*$", re.DOTALL)
+# 行番号が多少ずれていても、前後この行数の範囲で一致する位置を探す
+MAX_FUZZ_LINES = 50
+
+
+class PatchError(ValueError):
+    """差分の形式が不正、または元のコードに適用できない場合の例外。"""
+
+
+@dataclass
+class Hunk:
+    old_start: int
+    old_count: int
+    new_start: int
+    new_count: int
+    lines: List[str] = field(default_factory=list)
+
+    @property
+    def old_lines(self) -> List[str]:
+        return [line[1:] for line in self.lines if line[:1] in (" ", "-")]
+
+    @property
+    def new_lines(self) -> List[str]:
+        return [line[1:] for line in self.lines if line[:1] in (" ", "+")]
+
+    @property
+    def is_complete(self) -> bool:
+        return len(self.old_lines) >= self.old_count and len(self.new_lines) >= self.new_count
+
+
+def strip_code_fence(text: str) -> str:
+    """Markdownのコードブロック(```lang ... ```)で囲まれていれば、中身だけを返します。"""
+    stripped = text.strip()
+    match = _FENCE.match(stripped)
+    return match.group(1) if match else stripped
+
+
+def parse_unified_diff(diff_text: str) -> List[Hunk]:
+    """
+    unified diff形式の文字列を解析してハンクのリストを返します。
+    Markdownの囲い(```diff)やファイルヘッダー(---/+++)は無視します。
+    """
+    hunks: List[Hunk] = []
+    current = None
+    for line in strip_code_fence(diff_text).split("\n"):
+        header = _HUNK_HEADER.match(line)
+        if header:
+            current = Hunk(
+                old_start=int(header.group(1)),
+                old_count=int(header.group(2)) if header.group(2) is not None else 1,
+                new_start=int(header.group(3)),
+                new_count=int(header.group(4)) if header.group(4) is not None else 1,
+            )
+            hunks.append(current)
+        elif current is None:
+            continue
+        elif current.is_complete and line.startswith(("--- ", "+++ ", "diff ", "index ")):
+            # ハンクの行数を満たした後のヘッダー行は次のファイルのもの
+            # (満たす前なら "-- コメント" を削除する行などの可能性がある)
+            continue
+        elif line.startswith("\\"):
+            # "\ No newline at end of file"
+            continue
+        elif line[:1] in (" ", "-", "+"):
+            current.lines.append(line)
+        elif line == "":
+            # 行末の空白が削られた空のコンテキスト行として扱う
+            current.lines.append(" ")
+        else:
+            raise PatchError(f"Unexpected line in diff: {line[:80]}")
+
+    if not hunks:
+        raise PatchError("No hunks found in diff.")
+    for hunk in hunks:
+        # 末尾の空コンテキスト行は、diffの最後の改行から生まれたものなので捨てる
+        while hunk.lines and hunk.lines[-1] == " ":
+            hunk.lines.pop()
+        if not hunk.lines:
+            raise PatchError("Empty hunk in diff.")
+    return hunks
+
+
+def shift_patch(diff_text: str, offset: int) -> str:
+    """
+    ハンクヘッダーの行番号を offset 行ずらした差分を返します。
+    ファイルの一部に対して作られた差分を、ファイル全体に対する差分に読み替えるために使います。
+    """
+    def shift(match: re.Match) -> str:
+        old_count = f",{match.group(2)}" if match.group(2) is not None else ""
+        new_count = f",{match.group(4)}" if match.group(4) is not None else ""
+        return f"@@ -{int(match.group(1)) + offset}{old_count} +{int(match.group(3)) + offset}{new_count} @@"
+
+    return "\n".join(_HUNK_HEADER.sub(shift, line, count=1) for line in strip_code_fence(diff_text).split("\n"))
+
+
+def _find_hunk(lines: List[str], old: List[str], expected: int, start: int) -> int:
+    def matches(pos: int) -> bool:
+        return lines[pos:pos + len(old)] == old or [l.rstrip() for l in lines[pos:pos + len(old)]] == [l.rstrip() for l in old]
+
+    if not old:
+        return max(start, min(expected, len(lines)))
+    for offset in range(MAX_FUZZ_LINES + 1):
+        for pos in (expected - offset, expected + offset) if offset else (expected,):
+            if start <= pos <= len(lines) - len(old) and matches(pos):
+                return pos
+    raise PatchError(f"Hunk at line {expected + 1} does not match the original code.")
+
+
+def apply_patch(original: str, diff_text: str) -> str:
+    """
+    unified diffを元のコードに適用し、修正後のファイル全体を返します。
+    適用できない場合は PatchError を送出します。
+    """
+    lines = original.split("\n")
+    result: List[str] = []
+    cursor = 0
+    for hunk in parse_unified_diff(diff_text):
+        # 削除・変更行のない挿入だけのハンクは、old_start行の「直後」に挿入する
+        expected = hunk.old_start if hunk.old_count == 0 else hunk.old_start - 1
+        position = _find_hunk(lines, hunk.old_lines, max(expected, 0), cursor)
+        result.extend(lines[cursor:position])
+        result.extend(hunk.new_lines)
+        cursor = position + len(hunk.old_lines)
+    result.extend(lines[cursor:])
+    return "\n".join(result)
+
+
+def is_valid_patch(original: str, diff_text: str) -> bool:
+    try:
+        apply_patch(original, diff_text)
+        return True
+    except PatchError:
+        return False
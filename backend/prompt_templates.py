@@ -0,0 +1,248 @@
+# backend/prompt_templates.py
+
+import os
+import json
+import threading
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+import metrics_service
+from review_planner import estimate_tokens
+
+# プロンプトの版数。定型部分を変更したら必ず更新すること（レビューのキャッシュキーに含まれる）
+REVIEW_PROMPT_VERSION = "review-v3"
+TEST_PROMPT_VERSION = "test-v2"
+SUMMARY_PROMPT_VERSION = "summary-v1"
+
+# "suggestion" の出力形式。"full" はファイル全体のコード、"patch" は元のファイルに対するunified diff
+SUGGESTION_FORMATS = ("full", "patch")
+
+# Anthropicがキャッシュできる定型部分（ツール定義 + system）の最小トークン数。これより短いと cache_control は無視される
+# (Claude 3.5 Sonnet / Opus は1024、Haiku は2048)
+ANTHROPIC_CACHE_MIN_TOKENS = int(os.getenv("ANTHROPIC_CACHE_MIN_TOKENS", "1024"))
+
+
+@dataclass(frozen=True)
+class Prompt:
+    """
+    プロバイダー側のプロンプトキャッシュが効くよう、リクエストごとに変わらない定型部分(system)と、
+    コードなどの可変部分(user)を分けて保持する。system は常に先頭に置いて送信する。
+    """
+    system: str
+    user: str
+    version: str
+
+
+# --- コードレビュー用のテンプレート ---
+
+_SUGGESTION_RULES = {
+    "full": '- "suggestion": 提案を適用した後の、**ファイル全体の完全なコード**をコードブロックで出力すること。元のコードから変更がない場合でも、必ずファイル全体のコードを出力すること。',
+    "patch": '- "suggestion": 提案を適用するための、元のファイルに対する**unified diff形式の差分のみ**を出力すること。各ハンクには "@@ -開始行,行数 +開始行,行数 @@" のヘッダーと、変更箇所の前後3行のコンテキスト行を含めること。ファイル全体のコードは出力しないこと。変更がない場合は空文字列 "" とすること。',
+}
+
+_REVIEW_SYSTEM = """あなたは経験豊富なソフトウェアエンジニアで、コードレビューの達人です。
+ユーザーから渡されるソースコードファイルをレビューしてください。
+
+レビュー結果は、必ず以下のルールに従った有効なJSON形式で出力してください。
+
+【JSON出力ルール】
+- ルートオブジェクトは "overall_score", "summary", "details" という3つのキーを持つこと。
+- "overall_score": コード全体の健全性を0から100の整数で評価したスコア。
+- "summary": レビュー結果全体の短い要約（日本語で2文程度）。
+- "details": 指摘事項の配列。指摘がない場合は空の配列 [] とすること。
+- 配列の各要素は、"category", "file_name", "line_number", "description", "suggestion" の5つのキーを持つオブジェクトであること。
+- "category": 指摘のカテゴリ。必ず "Bug", "Security", "Performance", "Quality", "Readability", "Style" のいずれかから選択すること。
+- "file_name": 指摘対象のファイル名。
+- "line_number": 指摘対象のおおよその行番号（整数）。
+- "description": 指摘内容の詳細な解説（日本語）。
+{suggestion_rule}
+"""
+
+# 形式ごとの定型部分は一度だけ組み立て、毎回まったく同じ文字列を送る
+_REVIEW_SYSTEMS = {fmt: _REVIEW_SYSTEM.format(suggestion_rule=rule) for fmt, rule in _SUGGESTION_RULES.items()}
+
+
+def review_prompt_version(suggestion_format: str) -> str:
+    return f"{REVIEW_PROMPT_VERSION}:{suggestion_format}"
+
+
+def build_review_prompt(files: Dict[str, str], suggestion_format: str = "full") -> Prompt:
+    formatted_code = "".join([f"### ファイル名: {name}\n```\n{content}\n```\n\n" for name, content in files.items()])
+    return Prompt(
+        system=_REVIEW_SYSTEMS[suggestion_format],
+        user=f"--- ソースコード ---\n{formatted_code}--------------------\n",
+        version=review_prompt_version(suggestion_format),
+    )
+
+
+# --- テストコード生成用のテンプレート ---
+
+_TEST_SYSTEM_JEST = """あなたは、コードの変更点を正確に検証するテストを作成する、熟練したTypeScript/Jestテストエンジニアです。
+提供された「修正済みのコード」が正しく動作することを証明するためのユニットテストを、Jestフレームワークを使用して生成してください。
+
+【実行環境に関する非常に重要なルール】
+- 「修正済みのコード」は `main.ts` というファイルに保存されます。
+- あなたがこれから生成するテストコードは `main.test.ts` という別のファイルに保存されます。
+- そのため、テスト対象の関数やクラスを `main.ts` から **必ずインポートする必要があります**。
+- 例: `import { functionNameToTest } from './main';`
+
+【テストコード生成ルール】
+1. テストフレームワークは「Jest」を使用してください。
+2. `main.ts` から必要な要素をインポートする `import` 文を必ず記述してください。
+3. 「修正済みのコード」が「元のコード」のバグを修正していることを検証する、具体的で有用なアサーションを記述してください。
+4. 出力には、テストコード本体（`import`文やテスト関数・クラス）のみを含めてください。他の説明やMarkdownの囲い(```)は絶対に含めないでください。
+5. 上記のルールに厳密に従い、import文を含む完全なテストコードを生成してください。
+"""
+
+_TEST_SYSTEM_PYTEST = """あなたは、コードの変更点を正確に検証するテストを作成する、熟練したPython/pytestテストエンジニアです。
+提供された「修正済みのコード」が正しく動作することを証明するためのユニットテストを、pytestフレームワークを使用して生成してください。
+
+【実行環境に関する非常に重要なルール】
+あなたが生成するテストコードは、「修正済みのコード」と同じファイル、同じスコープに配置されてから実行されます。
+そのため、テスト対象の関数やクラスをインポートする必要は一切ありません。そのまま直接呼び出してください。
+
+【テストコード生成ルール】
+- テストフレームワークは「pytest」を使用してください。
+- 「修正済みのコード」が「元のコード」のバグを修正していることを検証する、具体的で有用なアサーションを記述してください。
+- 出力には、テストコード本体（import文やテスト関数・クラス）のみを含めてください。他の説明やMarkdownの囲い(```)は絶対に含めないでください。
+- 上記のルールに厳密に従い、テスト対象のインポート文は含めずに、テストコードを生成してください。
+"""
+
+
+def build_test_prompt(original_code: str, revised_code: str, language: str) -> Prompt:
+    if language.lower() in ["javascript", "typescript"]:
+        return Prompt(
+            system=_TEST_SYSTEM_JEST,
+            user=(
+                f"【元のコード（参考情報）】\n```typescript\n{original_code}\n```\n---\n"
+                f"【修正済みのコード（main.tsの内容）】\n```typescript\n{revised_code}\n```\n"
+            ),
+            version=f"{TEST_PROMPT_VERSION}:jest",
+        )
+    return Prompt(
+        system=_TEST_SYSTEM_PYTEST,
+        user=(
+            f"【元のコード（参考情報）】\n```python\n{original_code}\n```\n---\n"
+            f"【修正済みのコード（テスト対象）】\n```python\n{revised_code}\n```\n"
+        ),
+        version=f"{TEST_PROMPT_VERSION}:pytest",
+    )
+
+
+# --- チャットの会話要約用のテンプレート ---
+
+_SUMMARY_SYSTEM = """あなたは、コードレビューに関するユーザーとAIアシスタント「Refix」の会話を記録する書記です。
+これまでの要約と、その後に続いた会話が渡されるので、両方を統合した新しい要約を作成してください。
+
+【要約のルール】
+- 日本語で、{max_tokens}トークン程度以内にまとめること。
+- ユーザーが知りたいこと・決まったこと・未解決の質問を優先して残すこと。
+- 会話に出てきた関数名・ファイル名・エラーメッセージ・行番号などの固有の情報は、省略せずそのまま残すこと。
+- コードの全文は書き写さず、変更点や問題点を短く説明すること。
+- 出力には要約の本文のみを含め、前置きや見出しは付けないこと。
+"""
+
+
+def build_summary_prompt(previous_summary: Optional[str], messages: List[Dict[str, str]], max_tokens: int) -> Prompt:
+    transcript = "".join(f"[{message['role']}]\n{message['content']}\n\n" for message in messages)
+    return Prompt(
+        system=_SUMMARY_SYSTEM.format(max_tokens=max_tokens),
+        user=(
+            f"【これまでの要約】\n{previous_summary or '（なし）'}\n\n"
+            f"【その後の会話】\n{transcript}"
+        ),
+        version=SUMMARY_PROMPT_VERSION,
+    )
+
+
+# --- プロバイダーごとのキャッシュ指定 ---
+
+def openai_messages(system: Optional[str], user: str) -> List[Dict[str, str]]:
+    """OpenAIは先頭から一致する部分を自動でキャッシュするため、定型部分を system メッセージとして先頭に置く。"""
+    messages = [{"role": "system", "content": system}] if system else []
+    messages.append({"role": "user", "content": user})
+    return messages
+
+
+def anthropic_system(system: Optional[str], tools: Optional[List[Dict[str, Any]]] = None) -> Any:
+    """
+    Anthropicでは定型部分に cache_control を付け、そこまで（ツール定義を含む）をキャッシュさせる。
+    ツール定義と合わせても最小トークン数に届かない場合はキャッシュされないため、cache_control を付けない。
+    """
+    if not system:
+        return None
+    prefix_tokens = estimate_tokens(system)
+    if tools:
+        prefix_tokens += estimate_tokens(json.dumps(tools, ensure_ascii=False))
+    if prefix_tokens < ANTHROPIC_CACHE_MIN_TOKENS:
+        return system
+    return [{"type": "text", "text": system, "cache_control": {"type": "ephemeral"}}]
+
+
+# --- キャッシュされた入力トークン数の記録 ---
+
+_usage: Dict[str, Dict[str, int]] = {}
+_usage_lock = threading.Lock()
+
+
+def _usage_counts(provider: str, usage: Any) -> Optional[Dict[str, int]]:
+    """各SDKの使用量オブジェクトから (入力トークン数, キャッシュから読んだ数, キャッシュに書いた数) を取り出す。"""
+    if usage is None:
+        return None
+    if provider == "openai":
+        details = getattr(usage, "prompt_tokens_details", None)
+        return {
+            "input_tokens": getattr(usage, "prompt_tokens", 0) or 0,
+            "cached_tokens": getattr(details, "cached_tokens", 0) or 0,
+            "cache_write_tokens": 0,
+        }
+    if provider == "anthropic":
+        # Anthropicの input_tokens にはキャッシュから読んだ分と書いた分が含まれない
+        cached = getattr(usage, "cache_read_input_tokens", 0) or 0
+        written = getattr(usage, "cache_creation_input_tokens", 0) or 0
+        return {
+            "input_tokens": (getattr(usage, "input_tokens", 0) or 0) + cached + written,
+            "cached_tokens": cached,
+            "cache_write_tokens": written,
+        }
+    if provider == "gemini":
+        return {
+            "input_tokens": getattr(usage, "prompt_token_count", 0) or 0,
+            "cached_tokens": getattr(usage, "cached_content_token_count", 0) or 0,
+            "cache_write_tokens": 0,
+        }
+    return None
+
+
+def record_usage(provider: str, model_name: str, usage: Any) -> None:
+    """
+    レスポンスの使用量を記録します。usage には各SDKの使用量オブジェクト
+    (OpenAI: response.usage / Anthropic: response.usage / Gemini: response.usage_metadata) を渡します。
+    """
+    try:
+        counts = _usage_counts(provider, usage)
+    except Exception:
+        counts = None
+    if counts is None:
+        return
+    with _usage_lock:
+        entry = _usage.setdefault(f"{provider}:{model_name}", {
+            "requests": 0, "input_tokens": 0, "cached_tokens": 0, "cache_write_tokens": 0, "cache_hit_requests": 0,
+        })
+        entry["requests"] += 1
+        for key, value in counts.items():
+            entry[key] += value
+        if counts["cached_tokens"]:
+            entry["cache_hit_requests"] += 1
+
+
+def usage_stats() -> Dict[str, Any]:
+    with _usage_lock:
+        models = {name: dict(entry) for name, entry in _usage.items()}
+    for entry in models.values():
+        entry["cached_ratio"] = round(entry["cached_tokens"] / entry["input_tokens"], 4) if entry["input_tokens"] else 0.0
+    return {"review_prompt_version": REVIEW_PROMPT_VERSION, "test_prompt_version": TEST_PROMPT_VERSION,
+            "summary_prompt_version": SUMMARY_PROMPT_VERSION, "models": models}
+
+
+metrics_service.register("prompt_cache", usage_stats)
@@ -0,0 +1,139 @@
+# backend/review_calls.py
+
+import os
+import asyncio
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+# --- レビューのLLM呼び出しを制御する、モデルやDBに依存しない処理 ---
+
+
+class _Flight:
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    同じキーの処理が既に実行中であれば、新たに実行せずその結果（または例外）を共有する。
+    待っている呼び出し元が全員キャンセルされた場合のみ、実行中の処理もキャンセルする。
+    """
+
+    def __init__(self):
+        self._flights: Dict[str, _Flight] = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    async def do(self, key: str, coro_factory):
+        flight = self._flights.get(key)
+        if flight is None:
+            self.leaders += 1
+            flight = _Flight(asyncio.ensure_future(coro_factory()))
+            self._flights[key] = flight
+            flight.task.add_done_callback(lambda _task, key=key, flight=flight: self._forget(key, flight))
+        else:
+            self.coalesced += 1
+            print(f"--- DEBUG: Joining in-flight review call for key {key[:12]}... ---")
+
+        flight.waiters += 1
+        try:
+            # shieldで包むことで、1人の呼び出し元のキャンセルが共有タスクに波及しないようにする
+            return await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            if flight.waiters == 1 and not flight.task.done():
+                # キャンセル完了前に来た呼び出し元が、キャンセル中のタスクに合流しないよう先に外しておく
+                self._forget(key, flight)
+                flight.task.cancel()
+            raise
+        finally:
+            flight.waiters -= 1
+
+    def _forget(self, key: str, flight: _Flight) -> None:
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    def stats(self) -> Dict[str, Any]:
+        return {"in_flight": len(self._flights), "leaders": self.leaders, "coalesced": self.coalesced}
+
+
+# 直近の応答時間のこのパーセンタイルを超えたらヘッジを発火する
+REVIEW_HEDGE_PERCENTILE = float(os.getenv("REVIEW_HEDGE_PERCENTILE", "0.95"))
+# サンプルが少ない間は、固定の予算時間を使う
+REVIEW_HEDGE_MIN_SAMPLES = int(os.getenv("REVIEW_HEDGE_MIN_SAMPLES", "20"))
+REVIEW_HEDGE_DEFAULT_BUDGET_SECONDS = float(os.getenv("REVIEW_HEDGE_DEFAULT_BUDGET_SECONDS", "30"))
+
+
+class LatencyTracker:
+    """モデルごとに直近の成功時の応答時間を保持し、パーセンタイルを計算する。"""
+
+    def __init__(self, window: int = 200):
+        self.window = window
+        self._samples: Dict[str, deque] = {}
+
+    def record(self, model_name: str, seconds: float) -> None:
+        self._samples.setdefault(model_name, deque(maxlen=self.window)).append(seconds)
+
+    def percentile(self, model_name: str, q: float) -> Optional[float]:
+        samples = sorted(self._samples.get(model_name, ()))
+        if not samples:
+            return None
+        index = min(len(samples) - 1, int(q * len(samples)))
+        return samples[index]
+
+    def budget(self, model_name: str) -> float:
+        if len(self._samples.get(model_name, ())) < REVIEW_HEDGE_MIN_SAMPLES:
+            return REVIEW_HEDGE_DEFAULT_BUDGET_SECONDS
+        return self.percentile(model_name, REVIEW_HEDGE_PERCENTILE)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            model_name: {
+                "samples": len(samples),
+                "p50_seconds": round(self.percentile(model_name, 0.5), 2),
+                "p95_seconds": round(self.percentile(model_name, 0.95), 2),
+            }
+            for model_name, samples in self._samples.items() if samples
+        }
+
+
+hedge_stats = {"fired": 0, "fallback_wins": 0}
+
+
+async def hedge(primary_name: str, primary_factory: Callable[[], Awaitable[Any]],
+                fallback_name: str, fallback_factory: Callable[[], Awaitable[Any]],
+                budget: float) -> Tuple[Any, str]:
+    """
+    主の呼び出しが予算時間内に終わらなければフォールバックの呼び出しも始め、
+    先に成功した方の (結果, 名前) を返す。負けた方の呼び出しはキャンセルする。
+    """
+    primary = asyncio.ensure_future(primary_factory())
+    fallback = None
+    try:
+        done, _ = await asyncio.wait({primary}, timeout=budget)
+        if done:
+            return primary.result(), primary_name
+
+        print(f"--- DEBUG: {primary_name} exceeded its {budget:.1f}s budget. Hedging with {fallback_name}. ---")
+        hedge_stats["fired"] += 1
+        fallback = asyncio.ensure_future(fallback_factory())
+        candidates = [(primary, primary_name), (fallback, fallback_name)]
+        pending = {primary, fallback}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task, name in candidates:
+                if task in done and task.exception() is None:
+                    if task is fallback:
+                        hedge_stats["fallback_wins"] += 1
+                    return task.result(), name
+
+        # 両方とも失敗した場合は、主の呼び出しのエラーを報告する
+        return primary.result(), primary_name
+    finally:
+        for task in (primary, fallback):
+            if task is None:
+                continue
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled():
+                task.exception()  # 採用されなかった側の例外を回収し、未処理の警告を防ぐ
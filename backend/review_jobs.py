@@ -0,0 +1,161 @@
+# backend/review_jobs.py
+
+import os
+import uuid
+import socket
+import asyncio
+import traceback
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, List, Optional
+
+import crud
+import metrics_service
+import review_pipeline
+import cross_check_service
+from database import SessionLocal
+
+# --- 設定値（環境変数で上書き可能） ---
+# このプロセスで起動するワーカーの数（0ならジョブを実行しない。別プロセスのワーカーに任せる場合など）
+REVIEW_JOB_WORKERS = int(os.getenv("REVIEW_JOB_WORKERS", "2"))
+# キューが空のときに次のジョブを探すまでの間隔（秒）
+REVIEW_JOB_POLL_SECONDS = float(os.getenv("REVIEW_JOB_POLL_SECONDS", "1"))
+# 実行中のままこの秒数を過ぎたジョブは、ワーカーが落ちたものとみなして再実行する
+REVIEW_JOB_STALE_SECONDS = float(os.getenv("REVIEW_JOB_STALE_SECONDS", "600"))
+REVIEW_JOB_MAX_ATTEMPTS = int(os.getenv("REVIEW_JOB_MAX_ATTEMPTS", "3"))
+
+FINISHED_STATUSES = ("succeeded", "failed")
+
+_workers: List[asyncio.Task] = []
+_wakeup: Optional[asyncio.Event] = None
+# ワーカーが動いているイベントループ（submit_review_job はスレッドプールから呼ばれるため、ここ経由で起こす）
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_stats = {"claimed": 0, "succeeded": 0, "failed": 0, "busy_workers": 0}
+
+# プロジェクトに紐づくジョブの結果を保存する関数（main.py から start_workers で渡される）
+ProjectResultHandler = Callable[[Any, int, str, List[Dict[str, Any]]], None]
+_on_project_result: Optional[ProjectResultHandler] = None
+
+
+def _with_session(func, *args, **kwargs):
+    db = SessionLocal()
+    try:
+        return func(db, *args, **kwargs)
+    finally:
+        db.close()
+
+
+def job_to_dict(job) -> Dict[str, Any]:
+    return {
+        "job_id": job.id,
+        "status": job.status,
+        "project_id": job.project_id,
+        "attempts": job.attempts,
+        "created_at": job.created_at.isoformat() if job.created_at else None,
+        "started_at": job.started_at.isoformat() if job.started_at else None,
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+        "result": job.result,
+        "error": job.error,
+    }
+
+
+def submit_review_job(db, code: str, suggestion_format: str = "full", project_id: Optional[int] = None):
+    """レビュージョブをキューに登録し、同じプロセスの待機中のワーカーを起こします。"""
+    payload = {"code": code, "file_name": "pasted_code.txt", "suggestion_format": suggestion_format}
+    job = crud.create_review_job(db, job_id=uuid.uuid4().hex, payload=payload, project_id=project_id)
+    _notify_workers()
+    return job
+
+
+def _notify_workers() -> None:
+    # asyncio.Event はスレッドセーフではないため、ワーカーのイベントループ上で set する
+    if _wakeup is None or _loop is None or _loop.is_closed():
+        return
+    try:
+        _loop.call_soon_threadsafe(_wakeup.set)
+    except RuntimeError:
+        # ループが閉じられた直後など。ワーカーは次のポーリングでジョブを拾う
+        pass
+
+
+async def _run_job(job) -> Dict[str, Any]:
+    payload = job.payload
+    file_name = payload.get("file_name", "pasted_code.txt")
+    results = await review_pipeline.ReviewPipeline().run(
+        {file_name: payload["code"]}, suggestion_format=payload.get("suggestion_format", "full")
+    )
+    if job.project_id is not None and _on_project_result is not None:
+        await asyncio.to_thread(_with_session, _on_project_result, job.project_id, payload["code"], results)
+    # consolidate_reviews は指摘事項に model_name を書き込むため、保存した results を汚さないよう後で呼ぶ
+    consolidated_issues = cross_check_service.consolidate_reviews(results)
+    return {"results": results, "consolidated_issues": consolidated_issues}
+
+
+async def _worker(worker_id: str) -> None:
+    print(f"--- DEBUG: Review job worker {worker_id} started. ---")
+    while True:
+        try:
+            stale_before = datetime.now(timezone.utc) - timedelta(seconds=REVIEW_JOB_STALE_SECONDS)
+            job = await asyncio.to_thread(_with_session, crud.claim_next_review_job, worker_id, stale_before)
+            if job is None:
+                _wakeup.clear()
+                try:
+                    await asyncio.wait_for(_wakeup.wait(), timeout=REVIEW_JOB_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            _stats["claimed"] += 1
+            if job.attempts > REVIEW_JOB_MAX_ATTEMPTS:
+                _stats["failed"] += 1
+                await asyncio.to_thread(_with_session, crud.finish_review_job, job.id, None, "Review job exceeded the maximum number of attempts.")
+                continue
+
+            print(f"--- DEBUG: Worker {worker_id} is running review job {job.id} (attempt {job.attempts}). ---")
+            _stats["busy_workers"] += 1
+            try:
+                result = await _run_job(job)
+                await asyncio.to_thread(_with_session, crud.finish_review_job, job.id, result, None)
+                _stats["succeeded"] += 1
+            except Exception as e:
+                traceback.print_exc()
+                await asyncio.to_thread(_with_session, crud.finish_review_job, job.id, None, str(e))
+                _stats["failed"] += 1
+            finally:
+                _stats["busy_workers"] -= 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # DBへの接続エラーなどでワーカーが止まらないよう、少し待ってから続ける
+            print(f"--- DEBUG: Review job worker {worker_id} hit an error: {e} ---")
+            await asyncio.sleep(REVIEW_JOB_POLL_SECONDS)
+
+
+def start_workers(on_project_result: Optional[ProjectResultHandler] = None, count: Optional[int] = None) -> None:
+    """アプリケーション起動時に、ジョブを実行するワーカーを起動します。"""
+    global _wakeup, _loop, _on_project_result
+    _on_project_result = on_project_result
+    _wakeup = asyncio.Event()
+    _loop = asyncio.get_running_loop()
+    count = REVIEW_JOB_WORKERS if count is None else count
+    host = socket.gethostname()
+    for index in range(count):
+        worker_id = f"{host}:{os.getpid()}:{index}"
+        _workers.append(asyncio.create_task(_worker(worker_id)))
+
+
+async def stop_workers() -> None:
+    """
+    アプリケーション終了時にワーカーを止めます。
+    実行中だったジョブは REVIEW_JOB_STALE_SECONDS の経過後に他のワーカーが再実行します。
+    """
+    for task in _workers:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
+
+
+def job_stats() -> Dict[str, Any]:
+    return {"workers": len(_workers), **_stats}
+
+
+metrics_service.register("review_jobs", job_stats)
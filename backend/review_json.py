@@ -0,0 +1,198 @@
+# backend/review_json.py
+
+import re
+import json
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+import metrics_service
+
+# --- レビュー結果のJSONスキーマ（各プロバイダーの構造化出力モードで使う） ---
+
+_DETAIL_PROPERTIES = {
+    "category": {"type": "string", "enum": ["Bug", "Security", "Performance", "Quality", "Readability", "Style"]},
+    "file_name": {"type": "string"},
+    "line_number": {"type": "integer"},
+    "description": {"type": "string"},
+    "suggestion": {"type": "string"},
+}
+
+REVIEW_JSON_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "overall_score": {"type": "integer"},
+        "summary": {"type": "string"},
+        "details": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": _DETAIL_PROPERTIES,
+                "required": list(_DETAIL_PROPERTIES),
+                "additionalProperties": False,
+            },
+        },
+    },
+    "required": ["overall_score", "summary", "details"],
+    "additionalProperties": False,
+}
+
+
+def gemini_schema(schema: Dict[str, Any]) -> Dict[str, Any]:
+    """GeminiのresponseSchemaが対応していない additionalProperties を取り除いたスキーマを返します。"""
+    if isinstance(schema, dict):
+        return {key: gemini_schema(value) for key, value in schema.items() if key != "additionalProperties"}
+    if isinstance(schema, list):
+        return [gemini_schema(value) for value in schema]
+    return schema
+
+
+# --- 寛容なパーサー（途中で切れたJSONや軽微な崩れをローカルで修復する） ---
+
+_TRAILING_COMMA = re.compile(r",(\s*[}\]])")
+# JSONのオブジェクトの始まり（前置きの文章に含まれる "{...}" と区別するため、最初のキーの '"' まで見る）
+_OBJECT_START = re.compile(r'\{\s*(?:"|\})')
+_REVIEW_KEYS = {"overall_score", "summary", "details"}
+_stats = {"parsed": 0, "repaired": 0, "failed": 0}
+_stats_lock = threading.Lock()
+
+
+def _count(name: str) -> None:
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def _safe_cut_points(text: str) -> List[Tuple[int, List[str]]]:
+    """
+    そこで切ってから括弧を閉じれば有効なJSONになる位置と、その時点で開いている括弧の一覧を集める。
+    (開き括弧の直後、要素を閉じる括弧の直後、要素を区切る ',' の直前が該当する)
+    配列の要素であるオブジェクトが開いたままになる位置は含めないため、
+    末尾の不完全な要素（例: 途中で切れた details の1件）は丸ごと捨てられる。
+    """
+    def item_open(stack: List[str]) -> bool:
+        return "]" in stack and "}" in stack[stack.index("]") + 1:]
+
+    points: List[Tuple[int, List[str]]] = []
+    stack: List[str] = []
+    in_string = False
+    escape = False
+    for pos, ch in enumerate(text):
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+            if not item_open(stack):
+                points.append((pos + 1, list(stack)))
+        elif ch in "}]":
+            if not stack:
+                break
+            stack.pop()
+            if not stack:
+                break
+            # 配列の要素（details の1件など）が閉じた直後なら、そこまでの要素はすべて完結している
+            if not item_open(stack):
+                points.append((pos + 1, list(stack)))
+        elif ch == "," and not item_open(stack):
+            points.append((pos, list(stack)))
+    return points
+
+
+def _loads(text: str) -> Any:
+    # strict=False で、文字列中の生の改行やタブも受け付ける
+    return json.loads(_TRAILING_COMMA.sub(r"\1", text), strict=False)
+
+
+def _repair(text: str) -> Optional[Any]:
+    """途中で切れたJSONを、最後に完結している要素までで切り詰め、括弧を閉じて読み込む。"""
+    for cut, stack in reversed(_safe_cut_points(text)):
+        candidate = text[:cut].rstrip().rstrip(",") + "".join(reversed(stack))
+        try:
+            return _loads(candidate)
+        except json.JSONDecodeError:
+            continue
+    return None
+
+
+def _normalize_review(data: Dict[str, Any]) -> Dict[str, Any]:
+    details = data.get("details")
+    data["details"] = [d for d in details if isinstance(d, dict)] if isinstance(details, list) else []
+    data.setdefault("overall_score", 0)
+    data.setdefault("summary", "")
+    return data
+
+
+def _find_complete_review(raw_response: str) -> Optional[Dict[str, Any]]:
+    """前後の文章に括弧が含まれていても、応答の中にある完全なレビューのオブジェクトを探す。"""
+    decoder = json.JSONDecoder()
+    for match in _OBJECT_START.finditer(raw_response):
+        try:
+            data, _ = decoder.raw_decode(raw_response, match.start())
+        except json.JSONDecodeError:
+            continue
+        # details の1件など、入れ子のオブジェクトだけが読めた場合はレビューとみなさない
+        if isinstance(data, dict) and _REVIEW_KEYS & data.keys():
+            return data
+    return None
+
+
+def parse_review(raw_response: str) -> Dict[str, Any]:
+    """
+    モデルの応答からレビューのJSONを取り出します。
+    まずそのまま読み込み、失敗した場合は末尾の不完全な要素を捨てて括弧を補うなどの修復を試みます。
+    修復した場合は "repaired": True を付けます。どうしても読めない場合は JSONDecodeError を送出します。
+    """
+    json_start = raw_response.find('{')
+    if json_start == -1:
+        _count("failed")
+        raise json.JSONDecodeError("No JSON object found in the response", raw_response, 0)
+
+    json_end = raw_response.rfind('}') + 1
+    if json_end > json_start:
+        try:
+            data = json.loads(raw_response[json_start:json_end])
+            if isinstance(data, dict):
+                _count("parsed")
+                return _normalize_review(data)
+        except json.JSONDecodeError:
+            pass
+
+    data = _find_complete_review(raw_response)
+    if data is not None:
+        _count("parsed")
+        return _normalize_review(data)
+
+    object_start = _OBJECT_START.search(raw_response)
+    if object_start is not None:
+        json_start = object_start.start()
+    text = raw_response[json_start:]
+    data = None
+    try:
+        data = _loads(text[:json_end - json_start] if json_end > json_start else text)
+    except json.JSONDecodeError:
+        data = _repair(text)
+
+    if not isinstance(data, dict):
+        _count("failed")
+        raise json.JSONDecodeError("Could not repair the JSON object in the response", raw_response, json_start)
+
+    _count("repaired")
+    print("--- DEBUG: Review JSON was malformed or truncated and has been repaired locally. ---")
+    data = _normalize_review(data)
+    data["repaired"] = True
+    return data
+
+
+def parse_stats() -> Dict[str, Any]:
+    with _stats_lock:
+        stats = dict(_stats)
+    total = sum(stats.values())
+    return {**stats, "repair_rate": round(stats["repaired"] / total, 4) if total else 0.0}
+
+
+metrics_service.register("review_json", parse_stats)
@@ -0,0 +1,106 @@
+# backend/review_pipeline.py
+
+import os
+import time
+import asyncio
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import metrics_service
+
+# レビューを依頼するモデル（モード:表示名 をカンマ区切りで指定）
+REVIEW_PIPELINE_TARGETS = os.getenv(
+    "REVIEW_PIPELINE_TARGETS",
+    "balanced:Gemini (Balanced),strict_audit:GPT-4o (Strict Audit)",
+)
+# 全モデルのレビューを待つ上限の秒数。これを過ぎたモデルはキャンセルし、タイムアウトとして返す
+REVIEW_PIPELINE_DEADLINE_SECONDS = float(os.getenv("REVIEW_PIPELINE_DEADLINE_SECONDS", "90"))
+
+
+@dataclass(frozen=True)
+class ReviewTarget:
+    mode: str
+    label: str  # レスポンスの "model_name" に入る表示名
+
+
+def parse_targets(spec: str) -> List[ReviewTarget]:
+    targets = []
+    for item in spec.split(","):
+        mode, _, label = item.strip().partition(":")
+        if mode:
+            targets.append(ReviewTarget(mode.strip(), label.strip() or mode.strip()))
+    return targets
+
+
+REVIEW_TARGETS = parse_targets(REVIEW_PIPELINE_TARGETS)
+
+_stats = {"runs": 0, "completed": 0, "errors": 0, "timed_out": 0, "deadline_hits": 0}
+
+
+class ReviewPipeline:
+    """
+    複数のモデルに同じレビューを並行して依頼し、締め切りまでに完了した結果を集める。
+    締め切りを過ぎたモデルはキャンセルし、"timed_out": True を付けたエラーとして返すため、
+    モデルを増やしても全体の待ち時間は締め切りを超えない。
+    """
+
+    def __init__(self, targets: Optional[List[ReviewTarget]] = None, deadline: Optional[float] = None):
+        self.targets = list(targets) if targets is not None else list(REVIEW_TARGETS)
+        self.deadline = REVIEW_PIPELINE_DEADLINE_SECONDS if deadline is None else deadline
+
+    async def run(self, files: Dict[str, str], suggestion_format: str = "full",
+                  review_factory: Optional[Callable[[ReviewTarget], Awaitable[dict]]] = None) -> List[Dict[str, Any]]:
+        """
+        各モデルのレビュー結果を targets の順に {"model_name", "review"} または {"model_name", "error"} で返す。
+        review_factory を渡すと、モデルごとのレビューの取得方法（差分レビューなど）を差し替えられる。
+        """
+        if review_factory is None:
+            # 締め切りの処理をプロバイダーのSDKなしでテストできるよう、既定のレビュー取得時にだけ読み込む
+            import ai_partner
+
+            def review_factory(target: ReviewTarget):
+                return ai_partner.generate_structured_review(
+                    files=files, linter_results="", mode=target.mode, suggestion_format=suggestion_format
+                )
+
+        _stats["runs"] += 1
+        started = time.monotonic()
+        tasks = [asyncio.ensure_future(review_factory(target)) for target in self.targets]
+        try:
+            _, pending = await asyncio.wait(tasks, timeout=self.deadline) if tasks else (set(), set())
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+        if pending:
+            _stats["deadline_hits"] += 1
+            print(f"--- DEBUG: Review deadline of {self.deadline:g}s reached. {len(pending)} model(s) timed out. ---")
+
+        results = []
+        for target, task in zip(self.targets, tasks):
+            if task in pending:
+                _stats["timed_out"] += 1
+                results.append({
+                    "model_name": target.label,
+                    "error": f"Review did not complete within {self.deadline:g} seconds.",
+                    "timed_out": True,
+                })
+            elif task.exception() is not None:
+                _stats["errors"] += 1
+                results.append({"model_name": target.label, "error": str(task.exception())})
+            else:
+                _stats["completed"] += 1
+                results.append({"model_name": target.label, "review": task.result()})
+        print(f"--- DEBUG: Review pipeline finished in {time.monotonic() - started:.1f}s. ---")
+        return results
+
+
+def pipeline_stats() -> Dict[str, Any]:
+    return {
+        "targets": [target.label for target in REVIEW_TARGETS],
+        "deadline_seconds": REVIEW_PIPELINE_DEADLINE_SECONDS,
+        **_stats,
+    }
+
+
+metrics_service.register("review_pipeline", pipeline_stats)
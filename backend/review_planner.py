@@ -0,0 +1,229 @@
+# backend/review_planner.py
+
+import os
+import re
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+import patch_service
+
+# 1回のレビュー呼び出しに含めるソースコードのトークン数の目安（プロンプトの定型部分は含まない）
+REVIEW_CHUNK_TOKEN_BUDGET = int(os.getenv("REVIEW_CHUNK_TOKEN_BUDGET", "12000"))
+
+# 関数・クラスなど、トップレベルの定義の開始とみなす行（インデントなし）
+_UNIT_BOUNDARY = re.compile(
+    r"^(?:async\s+def\s|def\s|class\s|@\w|"
+    r"(?:export\s+)?(?:default\s+)?(?:async\s+)?function[\s*]|"
+    r"export\s|(?:const|let|var)\s+\w+\s*=\s*(?:async\s*)?\(|"
+    r"(?:public|private|protected|internal|static)\s|"
+    r"func\s|fn\s|pub\s|impl\s|interface\s|type\s+\w+\s*=)"
+)
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    トークン数をローカルで概算します。ASCIIはおよそ4文字で1トークン、
+    日本語などの非ASCII文字はおよそ1文字で1トークンとして数えます。
+    """
+    non_ascii = sum(1 for ch in text if ord(ch) > 127)
+    return (len(text) - non_ascii) // 4 + non_ascii + 1
+
+
+def fitting_length(text: str, max_tokens: int) -> int:
+    """text の先頭から予算に収まる最長の文字数を二分探索で求める（文字の種類で1文字あたりのトークン数が異なるため）。"""
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if estimate_tokens(text[:middle]) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+@dataclass
+class ChunkPart:
+    file_name: str
+    start_line: int  # 元のファイルでの開始行（1始まり）
+    content: str
+    partial: bool = False  # ファイルの一部だけを含むか
+
+    @property
+    def end_line(self) -> int:
+        return self.start_line + self.content.count("\n")
+
+    @property
+    def display_name(self) -> str:
+        """プロンプト上のファイル名。ファイルの一部だけを含む場合は行範囲を付ける。"""
+        if not self.partial:
+            return self.file_name
+        return f"{self.file_name} (lines {self.start_line}-{self.end_line})"
+
+
+@dataclass
+class ReviewChunk:
+    parts: List[ChunkPart] = field(default_factory=list)
+    tokens: int = 0
+
+    def files(self) -> Dict[str, str]:
+        return {part.display_name: part.content for part in self.parts}
+
+    def resolve(self, file_name: Optional[str]) -> Optional[ChunkPart]:
+        """モデルが返したファイル名から、元のファイルの部分を特定する。"""
+        for part in self.parts:
+            if file_name in (part.display_name, part.file_name):
+                return part
+        return self.parts[0] if len(self.parts) == 1 else None
+
+
+def _is_attached_line(line: str) -> bool:
+    # 定義の直前にあるデコレーターやコメントは、その定義の一部として扱う
+    return line.lstrip().startswith(("@", "#", "//", "/*", "*"))
+
+
+def _split_units(content: str) -> List[Tuple[int, List[str]]]:
+    """ファイルをトップレベルの定義の境界で分割し、(開始行, 行のリスト) を返す。"""
+    units: List[Tuple[int, List[str]]] = []
+    current: List[str] = []
+    start = 1
+    for number, line in enumerate(content.split("\n"), start=1):
+        if _UNIT_BOUNDARY.match(line) and current:
+            attached = 0
+            while attached < len(current) and _is_attached_line(current[-1 - attached]):
+                attached += 1
+            head = current[:len(current) - attached]
+            if head:
+                units.append((start, head))
+                current = current[len(current) - attached:]
+                start = number - attached
+        current.append(line)
+    if current:
+        units.append((start, current))
+    return units
+
+
+def _split_file(file_name: str, content: str, budget: int) -> List[ChunkPart]:
+    """予算を超えるファイルを、定義の境界（それでも大きければ行単位）で予算内の部分に分ける。"""
+    parts: List[ChunkPart] = []
+    buffer: List[str] = []
+    buffer_start = 1
+    buffer_tokens = 0
+
+    def flush():
+        nonlocal buffer, buffer_tokens
+        if buffer:
+            parts.append(ChunkPart(file_name, buffer_start, "\n".join(buffer), partial=True))
+        buffer, buffer_tokens = [], 0
+
+    for unit_start, unit_lines in _split_units(content):
+        unit_tokens = estimate_tokens("\n".join(unit_lines))
+        if buffer and buffer_tokens + unit_tokens > budget:
+            flush()
+        if not buffer:
+            buffer_start = unit_start
+        if unit_tokens <= budget:
+            buffer.extend(unit_lines)
+            buffer_tokens += unit_tokens
+            continue
+        # 1つの定義だけで予算を超える場合は行単位で分割する
+        for offset, line in enumerate(unit_lines):
+            line_tokens = estimate_tokens(line)
+            if buffer and buffer_tokens + line_tokens > budget:
+                flush()
+                buffer_start = unit_start + offset
+            buffer.append(line)
+            buffer_tokens += line_tokens
+    flush()
+    return parts
+
+
+def split_text(content: str, budget: int) -> List[ChunkPart]:
+    """
+    1つのテキストを、定義の境界（それでも大きければ行単位）で予算内の部分に分けます。
+    予算内に収まる場合はそのまま1つの部分として返します。
+    """
+    if estimate_tokens(content) <= budget:
+        return [ChunkPart("", 1, content)]
+    return _split_file("", content, budget)
+
+
+def plan_chunks(files: Dict[str, str], budget: Optional[int] = None) -> List[ReviewChunk]:
+    """
+    ファイル群を、それぞれ予算内に収まるレビュー単位（チャンク）に分けます。
+    小さいファイルは1つのチャンクにまとめ、大きいファイルは定義の境界で分割します。
+    """
+    budget = budget or REVIEW_CHUNK_TOKEN_BUDGET
+    chunks: List[ReviewChunk] = []
+    open_chunk = ReviewChunk()
+    for file_name, content in files.items():
+        tokens = estimate_tokens(content)
+        if tokens > budget:
+            for part in _split_file(file_name, content, budget):
+                chunks.append(ReviewChunk(parts=[part], tokens=estimate_tokens(part.content)))
+            continue
+        if open_chunk.parts and open_chunk.tokens + tokens > budget:
+            chunks.append(open_chunk)
+            open_chunk = ReviewChunk()
+        open_chunk.parts.append(ChunkPart(file_name, 1, content))
+        open_chunk.tokens += tokens
+    if open_chunk.parts:
+        chunks.append(open_chunk)
+    return chunks
+
+
+def needs_chunking(files: Dict[str, str], budget: Optional[int] = None) -> bool:
+    budget = budget or REVIEW_CHUNK_TOKEN_BUDGET
+    return sum(estimate_tokens(content) for content in files.values()) > budget
+
+
+def merge_chunk_reviews(chunks: List[ReviewChunk], reviews: List[dict], failed: List[bool]) -> dict:
+    """
+    チャンクごとのレビューを1つのレビューに統合します。
+    ファイル名と行番号（差分のハンクヘッダーを含む）を元のファイル基準に戻し、
+    スコアはチャンクの大きさで重み付けした平均にします。
+    """
+    details = []
+    summaries = []
+    weighted_score = 0.0
+    total_weight = 0
+    for chunk, review, chunk_failed in zip(chunks, reviews, failed):
+        if chunk_failed:
+            first, last = chunk.parts[0], chunk.parts[-1]
+            details.append({
+                "category": "Error",
+                "file_name": first.file_name,
+                "line_number": first.start_line,
+                "description": f"{first.file_name} の {first.start_line} 行目から {last.file_name} の {last.end_line} 行目までのレビューに失敗しました。",
+                "suggestion": "",
+            })
+            continue
+
+        try:
+            score = float(review.get("overall_score", 0))
+        except (TypeError, ValueError):
+            score = 0.0
+        weighted_score += score * chunk.tokens
+        total_weight += chunk.tokens
+        if review.get("summary"):
+            summaries.append(review["summary"])
+
+        for detail in review.get("details", []):
+            part = chunk.resolve(detail.get("file_name"))
+            if part is not None:
+                offset = part.start_line - 1
+                detail["file_name"] = part.file_name
+                if isinstance(detail.get("line_number"), int):
+                    detail["line_number"] += offset
+                if offset and detail.get("suggestion_format") == "patch" and detail.get("suggestion"):
+                    detail["suggestion"] = patch_service.shift_patch(detail["suggestion"], offset)
+            details.append(detail)
+
+    if not total_weight:
+        raise ValueError("All review chunks failed.")
+
+    return {
+        "overall_score": round(weighted_score / total_weight),
+        "summary": " ".join(summaries),
+        "details": sorted(details, key=lambda d: (str(d.get("file_name")), d.get("line_number") or 0)),
+        "chunks": len(chunks),
+    }
@@ -0,0 +1,95 @@
+# backend/review_stream_parser.py
+
+import json
+from typing import Any, Dict, List
+
+
+class IncrementalReviewParser:
+    """
+    ストリーミングで届くレビューJSONを少しずつ読み進め、
+    "details" 配列の要素が1つ完成するたびに取り出せるようにするパーサー。
+
+    完全なJSONパーサーではなく、文字列・エスケープ・括弧の深さだけを追跡する。
+    JSONの前後にMarkdownの囲いや説明文が付いていても、最初の '{' から解析を始める。
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._string_start = -1
+        self._last_key = None
+        self._in_details = False
+        self._item_start = -1
+        self.root_start = -1
+        self.root_end = -1
+        self.details: List[Dict[str, Any]] = []
+
+    def feed(self, text: str) -> List[Dict[str, Any]]:
+        """テキスト片を追加し、新たに完成した details の要素を返す。"""
+        self.buffer += text
+        completed = []
+        buf = self.buffer
+        while self._pos < len(buf):
+            ch = buf[self._pos]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    if self._depth == 1:
+                        # ルートオブジェクト直下の文字列は、直後に ':' が来ればキーになる
+                        self._last_key = buf[self._string_start + 1:self._pos]
+            elif self.root_end != -1:
+                break
+            elif ch == '"':
+                if self._depth >= 1:
+                    self._in_string = True
+                    self._string_start = self._pos
+            elif ch in "{[":
+                if self._depth == 0 and ch == "{":
+                    self.root_start = self._pos
+                if self._depth >= 1 or self.root_start != -1:
+                    self._depth += 1
+                    if ch == "[" and self._depth == 2 and self._last_key == "details":
+                        self._in_details = True
+                    elif ch == "{" and self._depth == 3 and self._in_details:
+                        self._item_start = self._pos
+            elif ch in "}]":
+                if self._depth >= 1:
+                    if ch == "}" and self._depth == 3 and self._in_details and self._item_start != -1:
+                        item = self._load_item(buf[self._item_start:self._pos + 1])
+                        if item is not None:
+                            self.details.append(item)
+                            completed.append(item)
+                        self._item_start = -1
+                    elif ch == "]" and self._depth == 2 and self._in_details:
+                        self._in_details = False
+                    self._depth -= 1
+                    if self._depth == 0:
+                        self.root_end = self._pos + 1
+            self._pos += 1
+        return completed
+
+    @staticmethod
+    def _load_item(text: str):
+        try:
+            item = json.loads(text)
+        except json.JSONDecodeError:
+            return None
+        return item if isinstance(item, dict) else None
+
+    @property
+    def is_complete(self) -> bool:
+        return self.root_end != -1
+
+    def root_text(self) -> str:
+        """ルートオブジェクトの範囲の文字列（未完成ならその途中まで）を返す。"""
+        if self.root_start == -1:
+            return ""
+        end = self.root_end if self.root_end != -1 else len(self.buffer)
+        return self.buffer[self.root_start:end]
@@ -1,4 +1,4 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from typing import List, Dict, Optional
 from datetime import datetime
 
@@ -69,6 +69,27 @@ class ProjectReorderRequest(BaseModel):
 class CodeInspectionRequest(BaseModel):
     code: str
     language: Optional[str] = None
+    # "full": 提案ごとにファイル全体のコード / "patch": 提案ごとにunified diff
+    suggestion_format: str = "full"
+
+class BatchInspectionItem(BaseModel):
+    file_name: str
+    code: str
+    language: Optional[str] = None
+
+class BatchInspectionRequest(BaseModel):
+    items: List[BatchInspectionItem]
+    suggestion_format: str = "full"
+    # True の場合、ファイルごとの結果をSSEで完了した順に返す
+    stream: bool = False
+
+# 認証なしで呼べるため、1回の適用で扱う大きさに上限を設ける（文字数）
+APPLY_PATCH_MAX_CODE_CHARS = 500_000
+APPLY_PATCH_MAX_PATCH_CHARS = 200_000
+
+class ApplyPatchRequest(BaseModel):
+    original_code: str = Field(..., max_length=APPLY_PATCH_MAX_CODE_CHARS)
+    patch: str = Field(..., max_length=APPLY_PATCH_MAX_PATCH_CHARS)
 
 class GenerateTestRequest(BaseModel):
     original_code: str
@@ -85,7 +106,10 @@ class SnykScanRequest(BaseModel):
     language: str
     
 class ChatRequest(BaseModel):
-    chat_history: List[Dict[str, str]]
+    # 会話の履歴はサーバー側で保持するため、新しい質問だけを message に入れて送ればよい。
+    # 従来どおり chat_history を送った場合は、その最後のメッセージを新しい質問として扱う
+    chat_history: List[Dict[str, str]] = []
+    message: Optional[str] = None
     project_id: int
 
 # Pydantic v2では、前方参照の解決は通常自動で行われるため、
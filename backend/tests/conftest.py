@@ -0,0 +1,10 @@
+# backend/tests/conftest.py
+
+import os
+import sys
+
+# backend のモジュールは互いに `import crud` のように参照するため、backend ディレクトリを import パスに入れる
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# database.py は import 時にエンジンを作る（接続はしない）ため、DATABASE_URL が未設定でも読み込めるようにする
+os.environ.setdefault("DATABASE_URL", "postgresql://localhost/refix_test")
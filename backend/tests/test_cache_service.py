@@ -0,0 +1,66 @@
+# backend/tests/test_cache_service.py
+
+import asyncio
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+cache_service = pytest.importorskip("cache_service")
+
+
+@pytest.fixture
+def review_cache(monkeypatch):
+    monkeypatch.setattr(cache_service, "_review_memory_cache", cache_service.LRUCache(8, ttl_seconds=3600))
+    monkeypatch.setattr(cache_service, "_review_stats", {"db_hits": 0, "db_misses": 0, "db_errors": 0, "writes": 0})
+    monkeypatch.setattr(cache_service, "REVIEW_CACHE_PERSISTENT", True)
+    return cache_service._review_memory_cache
+
+
+def test_lru_entry_with_its_own_ttl_expires_before_the_cache_ttl():
+    cache = cache_service.LRUCache(4, ttl_seconds=3600)
+    cache.set("short", "value", ttl_seconds=0.01)
+    cache.set("long", "value")
+    time.sleep(0.02)
+
+    assert cache.get("short") is None
+    assert cache.get("long") == "value"
+
+
+def test_review_promoted_from_the_database_keeps_the_rows_remaining_lifetime(monkeypatch, review_cache):
+    expires_at = datetime.now(timezone.utc) + timedelta(seconds=0.05)
+    rows = {"key": ({"overall_score": 70}, expires_at)}
+    monkeypatch.setattr(cache_service, "_db_get_review", lambda key: rows.get(key))
+
+    assert asyncio.run(cache_service.get_review("key")) == {"overall_score": 70}
+    assert review_cache.get("key") is not None
+
+    # 行の有効期限を過ぎたら、メモリ層からも消えている
+    rows.clear()
+    time.sleep(0.06)
+    assert review_cache.get("key") is None
+    assert asyncio.run(cache_service.get_review("key")) is None
+
+
+def test_expired_row_is_not_promoted(monkeypatch, review_cache):
+    expired = datetime.now(timezone.utc) - timedelta(seconds=1)
+    monkeypatch.setattr(cache_service, "_db_get_review", lambda key: ({"overall_score": 70}, expired))
+
+    asyncio.run(cache_service.get_review("key"))
+
+    assert len(review_cache) == 0
+
+
+def test_concurrent_writes_sweep_once_per_interval(monkeypatch, review_cache):
+    monkeypatch.setattr(cache_service, "REVIEW_CACHE_SWEEP_INTERVAL", 5)
+    sweeps = []
+    monkeypatch.setattr(cache_service, "_db_set_review", lambda key, review, mode, model_name, sweep: sweeps.append(sweep))
+
+    async def scenario():
+        await asyncio.gather(*[cache_service.set_review(f"key{index}", {}, "balanced", "model") for index in range(10)])
+
+    asyncio.run(scenario())
+
+    assert len(sweeps) == 10
+    assert sweeps.count(True) == 2
@@ -0,0 +1,71 @@
+# backend/tests/test_concurrency_limiter.py
+
+import asyncio
+
+import concurrency_limiter
+
+
+def test_a_saturated_model_does_not_block_other_models_of_the_same_provider(monkeypatch):
+    monkeypatch.setattr(concurrency_limiter, "_limiters", {})
+
+    async def scenario():
+        limiters = concurrency_limiter._limiters
+        limiters["openai"] = concurrency_limiter.AdaptiveLimiter("openai", 2, 1, 2)
+        limiters["openai:slow-model"] = concurrency_limiter.AdaptiveLimiter("openai:slow-model", 1, 1, 1)
+
+        release_slow = asyncio.Event()
+
+        async def call_slow():
+            async with concurrency_limiter.limit("openai", "slow-model"):
+                await release_slow.wait()
+
+        async def call_fast():
+            async with concurrency_limiter.limit("openai", "fast-model"):
+                return "done"
+
+        # 1つ目が slow-model の枠を占有し、残りは slow-model の順番待ちになる
+        slow_calls = [asyncio.create_task(call_slow()) for _ in range(3)]
+        await asyncio.sleep(0.01)
+
+        # 順番待ちの呼び出しがプロバイダーの枠を抱えていなければ、別モデルはすぐ通る
+        result = await asyncio.wait_for(call_fast(), timeout=1)
+        provider_in_flight = limiters["openai"].in_flight
+
+        release_slow.set()
+        await asyncio.gather(*slow_calls)
+        return result, provider_in_flight
+
+    result, provider_in_flight = asyncio.run(scenario())
+
+    assert result == "done"
+    assert provider_in_flight == 1
+
+
+def test_limiters_are_released_in_reverse_order_after_a_throttled_call(monkeypatch):
+    monkeypatch.setattr(concurrency_limiter, "_limiters", {})
+    released = []
+
+    class RateLimitError(Exception):
+        pass
+
+    async def scenario():
+        for name in ("openai", "openai:model"):
+            limiter = concurrency_limiter.get_limiter(name)
+            original_release = limiter.release
+
+            async def release(outcome, retry_after=None, _name=name, _original=original_release):
+                released.append((_name, outcome))
+                await _original(outcome, retry_after)
+
+            limiter.release = release
+
+        try:
+            async with concurrency_limiter.limit("openai", "model"):
+                raise RateLimitError()
+        except RateLimitError:
+            pass
+
+    asyncio.run(scenario())
+
+    assert released == [("openai", "throttled"), ("openai:model", "throttled")]
+    assert all(limiter.in_flight == 0 for limiter in concurrency_limiter._limiters.values())
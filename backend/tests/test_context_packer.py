@@ -0,0 +1,85 @@
+# backend/tests/test_context_packer.py
+
+from types import SimpleNamespace
+
+import context_packer
+from review_planner import estimate_tokens
+
+
+def _match(content: str, embedding, role: str = "user", start_line: int = 1, message_content: str = None):
+    message = SimpleNamespace(role=role, content=message_content if message_content is not None else content)
+    return SimpleNamespace(message=message, content=content, start_line=start_line, embedding=embedding)
+
+
+def test_short_messages_are_packed_whole_in_relevance_order():
+    matches = [_match("far", [0.0, 1.0]), _match("near", [1.0, 0.1])]
+    packed = context_packer.pack_memories(matches, [1.0, 0.0], [], token_budget=500)
+    assert [memory.content for memory in packed] == ["near", "far"]
+    assert all(memory.whole_message for memory in packed)
+    assert packed[0].render() == "- user: near\n"
+
+
+def test_near_duplicates_are_dropped():
+    matches = [_match("first", [1.0, 0.0]), _match("copy", [0.999, 0.01]), _match("other", [0.6, 0.8])]
+    packed = context_packer.pack_memories(matches, [1.0, 0.0], [], token_budget=500)
+    assert [memory.content for memory in packed] == ["first", "other"]
+
+
+def test_mmr_prefers_diverse_memories_over_redundant_ones(monkeypatch):
+    monkeypatch.setattr(context_packer, "MEMORY_MMR_LAMBDA", 0.5)
+    monkeypatch.setattr(context_packer, "MEMORY_DUPLICATE_SIMILARITY", 1.1)
+    # a2 は a とほぼ同じ向き。関連度は b より高いが、a を選んだ後は b の方が先に選ばれる
+    matches = [_match("a", [0.9, 0.436, 0.0]), _match("a2", [0.88, 0.45, 0.07]), _match("b", [0.85, -0.527, 0.0])]
+    packed = context_packer.pack_memories(matches, [1.0, 0.0, 0.0], [], token_budget=500)
+    assert [memory.content for memory in packed] == ["a", "b", "a2"]
+
+
+def test_total_tokens_stay_within_budget():
+    matches = [_match(f"memory {i} " + "word " * 60, [1.0, i / 10]) for i in range(10)]
+    budget = 200
+    packed = context_packer.pack_memories(matches, [1.0, 0.0], [], token_budget=budget)
+    assert packed
+    assert sum(memory.tokens for memory in packed) <= budget
+    assert sum(estimate_tokens(memory.render()) for memory in packed) <= budget
+
+
+def test_long_memory_is_cut_around_the_query_terms(monkeypatch):
+    monkeypatch.setattr(context_packer, "MEMORY_SNIPPET_MAX_TOKENS", 60)
+    lines = [f"    filler_{i} = compute_something({i})" for i in range(200)]
+    lines[120] = "def parse_review(raw):"
+    content = "\n".join(lines)
+    packed = context_packer.pack_memories([_match(content, [1.0], start_line=11)], [1.0], ["parse_review"], token_budget=500)
+    (memory,) = packed
+    assert not memory.whole_message
+    assert "def parse_review(raw):" in memory.content
+    assert memory.start_line <= 131 <= memory.end_line
+    assert memory.render().startswith(f"- user (lines {memory.start_line}-{memory.end_line}): ")
+
+
+def test_extract_span_returns_short_text_unchanged():
+    assert context_packer.extract_span("a\nb", 5, ["x"], 100) == ("a\nb", 5, 6, False)
+
+
+def test_extract_span_truncates_a_single_huge_line():
+    text, start, end, truncated = context_packer.extract_span("x" * 10000, 1, [], 50)
+    assert truncated and start == end == 1
+    assert estimate_tokens(text) <= 50
+
+    # 非ASCIIの文字は1文字でおよそ1トークンになるため、文字数の固定の比率では予算を超えてしまう
+    text, start, end, truncated = context_packer.extract_span("あ" * 10000, 1, [], 50)
+    assert truncated and start == end == 1
+    assert 0 < estimate_tokens(text) <= 50
+
+
+def test_memories_without_embeddings_use_the_median_relevance():
+    matches = [_match("high", [1.0, 0.0]), _match("none", None), _match("low", [0.0, 1.0])]
+    packed = context_packer.pack_memories(matches, [1.0, 0.0], [], token_budget=500)
+    assert [memory.content for memory in packed][0] == "high"
+    assert {memory.content for memory in packed} == {"high", "none", "low"}
+
+
+def test_chunk_of_a_longer_message_is_not_rendered_as_whole():
+    match = _match("def f():\n    pass", [1.0], start_line=40, message_content="x = 1\n" * 40 + "def f():\n    pass")
+    (memory,) = context_packer.pack_memories([match], [1.0], [], token_budget=500)
+    assert not memory.whole_message
+    assert memory.render() == "- user (lines 40-41): def f():\n    pass\n"
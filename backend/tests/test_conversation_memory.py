@@ -0,0 +1,47 @@
+# backend/tests/test_conversation_memory.py
+
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+conversation_memory = pytest.importorskip("conversation_memory")
+
+
+def _messages(*roles):
+    return [SimpleNamespace(role=role, content=f"{role} {index}") for index, role in enumerate(roles)]
+
+
+def _load(monkeypatch, messages, summary=None):
+    async def fake_unsummarized(db, conversation, limit, newest=False):
+        return messages
+
+    monkeypatch.setattr(conversation_memory.crud, "aget_unsummarized_messages", fake_unsummarized)
+    return asyncio.run(conversation_memory.load_chat_context(None, SimpleNamespace(summary=summary)))
+
+
+def test_history_cut_at_an_assistant_turn_starts_at_the_next_user_turn(monkeypatch):
+    summary, history = _load(monkeypatch, _messages("assistant", "user", "assistant", "user"), summary="earlier")
+
+    assert summary == "earlier"
+    assert [message["role"] for message in history] == ["user", "assistant", "user"]
+    assert history[0]["content"] == "user 1"
+
+
+def test_history_starting_with_a_user_turn_is_unchanged(monkeypatch):
+    _, history = _load(monkeypatch, _messages("user", "assistant", "user"))
+
+    assert [message["content"] for message in history] == ["user 0", "assistant 1", "user 2"]
+
+
+@pytest.mark.parametrize("char", ["x", "あ"])
+def test_clip_keeps_long_messages_within_the_token_cap(monkeypatch, char):
+    monkeypatch.setattr(conversation_memory, "CHAT_SUMMARY_MESSAGE_MAX_TOKENS", 90)
+    content = "start" + char * 5000 + "end"
+
+    clipped = conversation_memory._clip(content)
+
+    assert clipped.startswith("start") and clipped.endswith("end")
+    assert "（中略）" in clipped
+    assert conversation_memory.estimate_tokens(clipped) <= 90
@@ -0,0 +1,52 @@
+# backend/tests/test_embedding_batcher.py
+
+import asyncio
+import threading
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+memory_service = pytest.importorskip("memory_service")
+
+
+def test_embed_many_returns_vectors_in_order(monkeypatch):
+    monkeypatch.setattr(memory_service, "_encode", lambda texts: [[float(len(text))] for text in texts])
+    batcher = memory_service.EmbeddingBatcher(max_batch_size=8, max_wait_seconds=0.001)
+
+    async def scenario():
+        try:
+            return await batcher.embed_many(["a", "bbb", "cc"])
+        finally:
+            await batcher.stop()
+
+    assert asyncio.run(scenario()) == [[1.0], [3.0], [2.0]]
+
+
+def test_stop_fails_queued_and_in_flight_requests_instead_of_hanging(monkeypatch):
+    encoding, release = threading.Event(), threading.Event()
+
+    def slow_encode(texts):
+        encoding.set()
+        release.wait(timeout=5)
+        return [[0.0] for _ in texts]
+
+    monkeypatch.setattr(memory_service, "_encode", slow_encode)
+    batcher = memory_service.EmbeddingBatcher(max_batch_size=1, max_wait_seconds=0)
+
+    async def scenario():
+        # 1件目がベクトル化の途中で、残りはキューで待っている状態で止める
+        calls = [asyncio.create_task(batcher.embed_many([f"text {index}"])) for index in range(3)]
+        await asyncio.to_thread(encoding.wait, 5)
+        await batcher.stop()
+        results = await asyncio.wait_for(asyncio.gather(*calls, return_exceptions=True), timeout=1)
+        release.set()
+        return results
+
+    try:
+        results = asyncio.run(scenario())
+    finally:
+        release.set()
+        batcher._executor.shutdown(wait=True)
+
+    assert len(results) == 3
+    assert all(isinstance(result, RuntimeError) for result in results)
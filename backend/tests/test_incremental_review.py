@@ -0,0 +1,96 @@
+# backend/tests/test_incremental_review.py
+
+import incremental_review
+
+OLD = "\n".join(f"line {i}" for i in range(1, 41))
+
+
+def _replace(code: str, line: int, text: str) -> str:
+    lines = code.split("\n")
+    lines[line - 1] = text
+    return "\n".join(lines)
+
+
+def test_identical_code_has_no_changes():
+    diff = incremental_review.diff_code(OLD, OLD)
+    assert not diff.has_changes
+    assert diff.change_ratio == 0
+    assert diff.line_map[40] == 40
+
+
+def test_inserted_lines_shift_the_line_map():
+    new = "import os\nimport sys\n" + OLD
+    diff = incremental_review.diff_code(OLD, new)
+    assert diff.changed_ranges == [(1, 2)]
+    assert diff.line_map[1] == 3
+    assert diff.line_map[40] == 42
+
+
+def test_deleted_lines_are_dropped_from_the_map_and_mark_the_next_line():
+    new = "\n".join(line for line in OLD.split("\n") if line not in ("line 10", "line 11"))
+    diff = incremental_review.diff_code(OLD, new)
+    assert 10 not in diff.line_map and 11 not in diff.line_map
+    assert diff.line_map[12] == 10
+    assert diff.changed_ranges == [(10, 10)]
+    assert diff.has_changes
+
+
+def test_review_windows_add_context_and_merge_overlaps():
+    new = _replace(_replace(_replace(OLD, 5, "five"), 9, "nine"), 35, "thirty-five")
+    diff = incremental_review.diff_code(OLD, new)
+    assert incremental_review.review_windows(diff, context=2) == [(3, 11), (33, 37)]
+    assert incremental_review.review_windows(diff, context=0) == [(5, 5), (9, 9), (35, 35)]
+
+
+def test_build_chunk_keeps_original_line_numbers():
+    new = _replace(OLD, 20, "twenty")
+    diff = incremental_review.diff_code(OLD, new)
+    windows = incremental_review.review_windows(diff, context=1)
+    chunk = incremental_review.build_chunk("app.py", diff, windows)
+    (part,) = chunk.parts
+    assert part.start_line == 19
+    assert part.content == "line 19\ntwenty\nline 21"
+    assert chunk.files() == {"app.py (lines 19-21)": part.content}
+
+
+def test_carry_forward_remaps_details_outside_the_reviewed_windows():
+    new = "# header\n" + _replace(OLD, 20, "twenty")
+    diff = incremental_review.diff_code(OLD, new)
+    windows = incremental_review.review_windows(diff, context=1)
+    previous = [
+        {"category": "Bug", "line_number": 5, "suggestion": ""},
+        {"category": "Bug", "line_number": 20, "suggestion": ""},  # 変更された行
+        {"category": "Bug", "line_number": 21, "suggestion": ""},  # レビューし直す範囲の中
+        {"category": "Error", "line_number": 30, "suggestion": ""},
+    ]
+    carried = incremental_review.carry_forward_details(previous, diff, windows, OLD, new)
+    assert [(d["line_number"], d["carried_forward"]) for d in carried] == [(6, True)]
+    assert previous[0]["line_number"] == 5
+
+
+def test_carry_forward_shifts_patch_suggestions():
+    new = "# header\n" + OLD
+    diff = incremental_review.diff_code(OLD, new)
+    previous = [{
+        "category": "Bug", "line_number": 30, "suggestion_format": "patch",
+        "suggestion": "@@ -30,1 +30,1 @@\n-line 30\n+thirty",
+    }]
+    (detail,) = incremental_review.carry_forward_details(previous, diff, [(1, 1)], OLD, new)
+    assert detail["suggestion"].startswith("@@ -31,1 +31,1 @@")
+    assert detail["patch_valid"]
+
+
+def test_carry_forward_rebases_full_file_suggestions():
+    new = "# header\n" + OLD
+    diff = incremental_review.diff_code(OLD, new)
+    previous = [{"category": "Bug", "line_number": 30, "suggestion": _replace(OLD, 30, "thirty")}]
+    (detail,) = incremental_review.carry_forward_details(previous, diff, [(1, 1)], OLD, new)
+    assert detail["suggestion"] == _replace(new, 31, "thirty")
+
+
+def test_full_file_suggestion_that_no_longer_applies_is_cleared():
+    new = _replace(OLD, 30, "changed")
+    diff = incremental_review.diff_code(OLD, new)
+    previous = [{"category": "Bug", "line_number": 5, "suggestion": _replace(OLD, 30, "thirty")}]
+    (detail,) = incremental_review.carry_forward_details(previous, diff, [(29, 31)], OLD, new)
+    assert detail["suggestion"] == ""
@@ -0,0 +1,142 @@
+# backend/tests/test_local_vector_index.py
+
+import threading
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("sqlalchemy")
+local_vector_index = pytest.importorskip("local_vector_index")
+
+DIM = 4
+
+
+def _vector(*values):
+    return list(values) + [0.0] * (DIM - len(values))
+
+
+def _empty_index(project_id=1, watermark=(0, 0, 0, 0)):
+    return local_vector_index.ProjectIndex(
+        project_id,
+        np.zeros((0, DIM), dtype=np.float32),
+        np.zeros(0, dtype=np.int64),
+        np.zeros(0, dtype=np.int64),
+        watermark,
+    )
+
+
+def _query(*values):
+    return local_vector_index._normalize(np.asarray(_vector(*values), dtype=np.float32))
+
+
+def test_replace_message_replaces_the_previous_rows_of_the_message():
+    index = _empty_index()
+    index.replace_message(10, [(None, _vector(1.0))])
+    index.replace_message(11, [(None, _vector(0.0, 1.0))])
+
+    index.replace_message(10, [(100, _vector(0.0, 0.0, 1.0)), (101, _vector(0.0, 0.0, 0.9, 0.1))])
+
+    assert index.rows == 3
+    hits = index.search(_query(1.0), limit=5)
+    assert {hit.message_id for hit in hits} == {10, 11}
+    # 置き換え前のメッセージ全体のベクトルは検索されない
+    assert all(hit.chunk_id is not None for hit in hits if hit.message_id == 10)
+    assert index.dirty
+
+
+def test_replace_message_compacts_when_too_many_rows_are_deleted():
+    index = _empty_index()
+    for message_id in range(4):
+        index.replace_message(message_id, [(None, _vector(1.0, float(message_id)))])
+
+    index.replace_message(0, [])
+    index.replace_message(1, [])
+
+    # 削除済みの行が一定の割合を超えると詰め直され、有効な行だけが残る
+    assert index._size == index.rows == 2
+    assert sorted(int(message_id) for message_id in index._message_ids[:index._size]) == [2, 3]
+    assert {hit.message_id for hit in index.search(_query(1.0), limit=5)} == {2, 3}
+
+
+def test_search_returns_each_message_once_with_its_closest_chunk():
+    index = _empty_index()
+    index.replace_message(1, [(10, _vector(1.0)), (11, _vector(0.9, 0.1)), (12, _vector(0.8, 0.2))])
+    index.replace_message(2, [(20, _vector(0.0, 1.0))])
+
+    hits = index.search(_query(1.0), limit=2)
+
+    assert [hit.message_id for hit in hits] == [1, 2]
+    assert hits[0].chunk_id == 10
+    assert hits[0].distance == pytest.approx(0.0, abs=1e-6)
+
+
+def test_snapshot_round_trip_keeps_vectors_and_watermark(tmp_path):
+    index = _empty_index(project_id=7, watermark=(2, 21, 1, 9))
+    index.replace_message(1, [(20, _vector(1.0)), (21, _vector(0.0, 1.0))])
+    index.replace_message(9, [(None, _vector(0.0, 0.0, 1.0))])
+    index.save(str(tmp_path))
+
+    loaded = local_vector_index.ProjectIndex.load_snapshot(str(tmp_path), 7)
+
+    assert not index.dirty
+    assert loaded is not None
+    assert loaded.watermark == (2, 21, 1, 9)
+    assert loaded.rows == 3
+    assert [(hit.message_id, hit.chunk_id) for hit in loaded.search(_query(0.0, 0.0, 1.0), limit=1)] == [(9, None)]
+    # memory-map したスナップショットにも追加できる
+    loaded.replace_message(9, [(None, _vector(0.0, 0.0, 0.0, 1.0))])
+    assert loaded.search(_query(0.0, 0.0, 0.0, 1.0), limit=1)[0].message_id == 9
+
+
+def test_load_snapshot_returns_none_when_missing(tmp_path):
+    assert local_vector_index.ProjectIndex.load_snapshot(str(tmp_path), 1) is None
+
+
+def test_put_evicts_and_saves_the_least_recently_used_project(tmp_path):
+    cache = local_vector_index.LocalVectorIndex(max_projects=2, directory=str(tmp_path))
+    for project_id in (1, 2):
+        index = _empty_index(project_id)
+        index.replace_message(project_id, [(None, _vector(1.0))])
+        cache._put(index)
+    cache._get(1)  # 1を使ったので、最も長く使われていないのは2になる
+
+    cache._put(_empty_index(3))
+
+    assert cache._get(2) is None
+    assert cache._get(1) is not None and cache._get(3) is not None
+    assert cache.stats()["evictions"] == 1
+    assert local_vector_index.ProjectIndex.load_snapshot(str(tmp_path), 2) is not None
+
+
+def test_replace_during_a_load_is_applied_to_the_loaded_index(tmp_path, monkeypatch):
+    cache = local_vector_index.LocalVectorIndex(max_projects=2, directory=str(tmp_path))
+    read_done, replaced = threading.Event(), threading.Event()
+
+    class FakeSession:
+        def close(self):
+            pass
+
+    def fake_load_from_database(db, project_id, watermark):
+        # データベースを読み終えた後、インデックスを登録する前にメッセージが保存される
+        index = _empty_index(project_id, watermark)
+        index.replace_message(1, [(None, _vector(1.0))])
+        read_done.set()
+        replaced.wait(timeout=5)
+        return index
+
+    monkeypatch.setattr(local_vector_index, "SessionLocal", FakeSession)
+    monkeypatch.setattr(local_vector_index, "_watermark", lambda db, project_id: (0, 0, 1, 1))
+    monkeypatch.setattr(local_vector_index, "_load_from_database", fake_load_from_database)
+
+    cache.schedule_load(5)
+    assert read_done.wait(timeout=5)
+    cache.replace_message(5, 2, [(None, _vector(0.0, 1.0))])
+    replaced.set()
+    cache._loader.shutdown(wait=True)
+
+    index = cache._get(5)
+    assert index is not None
+    assert {hit.message_id for hit in index.search(_query(0.0, 1.0), limit=5)} == {1, 2}
+    # 読み込み後に追加されたため、次に古くなったときはデータベースから読み込み直す
+    assert index.watermark is None
+    assert cache._pending == {}
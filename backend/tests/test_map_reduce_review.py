@@ -0,0 +1,75 @@
+# backend/tests/test_map_reduce_review.py
+
+import asyncio
+import re
+
+import pytest
+
+pytest.importorskip("google.generativeai")
+pytest.importorskip("sqlalchemy")
+ai_partner = pytest.importorskip("ai_partner")
+
+import review_planner
+
+
+def _large_file(functions: int = 6) -> str:
+    return "\n".join(f"def func_{i}():\n    return {i}\n" for i in range(functions))
+
+
+def _chunk_review(files: dict) -> dict:
+    """チャンクの先頭の関数の戻り値を変える差分を、チャンク内の行番号で返す。"""
+    details = []
+    for display_name, content in files.items():
+        first_line = content.split("\n")[1]
+        details.append({
+            "category": "Bug",
+            "file_name": display_name,
+            "line_number": 2,
+            "description": "wrong value",
+            "suggestion": f"@@ -2,1 +2,1 @@\n-{first_line}\n+{first_line} + 1",
+            "suggestion_format": "patch",
+            "patch_valid": True,
+        })
+    return {"overall_score": 80, "summary": "ok", "details": details, "responding_model": "fake-model"}
+
+
+def test_chunked_full_review_returns_whole_files(monkeypatch):
+    code = _large_file()
+    monkeypatch.setattr(review_planner, "REVIEW_CHUNK_TOKEN_BUDGET", 20)
+    formats = []
+
+    async def fake_generate_review(files, mode, hedge, suggestion_format):
+        formats.append(suggestion_format)
+        return _chunk_review(files)
+
+    monkeypatch.setattr(ai_partner, "_generate_review", fake_generate_review)
+    review = asyncio.run(ai_partner.generate_structured_review({"app.py": code}, "", "balanced", hedge=False))
+
+    assert review["chunks"] > 1
+    assert set(formats) == {"patch"}
+    assert review["details"]
+    for detail in review["details"]:
+        assert detail["file_name"] == "app.py"
+        assert "suggestion_format" not in detail
+        # 差分ではなく、該当の行だけを直したファイル全体が返る
+        assert not re.search(r"^@@ ", detail["suggestion"], re.MULTILINE)
+        assert detail["suggestion"].split("\n") != code.split("\n")
+        assert len(detail["suggestion"].split("\n")) == len(code.split("\n"))
+        changed = detail["suggestion"].split("\n")[detail["line_number"] - 1]
+        assert changed.endswith(" + 1")
+
+
+def test_chunked_patch_review_keeps_shifted_diffs(monkeypatch):
+    code = _large_file()
+    monkeypatch.setattr(review_planner, "REVIEW_CHUNK_TOKEN_BUDGET", 20)
+
+    async def fake_generate_review(files, mode, hedge, suggestion_format):
+        return _chunk_review(files)
+
+    monkeypatch.setattr(ai_partner, "_generate_review", fake_generate_review)
+    review = asyncio.run(ai_partner.generate_structured_review(
+        {"app.py": code}, "", "balanced", hedge=False, suggestion_format="patch"
+    ))
+
+    for detail in review["details"]:
+        assert detail["suggestion"].startswith(f"@@ -{detail['line_number']},1 ")
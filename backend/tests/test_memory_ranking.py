@@ -0,0 +1,61 @@
+# backend/tests/test_memory_ranking.py
+
+from types import SimpleNamespace
+
+import memory_ranking
+
+
+def _match(message_id: int, source: str):
+    return SimpleNamespace(message=SimpleNamespace(id=message_id), source=source)
+
+
+def _ids(matches) -> list:
+    return [match.message.id for match in matches]
+
+
+def test_rrf_prefers_messages_found_by_both_searches():
+    vector = [_match(1, "vector"), _match(2, "vector"), _match(3, "vector")]
+    lexical = [_match(4, "lexical"), _match(3, "lexical"), _match(5, "lexical")]
+    fused = memory_ranking.reciprocal_rank_fusion([vector, lexical], limit=5, k=60)
+    assert _ids(fused)[0] == 3
+    assert sorted(_ids(fused)) == [1, 2, 3, 4, 5]
+
+
+def test_rrf_keeps_the_match_from_the_better_ranked_list():
+    vector = [_match(1, "vector"), _match(2, "vector")]
+    lexical = [_match(2, "lexical")]
+    fused = memory_ranking.reciprocal_rank_fusion([vector, lexical], limit=2)
+    assert {match.message.id: match.source for match in fused}[2] == "lexical"
+
+
+def test_rrf_breaks_ties_by_first_seen_and_respects_limit():
+    fused = memory_ranking.reciprocal_rank_fusion([[_match(1, "a"), _match(2, "a")], [_match(3, "b"), _match(4, "b")]], limit=3)
+    assert _ids(fused) == [1, 3, 2]
+
+
+def test_rrf_with_an_empty_list_keeps_the_other_order():
+    vector = [_match(i, "vector") for i in range(1, 6)]
+    assert _ids(memory_ranking.reciprocal_rank_fusion([vector, []], limit=3)) == [1, 2, 3]
+    assert memory_ranking.reciprocal_rank_fusion([[], []], limit=3) == []
+
+
+def test_lexical_terms_prioritize_quotes_and_identifiers():
+    question = 'Why does parse_review raise "Expecting value: line 1" in ReviewPipeline.run with the cache?'
+    terms = memory_ranking.lexical_terms(question)
+    assert terms[0] == "Expecting value: line 1"
+    assert terms[1:3] == ["parse_review", "ReviewPipeline.run"]
+    assert "cache" in terms
+    assert "Why" not in terms and "does" not in terms
+
+
+def test_lexical_terms_deduplicate_and_cap():
+    question = " ".join(f"name_{i} NAME_{i}" for i in range(20))
+    terms = memory_ranking.lexical_terms(question)
+    assert len(terms) == memory_ranking._MAX_LEXICAL_TERMS
+    assert len({term.lower() for term in terms}) == len(terms)
+
+
+def test_lexical_terms_ignore_japanese_sentences():
+    assert memory_ranking.lexical_terms("この関数はなぜ遅いのですか") == []
+    assert memory_ranking.lexical_terms("「タイムアウトしました」と出ます") == ["タイムアウトしました"]
+    assert memory_ranking.lexical_terms("") == []
@@ -0,0 +1,91 @@
+# backend/tests/test_patch_service.py
+
+import pytest
+
+import patch_service
+from patch_service import PatchError
+
+ORIGINAL = "\n".join(f"line {i}" for i in range(1, 21))
+
+
+def test_applies_simple_hunk():
+    patch = "@@ -3,3 +3,3 @@\n line 3\n-line 4\n+LINE 4\n line 5"
+    result = patch_service.apply_patch(ORIGINAL, patch).split("\n")
+    assert result[3] == "LINE 4"
+    assert len(result) == 20
+
+
+def test_ignores_code_fence_and_file_headers():
+    patch = "```diff\n--- a/app.py\n+++ b/app.py\n@@ -1,2 +1,2 @@\n-line 1\n+first\n line 2\n```"
+    assert patch_service.apply_patch(ORIGINAL, patch).split("\n")[0] == "first"
+
+
+def test_applies_hunk_with_wrong_line_numbers_within_fuzz():
+    # ヘッダーの行番号が 5 行ずれていても、前後を探して一致する位置に適用する
+    patch = "@@ -10,2 +10,2 @@\n line 15\n-line 16\n+sixteen"
+    result = patch_service.apply_patch(ORIGINAL, patch).split("\n")
+    assert result[15] == "sixteen"
+
+
+def test_rejects_hunk_beyond_fuzz(monkeypatch):
+    monkeypatch.setattr(patch_service, "MAX_FUZZ_LINES", 2)
+    patch = "@@ -10,2 +10,2 @@\n line 15\n-line 16\n+sixteen"
+    with pytest.raises(PatchError):
+        patch_service.apply_patch(ORIGINAL, patch)
+
+
+def test_rejects_hunk_that_does_not_match():
+    patch = "@@ -3,1 +3,1 @@\n-not in the file\n+replacement"
+    with pytest.raises(PatchError):
+        patch_service.apply_patch(ORIGINAL, patch)
+    assert not patch_service.is_valid_patch(ORIGINAL, patch)
+
+
+def test_multiple_hunks_and_pure_insertion():
+    patch = (
+        "@@ -2,0 +3,1 @@\n+inserted after 2\n"
+        "@@ -10,1 +11,1 @@\n-line 10\n+ten"
+    )
+    result = patch_service.apply_patch(ORIGINAL, patch).split("\n")
+    assert result[1:4] == ["line 2", "inserted after 2", "line 3"]
+    assert result[10] == "ten"
+    assert len(result) == 21
+
+
+def test_hunks_must_not_overlap_earlier_hunks():
+    patch = "@@ -5,1 +5,1 @@\n-line 5\n+five\n@@ -5,1 +5,1 @@\n-line 5\n+again"
+    with pytest.raises(PatchError):
+        patch_service.apply_patch(ORIGINAL, patch)
+
+
+def test_trailing_whitespace_differences_are_tolerated():
+    original = "a  \nb\nc"
+    patch = "@@ -1,2 +1,2 @@\n a\n-b\n+B"
+    # 一致の判定は行末の空白を無視し、出力のコンテキスト行は差分の内容になる
+    assert patch_service.apply_patch(original, patch) == "a\nB\nc"
+
+
+def test_malformed_diffs_raise():
+    with pytest.raises(PatchError):
+        patch_service.parse_unified_diff("just some text")
+    with pytest.raises(PatchError):
+        patch_service.parse_unified_diff("@@ -1,1 +1,1 @@\n?? unexpected")
+
+
+def test_removed_sql_comment_line_is_not_mistaken_for_a_header():
+    original = "-- comment\nSELECT 1;"
+    patch = "@@ -1,2 +1,1 @@\n--- comment\n SELECT 1;"
+    assert patch_service.apply_patch(original, patch) == "SELECT 1;"
+
+
+def test_shift_patch_moves_only_hunk_headers():
+    patch = "@@ -3,2 +3,3 @@\n line 3\n+new\n line 4\n@@ -8 +9 @@\n-line 8\n+eight"
+    shifted = patch_service.shift_patch(patch, 10)
+    assert shifted.split("\n")[0] == "@@ -13,2 +13,3 @@"
+    assert "@@ -18 +19 @@" in shifted
+    assert shifted.split("\n")[1:3] == [" line 3", "+new"]
+
+
+def test_strip_code_fence():
+    assert patch_service.strip_code_fence("```python\nprint(1)\n```") == "print(1)"
+    assert patch_service.strip_code_fence("print(1)") == "print(1)"
@@ -0,0 +1,28 @@
+# backend/tests/test_prompt_templates.py
+
+import prompt_templates
+import review_json
+
+TOOLS = [{"name": "submit_review", "description": "review", "input_schema": review_json.REVIEW_JSON_SCHEMA}]
+
+
+def test_short_review_prefix_is_sent_without_cache_control():
+    system = prompt_templates.build_review_prompt({"a.py": "x = 1"}).system
+
+    assert prompt_templates.anthropic_system(system, TOOLS) == system
+
+
+def test_prefix_reaching_the_minimum_is_marked_for_caching(monkeypatch):
+    system = prompt_templates.build_review_prompt({"a.py": "x = 1"}).system
+    monkeypatch.setattr(prompt_templates, "ANTHROPIC_CACHE_MIN_TOKENS", prompt_templates.estimate_tokens(system) + 10)
+
+    # system だけでは届かなくても、前に置かれるツール定義と合わせて届けばキャッシュされる
+    assert prompt_templates.anthropic_system(system) == system
+    assert prompt_templates.anthropic_system(system, TOOLS) == [
+        {"type": "text", "text": system, "cache_control": {"type": "ephemeral"}}
+    ]
+
+
+def test_empty_system_is_omitted():
+    assert prompt_templates.anthropic_system(None) is None
+    assert prompt_templates.anthropic_system("") is None
@@ -0,0 +1,184 @@
+# backend/tests/test_review_calls.py
+
+import asyncio
+
+import pytest
+
+import review_calls
+
+
+def test_single_flight_runs_identical_calls_once():
+    flights = review_calls.SingleFlight()
+    calls = []
+
+    async def review():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return {"overall_score": 90}
+
+    async def scenario():
+        return await asyncio.gather(*[flights.do("key", review) for _ in range(3)])
+
+    results = asyncio.run(scenario())
+
+    assert results == [{"overall_score": 90}] * 3
+    assert len(calls) == 1
+    assert flights.stats() == {"in_flight": 0, "leaders": 1, "coalesced": 2}
+
+
+def test_single_flight_follower_sees_the_leaders_exception():
+    flights = review_calls.SingleFlight()
+
+    async def failing_review():
+        await asyncio.sleep(0.01)
+        raise ValueError("model error")
+
+    async def scenario():
+        leader = asyncio.create_task(flights.do("key", failing_review))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(flights.do("key", failing_review))
+        return await asyncio.gather(leader, follower, return_exceptions=True)
+
+    leader_result, follower_result = asyncio.run(scenario())
+
+    assert isinstance(leader_result, ValueError)
+    assert follower_result is leader_result
+    assert flights.stats()["in_flight"] == 0
+
+
+def test_single_flight_follower_survives_the_leader_being_cancelled():
+    flights = review_calls.SingleFlight()
+    started = []
+
+    async def review():
+        started.append(1)
+        await asyncio.sleep(0.05)
+        return "review"
+
+    async def scenario():
+        leader = asyncio.create_task(flights.do("key", review))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(flights.do("key", review))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await follower
+
+    assert asyncio.run(scenario()) == "review"
+    assert len(started) == 1
+
+
+def test_single_flight_cancels_the_call_when_every_waiter_is_cancelled():
+    flights = review_calls.SingleFlight()
+    cancelled = []
+
+    async def review():
+        try:
+            await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            cancelled.append(1)
+            raise
+
+    async def scenario():
+        caller = asyncio.create_task(flights.do("key", review))
+        await asyncio.sleep(0.01)
+        caller.cancel()
+        await asyncio.gather(caller, return_exceptions=True)
+        await asyncio.sleep(0)
+        return flights.stats()
+
+    stats = asyncio.run(scenario())
+
+    assert cancelled == [1]
+    assert stats["in_flight"] == 0
+
+
+def _tracker_with_samples(monkeypatch, model_name, samples):
+    monkeypatch.setattr(review_calls, "REVIEW_HEDGE_MIN_SAMPLES", len(samples))
+    tracker = review_calls.LatencyTracker()
+    for seconds in samples:
+        tracker.record(model_name, seconds)
+    return tracker
+
+
+def test_latency_budget_uses_the_default_until_there_are_enough_samples(monkeypatch):
+    monkeypatch.setattr(review_calls, "REVIEW_HEDGE_DEFAULT_BUDGET_SECONDS", 30.0)
+    tracker = _tracker_with_samples(monkeypatch, "primary", [0.1] * 10)
+    tracker.record("other", 0.5)
+    monkeypatch.setattr(review_calls, "REVIEW_HEDGE_MIN_SAMPLES", 20)
+
+    assert tracker.budget("primary") == 30.0
+
+
+def test_latency_budget_is_the_tracked_percentile(monkeypatch):
+    monkeypatch.setattr(review_calls, "REVIEW_HEDGE_PERCENTILE", 0.9)
+    tracker = _tracker_with_samples(monkeypatch, "primary", [index / 100 for index in range(1, 21)])
+
+    assert tracker.budget("primary") == pytest.approx(0.19)
+
+
+def test_hedge_does_not_fire_when_the_primary_answers_within_the_budget(monkeypatch):
+    monkeypatch.setattr(review_calls, "hedge_stats", {"fired": 0, "fallback_wins": 0})
+    fallback_calls = []
+
+    async def primary():
+        await asyncio.sleep(0.01)
+        return "primary review"
+
+    async def fallback():
+        fallback_calls.append(1)
+        return "fallback review"
+
+    result = asyncio.run(review_calls.hedge("primary", primary, "fallback", fallback, budget=0.5))
+
+    assert result == ("primary review", "primary")
+    assert fallback_calls == []
+    assert review_calls.hedge_stats["fired"] == 0
+
+
+def test_hedge_fires_after_the_budget_and_cancels_the_losing_call(monkeypatch):
+    monkeypatch.setattr(review_calls, "hedge_stats", {"fired": 0, "fallback_wins": 0})
+    tracker = _tracker_with_samples(monkeypatch, "primary", [0.05] * 20)
+    events = []
+
+    async def primary():
+        try:
+            await asyncio.sleep(5)
+            return "primary review"
+        except asyncio.CancelledError:
+            events.append("primary cancelled")
+            raise
+
+    async def fallback():
+        events.append(("fallback started", asyncio.get_running_loop().time()))
+        return "fallback review"
+
+    async def scenario():
+        started = asyncio.get_running_loop().time()
+        result = await review_calls.hedge("primary", primary, "fallback", fallback, tracker.budget("primary"))
+        await asyncio.sleep(0)
+        return result, started
+
+    result, started = asyncio.run(scenario())
+
+    assert result == ("fallback review", "fallback")
+    # フォールバックは主の呼び出しの p95（0.05秒）を過ぎてから始まる
+    assert 0.04 <= events[0][1] - started < 1
+    assert events[1] == "primary cancelled"
+    assert review_calls.hedge_stats == {"fired": 1, "fallback_wins": 1}
+
+
+def test_hedge_reports_the_primary_error_when_both_calls_fail(monkeypatch):
+    monkeypatch.setattr(review_calls, "hedge_stats", {"fired": 0, "fallback_wins": 0})
+
+    async def primary():
+        await asyncio.sleep(0.05)
+        raise ValueError("primary error")
+
+    async def fallback():
+        raise ValueError("fallback error")
+
+    with pytest.raises(ValueError, match="primary error"):
+        asyncio.run(review_calls.hedge("primary", primary, "fallback", fallback, budget=0.01))
+    assert review_calls.hedge_stats["fired"] == 1
@@ -0,0 +1,56 @@
+# backend/tests/test_review_jobs.py
+
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+review_jobs = pytest.importorskip("review_jobs")
+
+
+def test_submit_from_a_worker_thread_wakes_a_waiting_worker(monkeypatch):
+    submitted_from = []
+
+    def fake_create_review_job(db, job_id, payload, project_id=None):
+        submitted_from.append(threading.current_thread())
+        return SimpleNamespace(id=job_id, status="queued")
+
+    monkeypatch.setattr(review_jobs.crud, "create_review_job", fake_create_review_job)
+    monkeypatch.setattr(review_jobs, "REVIEW_JOB_POLL_SECONDS", 5.0)
+
+    async def scenario():
+        # ワーカーは起動せず、待機用の Event とループだけ start_workers と同じように用意する
+        review_jobs.start_workers(count=0)
+        started = time.monotonic()
+        waiter = asyncio.create_task(
+            asyncio.wait_for(review_jobs._wakeup.wait(), timeout=review_jobs.REVIEW_JOB_POLL_SECONDS)
+        )
+        await asyncio.sleep(0)
+        await asyncio.to_thread(review_jobs.submit_review_job, None, "print(1)")
+        await waiter
+        return time.monotonic() - started
+
+    try:
+        elapsed = asyncio.run(scenario())
+    finally:
+        monkeypatch.setattr(review_jobs, "_wakeup", None)
+        monkeypatch.setattr(review_jobs, "_loop", None)
+
+    assert submitted_from and submitted_from[0] is not threading.main_thread()
+    assert elapsed < review_jobs.REVIEW_JOB_POLL_SECONDS / 2
+
+
+def test_submit_without_running_workers_does_not_fail(monkeypatch):
+    monkeypatch.setattr(
+        review_jobs.crud, "create_review_job",
+        lambda db, job_id, payload, project_id=None: SimpleNamespace(id=job_id, status="queued"),
+    )
+    monkeypatch.setattr(review_jobs, "_wakeup", None)
+    monkeypatch.setattr(review_jobs, "_loop", None)
+
+    job = review_jobs.submit_review_job(None, "print(1)")
+
+    assert job.status == "queued"
@@ -0,0 +1,84 @@
+# backend/tests/test_review_json.py
+
+import json
+
+import pytest
+
+import review_json
+
+
+def _review(details: int) -> dict:
+    return {
+        "overall_score": 70,
+        "summary": "概要",
+        "details": [
+            {"category": "Bug", "file_name": "app.py", "line_number": i + 1,
+             "description": f"問題 {i} {{x}}", "suggestion": "if x:\n    return {\"y\": [1]}"}
+            for i in range(details)
+        ],
+    }
+
+
+def test_valid_json_is_not_marked_repaired():
+    review = review_json.parse_review(json.dumps(_review(2), ensure_ascii=False))
+    assert len(review["details"]) == 2
+    assert "repaired" not in review
+
+
+def test_code_fence_and_prose_are_ignored():
+    raw = "以下がレビューです。\n```json\n" + json.dumps(_review(1)) + "\n```\n以上です。"
+    review = review_json.parse_review(raw)
+    assert len(review["details"]) == 1
+    assert "repaired" not in review
+
+
+def test_prose_with_stray_braces_is_not_marked_repaired():
+    raw = "Use {braces} carefully: " + json.dumps(_review(2)) + " and call f() {done}"
+    review = review_json.parse_review(raw)
+    assert len(review["details"]) == 2
+    assert "repaired" not in review
+
+
+@pytest.mark.parametrize("details", [1, 2])
+@pytest.mark.parametrize("cut", ["}", "]}", '"}]}'])
+def test_truncated_closing_keeps_complete_details(details, cut):
+    text = json.dumps(_review(details), ensure_ascii=False)
+    assert text.endswith(cut)
+    review = review_json.parse_review(text[:-len(cut)])
+    assert len(review["details"]) == details - (1 if cut == '"}]}' else 0)
+    assert review["repaired"] is True
+
+
+def test_truncated_mid_detail_drops_only_the_incomplete_detail():
+    text = json.dumps(_review(3), ensure_ascii=False)
+    cut = text.index('"line_number": 3')
+    review = review_json.parse_review(text[:cut])
+    assert [d["line_number"] for d in review["details"]] == [1, 2]
+    assert review["summary"] == "概要"
+    assert review["repaired"] is True
+
+
+def test_truncated_inside_string_with_braces():
+    text = json.dumps(_review(2), ensure_ascii=False)
+    cut = text.rindex("return {")
+    review = review_json.parse_review(text[:cut + len("return {")])
+    assert len(review["details"]) == 1
+    assert review["repaired"] is True
+
+
+def test_trailing_comma_is_repaired():
+    review = review_json.parse_review('{"overall_score": 80, "summary": "ok", "details": [],}')
+    assert review["overall_score"] == 80
+    assert review["repaired"] is True
+
+
+def test_missing_fields_are_normalized():
+    review = review_json.parse_review('{"details": [1, {"category": "Bug"}]}')
+    assert review["details"] == [{"category": "Bug"}]
+    assert review["overall_score"] == 0
+    assert review["summary"] == ""
+
+
+def test_unparseable_response_raises():
+    with pytest.raises(json.JSONDecodeError):
+        review_json.parse_review("no json here")
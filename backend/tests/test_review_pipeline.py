@@ -0,0 +1,69 @@
+# backend/tests/test_review_pipeline.py
+
+import asyncio
+
+import review_pipeline
+from review_pipeline import ReviewPipeline, ReviewTarget
+
+TARGETS = [ReviewTarget("fast", "Fast"), ReviewTarget("slow", "Slow"), ReviewTarget("broken", "Broken")]
+
+
+def _fake_factory(delays, events):
+    async def review(target: ReviewTarget):
+        try:
+            await asyncio.sleep(delays[target.mode])
+        except asyncio.CancelledError:
+            events.append(f"{target.mode} cancelled")
+            raise
+        if target.mode == "broken":
+            raise ValueError("model error")
+        return {"overall_score": 80, "summary": target.mode}
+
+    return review
+
+
+def test_parse_targets_uses_the_mode_when_the_label_is_missing():
+    assert review_pipeline.parse_targets("balanced:Gemini, strict_audit ,") == [
+        ReviewTarget("balanced", "Gemini"), ReviewTarget("strict_audit", "strict_audit"),
+    ]
+
+
+def test_all_targets_finishing_before_the_deadline_are_returned_in_order():
+    events = []
+    factory = _fake_factory({"fast": 0.01, "slow": 0.02, "broken": 0}, events)
+
+    results = asyncio.run(ReviewPipeline(TARGETS, deadline=1).run({"a.py": "x = 1"}, review_factory=factory))
+
+    assert [result["model_name"] for result in results] == ["Fast", "Slow", "Broken"]
+    assert results[0]["review"]["summary"] == "fast"
+    assert results[1]["review"]["summary"] == "slow"
+    assert results[2] == {"model_name": "Broken", "error": "model error"}
+    assert events == []
+
+
+def test_targets_past_the_deadline_are_cancelled_and_reported_as_timed_out():
+    events = []
+    factory = _fake_factory({"fast": 0.01, "slow": 5, "broken": 0.01}, events)
+
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        results = await ReviewPipeline(TARGETS, deadline=0.1).run({"a.py": "x = 1"}, review_factory=factory)
+        elapsed = loop.time() - started
+        await asyncio.sleep(0)  # キャンセルされたタスクの後処理を進める
+        return results, elapsed
+
+    results, elapsed = asyncio.run(scenario())
+
+    assert elapsed < 1
+    assert results[0] == {"model_name": "Fast", "review": {"overall_score": 80, "summary": "fast"}}
+    assert results[1]["model_name"] == "Slow"
+    assert results[1]["timed_out"] is True
+    assert "0.1 seconds" in results[1]["error"]
+    assert "review" not in results[1]
+    assert results[2] == {"model_name": "Broken", "error": "model error"}
+    assert events == ["slow cancelled"]
+
+
+def test_no_targets_returns_no_results():
+    assert asyncio.run(ReviewPipeline([], deadline=1).run({"a.py": ""}, review_factory=lambda target: None)) == []
@@ -0,0 +1,111 @@
+# backend/tests/test_review_planner.py
+
+import pytest
+
+import patch_service
+import review_planner
+
+
+def _functions(count: int, body_lines: int = 3) -> str:
+    return "\n".join(
+        f"def func_{i}():\n" + "\n".join(f"    value_{j} = {j}" for j in range(body_lines)) + "\n"
+        for i in range(count)
+    )
+
+
+def test_estimate_tokens_counts_non_ascii_per_character():
+    assert review_planner.estimate_tokens("abcd" * 10) == 11
+    assert review_planner.estimate_tokens("日本語") == 4
+
+
+@pytest.mark.parametrize("text", ["x" * 1000, "あ" * 1000, "ab日本" * 250])
+def test_fitting_length_is_the_longest_prefix_within_the_budget(text):
+    length = review_planner.fitting_length(text, 50)
+    assert review_planner.estimate_tokens(text[:length]) <= 50
+    assert review_planner.estimate_tokens(text[:length + 1]) > 50
+
+
+def test_small_files_share_one_chunk():
+    chunks = review_planner.plan_chunks({"a.py": "x = 1", "b.py": "y = 2"}, budget=100)
+    assert len(chunks) == 1
+    assert chunks[0].files() == {"a.py": "x = 1", "b.py": "y = 2"}
+    assert not review_planner.needs_chunking({"a.py": "x = 1"}, budget=100)
+
+
+def test_large_file_is_split_on_definition_boundaries():
+    code = _functions(8)
+    chunks = review_planner.plan_chunks({"app.py": code}, budget=40)
+    assert len(chunks) > 1
+    lines = code.split("\n")
+    covered = []
+    for chunk in chunks:
+        (part,) = chunk.parts
+        assert part.partial
+        assert part.content.startswith("def ")
+        assert part.content.split("\n") == lines[part.start_line - 1:part.end_line]
+        assert chunk.files() == {f"app.py (lines {part.start_line}-{part.end_line})": part.content}
+        covered += part.content.split("\n")
+    assert covered == lines
+
+
+def test_decorators_and_comments_stay_with_their_definition():
+    code = "x = 1\n\n# helper\n@cached\ndef f():\n    return 1\n"
+    units = review_planner._split_units(code)
+    assert [start for start, _ in units] == [1, 3]
+    assert units[1][1][:3] == ["# helper", "@cached", "def f():"]
+
+
+def test_oversized_definition_is_split_by_lines():
+    code = _functions(1, body_lines=60)
+    parts = review_planner._split_file("big.py", code, budget=30)
+    assert len(parts) > 1
+    assert "\n".join(part.content for part in parts) == code
+    for previous, current in zip(parts, parts[1:]):
+        assert current.start_line == previous.end_line + 1
+
+
+def test_merge_remaps_line_numbers_and_patches_to_the_original_file():
+    code = _functions(6)
+    chunks = review_planner.plan_chunks({"app.py": code}, budget=40)
+    reviews = []
+    for chunk in chunks:
+        (display_name, content), = chunk.files().items()
+        second = content.split("\n")[1]
+        reviews.append({
+            "overall_score": 80,
+            "summary": f"chunk {len(reviews)}",
+            "details": [{
+                "file_name": display_name, "line_number": 2, "suggestion_format": "patch",
+                "suggestion": f"@@ -2,1 +2,1 @@\n-{second}\n+{second}  # fixed",
+            }],
+        })
+
+    merged = review_planner.merge_chunk_reviews(chunks, reviews, [False] * len(chunks))
+
+    assert merged["chunks"] == len(chunks)
+    assert [d["line_number"] for d in merged["details"]] == [chunk.parts[0].start_line + 1 for chunk in chunks]
+    for detail in merged["details"]:
+        assert detail["file_name"] == "app.py"
+        fixed = patch_service.apply_patch(code, detail["suggestion"]).split("\n")
+        assert fixed[detail["line_number"] - 1].endswith("# fixed")
+
+
+def test_merge_weights_scores_and_reports_failed_chunks():
+    chunks = [
+        review_planner.ReviewChunk(parts=[review_planner.ChunkPart("a.py", 1, "a\nb", partial=True)], tokens=30),
+        review_planner.ReviewChunk(parts=[review_planner.ChunkPart("a.py", 3, "c\nd", partial=True)], tokens=10),
+        review_planner.ReviewChunk(parts=[review_planner.ChunkPart("a.py", 5, "e\nf", partial=True)], tokens=10),
+    ]
+    reviews = [{"overall_score": 90, "details": []}, {"overall_score": 50, "details": []}, {}]
+    merged = review_planner.merge_chunk_reviews(chunks, reviews, [False, False, True])
+
+    assert merged["overall_score"] == 80
+    (error,) = merged["details"]
+    assert error["category"] == "Error"
+    assert error["line_number"] == 5
+
+
+def test_merge_raises_when_every_chunk_failed():
+    chunk = review_planner.ReviewChunk(parts=[review_planner.ChunkPart("a.py", 1, "a")], tokens=1)
+    with pytest.raises(ValueError):
+        review_planner.merge_chunk_reviews([chunk], [{}], [True])
@@ -0,0 +1,71 @@
+# backend/tests/test_review_stream_parser.py
+
+import json
+
+import pytest
+
+from review_stream_parser import IncrementalReviewParser
+
+REVIEW = {
+    "overall_score": 75,
+    "summary": "括弧 { や [ を含む \"概要\"",
+    "details": [
+        {"category": "Bug", "file_name": "app.py", "line_number": 3,
+         "description": "missing } in \"dict\"", "suggestion": "x = {'a': [1, 2]}\\n"},
+        {"category": "Style", "file_name": "app.py", "line_number": 10,
+         "description": "escaped backslash \\\\", "suggestion": "print(\"]}\")"},
+    ],
+}
+TEXT = json.dumps(REVIEW, ensure_ascii=False)
+
+
+def _feed_in_pieces(parser: IncrementalReviewParser, text: str, size: int) -> list:
+    completed = []
+    for start in range(0, len(text), size):
+        completed += parser.feed(text[start:start + size])
+    return completed
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 64, len(TEXT)])
+def test_details_are_emitted_regardless_of_chunk_boundaries(size):
+    parser = IncrementalReviewParser()
+    completed = _feed_in_pieces(parser, TEXT, size)
+    assert completed == REVIEW["details"]
+    assert parser.details == REVIEW["details"]
+    assert parser.is_complete
+    assert json.loads(parser.root_text()) == REVIEW
+
+
+def test_each_detail_is_emitted_as_soon_as_it_closes():
+    parser = IncrementalReviewParser()
+    first_end = TEXT.index('"line_number": 10')
+    assert parser.feed(TEXT[:first_end]) == REVIEW["details"][:1]
+    assert parser.feed(TEXT[first_end:]) == REVIEW["details"][1:]
+
+
+def test_braces_inside_strings_do_not_close_items():
+    parser = IncrementalReviewParser()
+    cut = TEXT.index("missing }") + len("missing }")
+    assert parser.feed(TEXT[:cut]) == []
+    assert not parser.is_complete
+
+
+def test_surrounding_prose_and_code_fence_are_ignored():
+    parser = IncrementalReviewParser()
+    text = "Here is the review [draft]:\n```json\n" + TEXT + "\n```\nDone {ok}."
+    completed = _feed_in_pieces(parser, text, 5)
+    assert completed == REVIEW["details"]
+    assert parser.root_text() == TEXT
+
+
+def test_nested_objects_outside_details_are_not_emitted():
+    parser = IncrementalReviewParser()
+    text = json.dumps({"meta": {"details": [{"a": 1}]}, "details": [{"b": 2}]})
+    assert parser.feed(text) == [{"b": 2}]
+
+
+def test_incomplete_stream_reports_partial_root():
+    parser = IncrementalReviewParser()
+    parser.feed(TEXT[:40])
+    assert not parser.is_complete
+    assert parser.root_text() == TEXT[:40]
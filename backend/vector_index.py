@@ -0,0 +1,249 @@
+# backend/vector_index.py
+
+import os
+import time
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import text
+
+import metrics_service
+
+# --- 設定値（環境変数で上書き可能） ---
+# ベクトル検索の近似インデックスの種類。"hnsw"（既定。精度と速度のバランスが良い）/ "ivfflat"（構築が速く小さい）/ "none"
+VECTOR_INDEX_TYPE = os.getenv("VECTOR_INDEX_TYPE", "hnsw").lower()
+# HNSWの構築パラメータ（大きいほど精度が上がるが、構築が遅くインデックスが大きくなる）
+VECTOR_HNSW_M = int(os.getenv("VECTOR_HNSW_M", "16"))
+VECTOR_HNSW_EF_CONSTRUCTION = int(os.getenv("VECTOR_HNSW_EF_CONSTRUCTION", "64"))
+# IVFFlatのリスト数（目安は 行数/1000、100万行を超えたら sqrt(行数)）。データが入った後に作らないと精度が出ない
+VECTOR_IVFFLAT_LISTS = int(os.getenv("VECTOR_IVFFLAT_LISTS", "100"))
+# インデックス構築時の maintenance_work_mem（例: "1GB"）。空ならサーバーの設定のまま
+VECTOR_INDEX_MAINTENANCE_WORK_MEM = os.getenv("VECTOR_INDEX_MAINTENANCE_WORK_MEM", "")
+
+# 検索時の既定値。HNSWは ef_search（候補リストの大きさ）、IVFFlatは probes（探索するリスト数）を大きくするほど再現率が上がり、遅くなる
+VECTOR_SEARCH_EF_SEARCH = int(os.getenv("VECTOR_SEARCH_EF_SEARCH", "100"))
+VECTOR_SEARCH_PROBES = int(os.getenv("VECTOR_SEARCH_PROBES", "10"))
+# pgvector 0.8以降の反復スキャン（"relaxed_order" / "strict_order"）。project_id での絞り込み後に件数が足りなくなるのを防ぐ。空なら使わない
+VECTOR_SEARCH_ITERATIVE_SCAN = os.getenv("VECTOR_SEARCH_ITERATIVE_SCAN", "")
+
+# 全文検索の設定。日本語や識別子を語幹処理で崩さないよう "simple" を使う（変更する場合はインデックスの作り直しが必要）
+TEXT_SEARCH_CONFIG = "simple"
+
+INDEX_TYPES = ("hnsw", "ivfflat")
+# 近似インデックスを張るテーブル（messages と、長いメッセージの部分ごとのベクトルを持つ message_chunks）
+VECTOR_TABLES = ("messages", "message_chunks")
+
+# 複数のプロセスから移行処理が同時に走らないようにするためのロックのキー
+_MIGRATION_LOCK_KEY = 7_190_019
+
+_stats: Dict[str, Any] = {"migrated": False, "migration_seconds": 0.0, "steps": [], "errors": [],
+                          "dropped_invalid": [], "missing_indexes": [], "searches": 0}
+
+
+def index_name(table: str, index_type: str) -> str:
+    return f"ix_{table}_embedding_{index_type}"
+
+
+def text_index_name(table: str) -> str:
+    return f"ix_{table}_content_tsv"
+
+
+def _index_ddl(table: str, index_type: str) -> str:
+    if index_type == "hnsw":
+        options = f"m = {VECTOR_HNSW_M}, ef_construction = {VECTOR_HNSW_EF_CONSTRUCTION}"
+    else:
+        options = f"lists = {VECTOR_IVFFLAT_LISTS}"
+    # 稼働中のテーブルへの書き込みを止めないよう CONCURRENTLY で作成する（トランザクションの外で実行する必要がある）
+    return (
+        f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {index_name(table, index_type)} "
+        f"ON {table} USING {index_type} (embedding vector_cosine_ops) WITH ({options})"
+    )
+
+
+def column_steps() -> List[tuple]:
+    """
+    モデルが参照する列を追加するDDLの一覧を返します（テーブル名, 列名, DDL）。
+    列がなければクエリ自体が失敗するため、起動時に実行します（NULL可の列の追加はすぐに終わる）。
+    """
+    return [
+        # project_id の非正規化。検索のたびに conversations と結合せずに絞り込めるようにする
+        ("messages", "project_id",
+         "ALTER TABLE messages ADD COLUMN IF NOT EXISTS project_id INTEGER REFERENCES projects(id) ON DELETE CASCADE"),
+        ("message_chunks", "project_id",
+         "ALTER TABLE message_chunks ADD COLUMN IF NOT EXISTS project_id INTEGER REFERENCES projects(id) ON DELETE CASCADE"),
+    ]
+
+
+def expected_indexes(index_type: Optional[str] = None) -> List[str]:
+    index_type = (index_type or VECTOR_INDEX_TYPE).lower()
+    names = ["ix_messages_project_id", "ix_message_chunks_project_id"]
+    names += [text_index_name(table) for table in VECTOR_TABLES]
+    if index_type in INDEX_TYPES:
+        names += [index_name(table, index_type) for table in VECTOR_TABLES]
+    return names
+
+
+def migration_steps(index_type: Optional[str] = None) -> List[tuple]:
+    """
+    既存行の埋め戻しとインデックスの構築を行う冪等なDDLの一覧を返します。
+    大きなテーブルでは時間がかかるため、起動時ではなく migrations.py から明示的に実行します。
+    何度実行しても同じ状態になるよう、すべて IF NOT EXISTS / IS NULL の条件付きで書いています。
+    """
+    index_type = (index_type or VECTOR_INDEX_TYPE).lower()
+    steps = [
+        # 1. project_id を追加する前に保存された行の埋め戻しと、絞り込み用のインデックス
+        ("backfill messages.project_id",
+         "UPDATE messages SET project_id = conversations.project_id FROM conversations "
+         "WHERE messages.conversation_id = conversations.id AND messages.project_id IS NULL"),
+        ("backfill message_chunks.project_id",
+         "UPDATE message_chunks SET project_id = messages.project_id FROM messages "
+         "WHERE message_chunks.message_id = messages.id AND message_chunks.project_id IS NULL"),
+        ("index messages.project_id",
+         "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_messages_project_id ON messages (project_id)"),
+        ("index message_chunks.project_id",
+         "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_message_chunks_project_id ON message_chunks (project_id)"),
+    ]
+    # 2. 関数名やエラーメッセージで検索するための全文検索（tsvector + GIN）のインデックス
+    for table in VECTOR_TABLES:
+        steps.append((f"create {text_index_name(table)}", (
+            f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {text_index_name(table)} "
+            f"ON {table} USING gin (to_tsvector('{TEXT_SEARCH_CONFIG}', content))"
+        )))
+    # 3. コサイン距離の近似インデックス。種類を切り替えた場合は、使わなくなった方を削除する
+    for table in VECTOR_TABLES:
+        for other in INDEX_TYPES:
+            if other != index_type:
+                steps.append((f"drop {index_name(table, other)}", f"DROP INDEX CONCURRENTLY IF EXISTS {index_name(table, other)}"))
+        if index_type in INDEX_TYPES:
+            steps.append((f"create {index_name(table, index_type)}", _index_ddl(table, index_type)))
+    return steps
+
+
+def _invalid_indexes(conn) -> List[str]:
+    names = [index_name(table, index_type) for table in VECTOR_TABLES for index_type in INDEX_TYPES]
+    names += [text_index_name(table) for table in VECTOR_TABLES]
+    names += ["ix_messages_project_id", "ix_message_chunks_project_id"]
+    return conn.execute(text(
+        "SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+        "WHERE NOT i.indisvalid AND c.relname = ANY(:names)"
+    ), {"names": names}).scalars().all()
+
+
+def _drop_invalid_indexes(conn) -> List[str]:
+    """
+    CONCURRENTLY での作成が途中で失敗すると無効なインデックスが残り、IF NOT EXISTS で作り直されなくなるため削除する。
+    作成中のインデックスも無効として見えるため、移行処理のロックを持っているときだけ呼ぶこと。
+    """
+    dropped = []
+    for name in _invalid_indexes(conn):
+        print(f"--- DEBUG: Dropping invalid index {name} left by an interrupted build. ---")
+        conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+        dropped.append(name)
+    return dropped
+
+
+def migrate(engine, index_type: Optional[str] = None) -> Dict[str, Any]:
+    """
+    記憶の検索に使う列の埋め戻しとインデックス（全文検索・ベクトル）の構築を行います（python migrations.py から呼ばれる）。
+    失敗した手順があっても続きを実行し、失敗した手順は結果の errors に記録します。
+    """
+    started = time.monotonic()
+    steps, errors = [], []
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        # 複数のプロセスから同時に実行されても、順番に1つずつ実行する
+        conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": _MIGRATION_LOCK_KEY})
+        try:
+            if VECTOR_INDEX_MAINTENANCE_WORK_MEM:
+                conn.execute(text("SELECT set_config('maintenance_work_mem', :value, false)"),
+                             {"value": VECTOR_INDEX_MAINTENANCE_WORK_MEM})
+            _drop_invalid_indexes(conn)
+            for name, ddl in [(f"add {table}.{column}", ddl) for table, column, ddl in column_steps()] + migration_steps(index_type):
+                try:
+                    step_started = time.monotonic()
+                    conn.execute(text(ddl))
+                    steps.append({"step": name, "seconds": round(time.monotonic() - step_started, 3)})
+                except Exception as e:
+                    print(f"--- DEBUG: Vector index migration step '{name}' failed: {e} ---")
+                    errors.append({"step": name, "error": str(e)})
+        finally:
+            conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": _MIGRATION_LOCK_KEY})
+
+    _stats.update({
+        "migrated": not errors,
+        "migration_seconds": round(time.monotonic() - started, 3),
+        "steps": steps,
+        "errors": errors,
+    })
+    print(f"--- DEBUG: Vector index migration finished in {_stats['migration_seconds']}s ({len(errors)} error(s)). ---")
+    return dict(_stats)
+
+
+def check(engine, index_type: Optional[str] = None) -> Dict[str, Any]:
+    """
+    起動時に、中断された構築が残した無効なインデックスを削除し、必要なインデックスがそろっているかを確認します。
+    インデックスは作成しません（なくても検索は全件走査で動作する）。足りなければ python migrations.py の実行を促します。
+    """
+    dropped: List[str] = []
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        # 移行処理の実行中は、作成中のインデックスを無効と誤って削除しないよう何もしない
+        if conn.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": _MIGRATION_LOCK_KEY}).scalar():
+            try:
+                dropped = _drop_invalid_indexes(conn)
+            finally:
+                conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": _MIGRATION_LOCK_KEY})
+        else:
+            print("--- DEBUG: A vector index migration is running. Skipping the invalid index check. ---")
+        expected = expected_indexes(index_type)
+        existing = set(conn.execute(text(
+            "SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+            "WHERE i.indisvalid AND c.relname = ANY(:names)"
+        ), {"names": expected}).scalars().all())
+
+    missing = [name for name in expected if name not in existing]
+    _stats.update({"dropped_invalid": dropped, "missing_indexes": missing})
+    if missing:
+        print(f"--- DEBUG: Missing search indexes {missing}. Run `python migrations.py` to build them. ---")
+    return dict(_stats)
+
+
+def _search_settings(ef_search: Optional[int], probes: Optional[int]) -> Dict[str, str]:
+    settings = {
+        "hnsw.ef_search": ef_search or VECTOR_SEARCH_EF_SEARCH,
+        "ivfflat.probes": probes or VECTOR_SEARCH_PROBES,
+    }
+    if VECTOR_SEARCH_ITERATIVE_SCAN:
+        settings["hnsw.iterative_scan"] = VECTOR_SEARCH_ITERATIVE_SCAN
+        settings["ivfflat.iterative_scan"] = VECTOR_SEARCH_ITERATIVE_SCAN
+    return {name: str(value) for name, value in settings.items()}
+
+
+_SET_LOCAL = text("SELECT set_config(:name, :value, true)")
+
+
+def apply_search_settings(db, ef_search: Optional[int] = None, probes: Optional[int] = None) -> None:
+    """
+    このトランザクション内の検索にだけ効く形で、近似検索のパラメータを設定します（SET LOCAL と同じ）。
+    ef_search / probes を省略した場合は環境変数の既定値を使います。
+    """
+    for name, value in _search_settings(ef_search, probes).items():
+        db.execute(_SET_LOCAL, {"name": name, "value": value})
+    _stats["searches"] += 1
+
+
+async def aapply_search_settings(db, ef_search: Optional[int] = None, probes: Optional[int] = None) -> None:
+    """apply_search_settings の AsyncSession 版です。"""
+    for name, value in _search_settings(ef_search, probes).items():
+        await db.execute(_SET_LOCAL, {"name": name, "value": value})
+    _stats["searches"] += 1
+
+
+def index_stats() -> Dict[str, Any]:
+    return {
+        "index_type": VECTOR_INDEX_TYPE,
+        "ef_search": VECTOR_SEARCH_EF_SEARCH,
+        "probes": VECTOR_SEARCH_PROBES,
+        "iterative_scan": VECTOR_SEARCH_ITERATIVE_SCAN or None,
+        **_stats,
+    }
+
+
+metrics_service.register("vector_index", index_stats)